@@ -32,6 +32,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# app.xray has to be imported before app.db, which the API workers' jobs import first
+from app import xray  # noqa
 from app import dashboard, jobs, routers, telegram  # noqa
 from app.routers import api_router  # noqa
 
@@ -0,0 +1,168 @@
+"""
+In-memory counters behind the system stats, kept current from user changes committed through the ORM.
+
+They're per process: in the multi-worker mode every API worker only sees the changes it
+commits itself, and the changes of the other workers and the controller (including the
+bandwidth of the usage pipeline) when its users counters job refreshes them, so the
+stats served by different workers may differ for up to JOB_REFRESH_USERS_COUNTERS_INTERVAL.
+"""
+
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+from app.db.base import SessionLocal
+from app.db.models import Admin, System, User
+from app.models.user import UserStatus
+
+# (admin username, status)
+CounterKey = Tuple[Optional[str], UserStatus]
+
+
+class UsersCounters:
+    """
+    Users per admin and status, online users and total bandwidth.
+
+    They're loaded with one GROUP BY query, then users created, removed or whose status or
+    admin change are applied when their session commits. Bulk updates only mark them
+    stale, and the users counters job reloads them periodically anyway, which also
+    refreshes the online users and bandwidth.
+    """
+
+    def __init__(self):
+        self.counts: Dict[CounterKey, int] = defaultdict(int)
+        self.admins: Dict[int, str] = {}
+        self.online_users = 0
+        self.uplink = 0
+        self.downlink = 0
+        self.stale = True
+        self._lock = Lock()
+
+    def refresh(self, db: Session):
+        from app.db.crud import count_online_users
+
+        counts = defaultdict(int)
+        for username, status, count in db.query(Admin.username, User.status, func.count(User.id)) \
+                .select_from(User).outerjoin(Admin, User.admin_id == Admin.id) \
+                .group_by(Admin.username, User.status):
+            counts[(username, status)] = count
+        admins = {admin_id: username for admin_id, username in db.query(Admin.id, Admin.username)}
+        online_users = count_online_users(db, 24)
+        system = db.query(System).first()
+
+        with self._lock:
+            self.counts = counts
+            self.admins = admins
+            self.online_users = online_users
+            if system:
+                self.uplink, self.downlink = system.uplink, system.downlink
+            self.stale = False
+
+    def invalidate(self):
+        self.stale = True
+
+    def ensure(self, db: Session):
+        if self.stale:
+            self.refresh(db)
+
+    def count(self, db: Session, status: UserStatus = None, admin: str = None) -> int:
+        """Users with `status` (any if None) owned by the admin with username `admin` (any if None)."""
+        self.ensure(db)
+        with self._lock:
+            return sum(
+                count for (username, user_status), count in self.counts.items()
+                if (status is None or user_status == status) and (admin is None or username == admin)
+            )
+
+    def apply(self, changes: List[Tuple[Optional[Tuple[int, UserStatus]], Optional[Tuple[int, UserStatus]]]]):
+        """Applies (old, new) (admin id, status) pairs of users, None for created or removed ones."""
+        with self._lock:
+            for old, new in changes:
+                for key, delta in ((old, -1), (new, 1)):
+                    if key is None:
+                        continue
+                    admin_id, status = key
+                    if admin_id is not None and admin_id not in self.admins:
+                        self.stale = True
+                        return
+                    self.counts[(self.admins.get(admin_id), status)] += delta
+
+    def add_bandwidth(self, uplink: int, downlink: int):
+        with self._lock:
+            self.uplink += uplink
+            self.downlink += downlink
+
+
+users_counters = UsersCounters()
+
+
+def _key(attrs: dict) -> Optional[Tuple[int, UserStatus]]:
+    if 'status' not in attrs:
+        return None
+    return attrs.get('admin_id'), attrs['status']
+
+
+def _previous(history):
+    values = history.deleted or history.unchanged
+    return values[0] if values else None
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_user_changes(session: Session, flush_context):
+    changes = session.info.setdefault("users_counters", [])
+
+    for obj in session.new:
+        if isinstance(obj, User):
+            new = _key(inspect(obj).dict)
+            if new is None:
+                users_counters.invalidate()
+            else:
+                changes.append((None, new))
+
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            old = _key(inspect(obj).dict)
+            if old is None:
+                users_counters.invalidate()
+            else:
+                changes.append((old, None))
+        elif isinstance(obj, Admin):
+            users_counters.invalidate()
+
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        status = state.attrs.status.history
+        admin_id = state.attrs.admin_id.history
+        if not (status.has_changes() or admin_id.has_changes()):
+            continue
+
+        new = _key(state.dict)
+        old_status = _previous(status)
+        if admin_id.has_changes():
+            old_admin_id = _previous(admin_id)
+            unknown = not (admin_id.deleted or admin_id.unchanged)
+        else:
+            old_admin_id = new[0] if new else None
+            unknown = False
+        if new is None or old_status is None or unknown:
+            # the previous values weren't loaded
+            users_counters.invalidate()
+            continue
+        changes.append(((old_admin_id, old_status), new))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_user_changes(session: Session):
+    changes = session.info.pop("users_counters", None)
+    if changes:
+        users_counters.apply(changes)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_user_changes(session: Session):
+    session.info.pop("users_counters", None)
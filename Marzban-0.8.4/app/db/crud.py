@@ -2,14 +2,20 @@
 Functions for managing proxy hosts, users, user templates, nodes, and administrative tasks.
 """
 
-from datetime import datetime, timedelta
+import base64
+import json
+import time
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import Dict, List, Optional, Tuple, Union
 
-from sqlalchemy import and_, delete, func, or_
+from sqlalchemy import DateTime, and_, case, delete, func, insert, literal, or_, select
 from sqlalchemy.orm import Query, Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.elements import ColumnElement
 from sqlalchemy.sql.functions import coalesce
 
+from app.db.counters import users_counters
 from app.db.models import (
     JWT,
     TLS,
@@ -19,6 +25,8 @@ from app.db.models import (
     Node,
     NodeUsage,
     NodeUserUsage,
+    NodeUserUsageDaily,
+    NodeUserUsageMonthly,
     NotificationReminder,
     Proxy,
     ProxyHost,
@@ -29,21 +37,26 @@ from app.db.models import (
     UserTemplate,
     UserUsageResetLogs,
 )
+from app.db.quotas import user_quotas
+from app.db.search import search_rank, search_users_filter, user_search_rank
+from app.db.sub_updates import sub_updates
 from app.models.admin import AdminCreate, AdminModify, AdminPartialModify
 from app.models.node import NodeCreate, NodeModify, NodeStatus, NodeUsageResponse
 from app.models.proxy import ProxyHost as ProxyHostModify
 from app.models.user import (
     ReminderType,
+    UsageGranularity,
     UserCreate,
     UserDataLimitResetStrategy,
     UserModify,
     UserResponse,
     UserStatus,
+    UserUsageBucket,
     UserUsageResponse,
 )
 from app.models.user_template import UserTemplateCreate, UserTemplateModify
 from app.utils.helpers import calculate_expiration_days, calculate_usage_percent
-from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, USERS_AUTODELETE_DAYS
+from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, USERS_AUTODELETE_DAYS, USERS_COUNT_CACHE_TTL
 
 
 def add_default_host(db: Session, inbound: ProxyInbound):
@@ -221,40 +234,103 @@ UsersSortingOptions = Enum('UsersSortingOptions', {
 })
 
 
-def get_users(db: Session,
-              offset: Optional[int] = None,
-              limit: Optional[int] = None,
-              usernames: Optional[List[str]] = None,
-              search: Optional[str] = None,
-              status: Optional[Union[UserStatus, list]] = None,
-              sort: Optional[List[UsersSortingOptions]] = None,
-              admin: Optional[Admin] = None,
-              admins: Optional[List[str]] = None,
-              reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None,
-              return_with_count: bool = False) -> Union[List[User], Tuple[List[User], int]]:
+# sort keys that can be NULL are ordered by whether they're NULL first, so keyset pagination is portable
+_NULLABLE_SORT_KEYS = {'data_limit', 'expire'}
+# (filters) -> (expires at, count)
+_users_count_cache: Dict[tuple, Tuple[float, int]] = {}
+
+
+def _get_users_keys(sort: Optional[List[UsersSortingOptions]],
+                    search: Optional[str] = None) -> List[Tuple[str, ColumnElement, bool]]:
     """
-    Retrieves users based on various filters and options.
+    (name, expression, descending) of every key users are ordered by, ending with the id as a tie breaker.
+
+    Search results without sorting options are ordered by their search rank first.
+    """
+    keys = []
+    if search and not sort:
+        keys.append(('search_rank', search_rank(search), False))
+    for opt in sort or []:
+        name = opt.name.lstrip('-')
+        descending = opt.name.startswith('-')
+        column = getattr(User, name)
+        if name in _NULLABLE_SORT_KEYS:
+            keys.append((f"{name}_is_null", case((column.is_(None), 1), else_=0), descending))
+        keys.append((name, column, descending))
+    keys.append(('id', User.id, False))
+    return keys
+
+
+def _get_user_key_values(user: User, keys: List[Tuple[str, ColumnElement, bool]], search: Optional[str] = None) -> list:
+    values = []
+    for name, _, _ in keys:
+        if name == 'search_rank':
+            values.append(user_search_rank(user, search))
+        elif name.endswith('_is_null'):
+            values.append(int(getattr(user, name[:-len('_is_null')]) is None))
+        else:
+            value = getattr(user, name)
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+    return values
+
+
+def encode_users_cursor(user: User, sort: Optional[List[UsersSortingOptions]] = None, search: Optional[str] = None) -> str:
+    """
+    Creates the cursor of the page after a user.
 
     Args:
-        db (Session): Database session.
-        offset (Optional[int]): Number of records to skip.
-        limit (Optional[int]): Number of records to retrieve.
-        usernames (Optional[List[str]]): List of usernames to filter by.
-        search (Optional[str]): Search term to filter by username or note.
-        status (Optional[Union[UserStatus, list]]): User status or list of statuses to filter by.
-        sort (Optional[List[UsersSortingOptions]]): Sorting options.
-        admin (Optional[Admin]): Admin to filter users by.
-        admins (Optional[List[str]]): List of admin usernames to filter users by.
-        reset_strategy (Optional[Union[UserDataLimitResetStrategy, list]]): Data limit reset strategy to filter by.
-        return_with_count (bool): Whether to return the total count of users.
+        user (User): Last user of a page.
+        sort (Optional[List[UsersSortingOptions]]): Sorting options of the page.
+        search (Optional[str]): Search term of the page.
 
     Returns:
-        Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count.
+        str: Opaque cursor.
     """
-    query = get_user_queryset(db)
+    keys = _get_users_keys(sort, search)
+    data = {"sort": [opt.name for opt in sort or []], "values": _get_user_key_values(user, keys, search)}
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
 
+def _decode_users_cursor(cursor: str, keys: List[Tuple[str, ColumnElement, bool]],
+                         sort: Optional[List[UsersSortingOptions]]) -> list:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = data["values"]
+        cursor_sort = data["sort"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+
+    if cursor_sort != [opt.name for opt in sort or []] or len(values) != len(keys):
+        raise ValueError("Cursor doesn't match the sort options")
+
+    return [
+        datetime.fromisoformat(value) if name == 'created_at' and value is not None else value
+        for (name, _, _), value in zip(keys, values)
+    ]
+
+
+def _filter_after_cursor(keys: List[Tuple[str, ColumnElement, bool]], values: list) -> ColumnElement:
+    """Rows ordered after the row with `values` for `keys`, compared lexicographically."""
+    clauses = []
+    for i, (_, expr, descending) in enumerate(keys):
+        if values[i] is None:
+            # NULLs are grouped by their is_null key, nothing within the group comes after them
+            continue
+        equals = [expr_ == value if value is not None else expr_.is_(None)
+                  for (_, expr_, _), value in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equals, expr < values[i] if descending else expr > values[i]))
+    return or_(*clauses)
+
+
+def _filter_users(query: Query,
+                  usernames: Optional[List[str]] = None,
+                  search: Optional[str] = None,
+                  status: Optional[Union[UserStatus, list]] = None,
+                  admin: Optional[Admin] = None,
+                  admins: Optional[List[str]] = None,
+                  reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None) -> Query:
     if search:
-        query = query.filter(or_(User.username.ilike(f"%{search}%"), User.note.ilike(f"%{search}%")))
+        query = query.filter(search_users_filter(search))
 
     if usernames:
         query = query.filter(User.username.in_(usernames))
@@ -277,13 +353,85 @@ def get_users(db: Session,
     if admins:
         query = query.filter(User.admin.has(Admin.username.in_(admins)))
 
+    return query
+
+
+def count_users(db: Session, **filters) -> int:
+    """
+    Counts users matching the filters of get_users, cached for USERS_COUNT_CACHE_TTL seconds.
+
+    The count is taken on the users table alone, without the joined relations of the users query.
+    Creating or removing users drops the cached counts.
+    """
+    key = tuple(
+        (name, tuple(value) if isinstance(value, list) else getattr(value, 'id', value))
+        for name, value in sorted(filters.items())
+    )
+    if USERS_COUNT_CACHE_TTL:
+        cached = _users_count_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+    count = _filter_users(db.query(func.count(User.id)), **filters).scalar()
+
+    if USERS_COUNT_CACHE_TTL:
+        _users_count_cache[key] = (time.monotonic() + USERS_COUNT_CACHE_TTL, count)
+    return count
+
+
+def clear_users_count_cache():
+    _users_count_cache.clear()
+
+
+def get_users(db: Session,
+              offset: Optional[int] = None,
+              limit: Optional[int] = None,
+              usernames: Optional[List[str]] = None,
+              search: Optional[str] = None,
+              status: Optional[Union[UserStatus, list]] = None,
+              sort: Optional[List[UsersSortingOptions]] = None,
+              admin: Optional[Admin] = None,
+              admins: Optional[List[str]] = None,
+              reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None,
+              return_with_count: bool = False,
+              cursor: Optional[str] = None) -> Union[List[User], Tuple[List[User], int]]:
+    """
+    Retrieves users based on various filters and options.
+
+    Args:
+        db (Session): Database session.
+        offset (Optional[int]): Number of records to skip, ignored when a cursor is given.
+        limit (Optional[int]): Number of records to retrieve.
+        usernames (Optional[List[str]]): List of usernames to filter by.
+        search (Optional[str]): Search term to filter by username or note, see search_users_filter().
+        status (Optional[Union[UserStatus, list]]): User status or list of statuses to filter by.
+        sort (Optional[List[UsersSortingOptions]]): Sorting options.
+        admin (Optional[Admin]): Admin to filter users by.
+        admins (Optional[List[str]]): List of admin usernames to filter users by.
+        reset_strategy (Optional[Union[UserDataLimitResetStrategy, list]]): Data limit reset strategy to filter by.
+        return_with_count (bool): Whether to return the total count of users.
+        cursor (Optional[str]): Cursor from encode_users_cursor() to return the users after.
+
+    Returns:
+        Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count.
+
+    Raises:
+        ValueError: If the cursor is invalid or was created with other sorting options.
+    """
+    filters = dict(usernames=usernames, search=search, status=status, admin=admin, admins=admins,
+                   reset_strategy=reset_strategy)
+    query = _filter_users(get_user_queryset(db), **filters)
+
     if return_with_count:
-        count = query.count()
+        count = count_users(db, **filters)
 
-    if sort:
-        query = query.order_by(*(opt.value for opt in sort))
+    if sort or limit or cursor or search:
+        keys = _get_users_keys(sort, search)
+        if cursor:
+            query = query.filter(_filter_after_cursor(keys, _decode_users_cursor(cursor, keys, sort)))
+        query = query.order_by(*(expr.desc() if descending else expr.asc() for _, expr, descending in keys))
 
-    if offset:
+    if offset and not cursor:
         query = query.offset(offset)
     if limit:
         query = query.limit(limit)
@@ -294,44 +442,192 @@ def get_users(db: Session,
     return query.all()
 
 
-def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -> List[UserUsageResponse]:
+def _floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _floor_month(dt: datetime) -> datetime:
+    return _floor_day(dt).replace(day=1)
+
+
+def _next_month(dt: datetime) -> datetime:
+    return (_floor_month(dt) + timedelta(days=32)).replace(day=1)
+
+
+def _get_node_user_usage_tiers(
+        db: Session, start: datetime, end: datetime, granularity: Optional[UsageGranularity] = None
+) -> List[Tuple[type, datetime, datetime]]:
     """
-    Retrieves user usages within a specified date range.
+    Splits a time range into pieces read from the coarsest usage tier that covers them.
+
+    Whole months that are rolled up are read from the monthly tier, whole days that are
+    rolled up from the daily tier, and the rest from the hourly one. Days whose hourly
+    rows were already pruned are read from the daily tier as a whole. Tiers coarser than
+    the requested granularity are skipped, except for those pruned days.
+
+    Returns:
+        List[Tuple[type, datetime, datetime]]: (model, start, exclusive end) of every piece.
+    """
+    # the tables store naive UTC times
+    if start.tzinfo:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    if end.tzinfo:
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+
+    end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    if start >= end:
+        return []
+
+    last_month = db.query(func.max(NodeUserUsageMonthly.created_at)).scalar()
+    last_day = db.query(func.max(NodeUserUsageDaily.created_at)).scalar()
+    first_hour = db.query(func.min(NodeUserUsage.created_at)).scalar()
+
+    tiers = []
+    pieces = [(start, end)]
+
+    if last_month and granularity in (None, UsageGranularity.month):
+        month_start = start if start == _floor_month(start) else _next_month(start)
+        month_end = min(_floor_month(end), _next_month(last_month))
+        if month_start < month_end:
+            tiers.append((NodeUserUsageMonthly, month_start, month_end))
+            pieces = [(start, month_start), (month_end, end)]
+
+    for piece_start, piece_end in pieces:
+        if piece_start >= piece_end:
+            continue
+
+        if last_day:
+            if piece_start == _floor_day(piece_start) or (first_hour and piece_start < first_hour):
+                day_start = _floor_day(piece_start)
+            else:
+                day_start = _floor_day(piece_start) + timedelta(days=1)
+            if piece_end == _floor_day(piece_end) or not first_hour or _floor_day(piece_end) >= _floor_day(first_hour):
+                day_end = _floor_day(piece_end)
+            else:
+                day_end = _floor_day(piece_end) + timedelta(days=1)
+            day_end = min(day_end, _floor_day(last_day) + timedelta(days=1))
+            if granularity == UsageGranularity.hour:
+                day_end = min(day_end, _floor_day(first_hour) if first_hour else day_end)
+            if day_start < day_end:
+                tiers.append((NodeUserUsageDaily, day_start, day_end))
+                tiers.append((NodeUserUsage, piece_start, min(day_start, piece_end)))
+                tiers.append((NodeUserUsage, day_end, piece_end))
+                continue
+
+        tiers.append((NodeUserUsage, piece_start, piece_end))
+
+    return [(model, a, b) for model, a, b in tiers if a < b]
+
+
+def _usage_bucket(db: Session, column, granularity: UsageGranularity):
+    """SQL expression truncating a timestamp column to the start of its hour, day or month."""
+    if db.bind.name == 'postgresql':
+        return func.date_trunc(granularity.value, column)
+
+    fmt = {
+        UsageGranularity.hour: '%Y-%m-%d %H:00:00',
+        UsageGranularity.day: '%Y-%m-%d 00:00:00',
+        UsageGranularity.month: '%Y-%m-01 00:00:00',
+    }[granularity]
+    if db.bind.name == 'mysql':
+        return func.date_format(column, fmt)
+    return func.strftime(fmt, column)
+
+
+def _get_node_user_usages(
+        db: Session,
+        start: datetime,
+        end: datetime,
+        user_id: Optional[int] = None,
+        admins: Optional[List[str]] = None,
+        granularity: Optional[UsageGranularity] = None
+) -> Dict[Optional[int], Dict[Optional[datetime], int]]:
+    """
+    Sums the per-node user usages in SQL, grouped by node and optionally by time bucket.
 
     Args:
         db (Session): Database session.
-        dbuser (User): The user object.
-        start (datetime): Start date for usage retrieval.
-        end (datetime): End date for usage retrieval.
+        start (datetime): Start of the range.
+        end (datetime): End of the range.
+        user_id (Optional[int]): Only count this user.
+        admins (Optional[List[str]]): Only count users of these admins.
+        granularity (Optional[UsageGranularity]): Bucket size, usages are only grouped by node if None.
 
     Returns:
-        List[UserUsageResponse]: List of user usage responses.
-    """
-
-    usages = {0: UserUsageResponse(  # Main Core
+        Dict[Optional[int], Dict[Optional[datetime], int]]: used traffic by node id and bucket start,
+        the bucket is None when no granularity is given.
+    """
+    usages = {}
+    for model, tier_start, tier_end in _get_node_user_usage_tiers(db, start, end, granularity):
+        columns = [model.node_id]
+        if granularity:
+            columns.append(_usage_bucket(db, model.created_at, granularity))
+
+        query = db.query(*columns, func.sum(model.used_traffic)) \
+            .filter(model.created_at >= tier_start, model.created_at < tier_end)
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        if admins:
+            query = query.join(User, User.id == model.user_id) \
+                .join(Admin, Admin.id == User.admin_id) \
+                .filter(Admin.username.in_(admins))
+
+        for row in query.group_by(*columns):
+            node_id, used_traffic = row[0], int(row[-1] or 0)
+            bucket = None
+            if granularity:
+                bucket = row[1] if isinstance(row[1], datetime) else datetime.fromisoformat(row[1])
+            node_usages = usages.setdefault(node_id, {})
+            node_usages[bucket] = node_usages.get(bucket, 0) + used_traffic
+    return usages
+
+
+def _node_user_usages_response(
+        db: Session, usages: Dict[Optional[int], Dict[Optional[datetime], int]], granularity: Optional[UsageGranularity]
+) -> List[UserUsageResponse]:
+    responses = {0: UserUsageResponse(  # Main Core
         node_id=None,
         node_name="Master",
         used_traffic=0
     )}
 
     for node in db.query(Node).all():
-        usages[node.id] = UserUsageResponse(
+        responses[node.id] = UserUsageResponse(
             node_id=node.id,
             node_name=node.name,
             used_traffic=0
         )
 
-    cond = and_(NodeUserUsage.user_id == dbuser.id,
-                NodeUserUsage.created_at >= start,
-                NodeUserUsage.created_at <= end)
+    for response in responses.values():
+        node_usages = usages.get(response.node_id, {})
+        response.used_traffic = sum(node_usages.values())
+        if granularity:
+            response.buckets = [
+                UserUsageBucket(created_at=bucket, used_traffic=used_traffic)
+                for bucket, used_traffic in sorted(node_usages.items())
+            ]
 
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
+    return list(responses.values())
 
-    return list(usages.values())
+
+def get_user_usages(
+        db: Session, dbuser: User, start: datetime, end: datetime, granularity: Optional[UsageGranularity] = None
+) -> List[UserUsageResponse]:
+    """
+    Retrieves user usages within a specified date range.
+
+    Args:
+        db (Session): Database session.
+        dbuser (User): The user object.
+        start (datetime): Start date for usage retrieval.
+        end (datetime): End date for usage retrieval.
+        granularity (Optional[UsageGranularity]): Also break the usages down into buckets of this size.
+
+    Returns:
+        List[UserUsageResponse]: List of user usage responses.
+    """
+    usages = _get_node_user_usages(db, start, end, user_id=dbuser.id, granularity=granularity)
+    return _node_user_usages_response(db, usages, granularity)
 
 
 def get_users_count(db: Session, status: UserStatus = None, admin: Admin = None) -> int:
@@ -346,12 +642,7 @@ def get_users_count(db: Session, status: UserStatus = None, admin: Admin = None)
     Returns:
         int: Count of users matching the criteria.
     """
-    query = db.query(User.id)
-    if admin:
-        query = query.filter(User.admin == admin)
-    if status:
-        query = query.filter(User.status == status)
-    return query.count()
+    return users_counters.count(db, status, admin.username if admin else None)
 
 
 def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
@@ -400,6 +691,7 @@ def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
     db.add(dbuser)
     db.commit()
     db.refresh(dbuser)
+    clear_users_count_cache()
     return dbuser
 
 
@@ -416,6 +708,7 @@ def remove_user(db: Session, dbuser: User) -> User:
     """
     db.delete(dbuser)
     db.commit()
+    clear_users_count_cache()
     return dbuser
 
 
@@ -430,6 +723,7 @@ def remove_users(db: Session, dbusers: List[User]):
     for dbuser in dbusers:
         db.delete(dbuser)
     db.commit()
+    clear_users_count_cache()
     return
 
 
@@ -532,6 +826,20 @@ def update_user(db: Session, dbuser: User, modify: UserModify) -> User:
     return dbuser
 
 
+def _clear_node_user_usage_tiers(db: Session, user_ids=None) -> None:
+    """
+    Deletes the daily and monthly per-node usages of the given users, or of every user if None.
+
+    Called wherever the hourly ones are cleared, so the tiers don't keep reporting usage from
+    before a reset and the next rollup doesn't rebuild them from emptied hours.
+    """
+    for tier in (NodeUserUsageDaily, NodeUserUsageMonthly):
+        query = db.query(tier)
+        if user_ids is not None:
+            query = query.filter(tier.user_id.in_(user_ids))
+        query.delete(synchronize_session=False)
+
+
 def reset_user_data_usage(db: Session, dbuser: User) -> User:
     """
     Resets the data usage of a user and logs the reset.
@@ -551,6 +859,7 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
 
     dbuser.used_traffic = 0
     dbuser.node_usages.clear()
+    _clear_node_user_usage_tiers(db, [dbuser.id])
     if dbuser.status not in (UserStatus.expired or UserStatus.disabled):
         dbuser.status = UserStatus.active.value
 
@@ -586,6 +895,7 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
     db.add(usage_log)
 
     dbuser.node_usages.clear()
+    _clear_node_user_usage_tiers(db, [dbuser.id])
     dbuser.status = UserStatus.active.value
 
     dbuser.data_limit = dbuser.next_plan.data_limit + \
@@ -630,6 +940,9 @@ def update_user_sub(db: Session, dbuser: User, user_agent: str) -> User:
     """
     Updates the user's subscription details.
 
+    They're buffered and written along with other users' by flush_sub_updates(), the user
+    object only reflects them without being modified in the session.
+
     Args:
         db (Session): Database session.
         dbuser (User): The user object whose subscription is to be updated.
@@ -638,30 +951,36 @@ def update_user_sub(db: Session, dbuser: User, user_agent: str) -> User:
     Returns:
         User: The updated user object.
     """
-    dbuser.sub_updated_at = datetime.utcnow()
-    dbuser.sub_last_user_agent = user_agent
+    now = datetime.utcnow()
+    set_committed_value(dbuser, 'sub_updated_at', now)
+    set_committed_value(dbuser, 'sub_last_user_agent', user_agent)
 
-    db.commit()
-    db.refresh(dbuser)
+    sub_updates.add(dbuser.id, now, user_agent)
     return dbuser
 
 
-def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None):
+def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Resets the data usage for all users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the users whose status changed to active.
     """
     query = get_user_queryset(db)
 
     if admin:
         query = query.filter(User.admin == admin)
 
+    activated_ids = []
     for dbuser in query.all():
         dbuser.used_traffic = 0
         if dbuser.status not in [UserStatus.on_hold, UserStatus.expired, UserStatus.disabled]:
+            if dbuser.status != UserStatus.active:
+                activated_ids.append(dbuser.id)
             dbuser.status = UserStatus.active
         dbuser.usage_logs.clear()
         dbuser.node_usages.clear()
@@ -670,33 +989,47 @@ def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None):
             dbuser.next_plan = None
         db.add(dbuser)
 
+    _clear_node_user_usage_tiers(
+        db, select(User.id).where(User.admin_id == admin.id) if admin else None
+    )
     db.commit()
+    return activated_ids
 
 
-def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
+def disable_all_active_users(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Disable all active users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the disabled users.
     """
     query = db.query(User).filter(User.status.in_((UserStatus.active, UserStatus.on_hold)))
     if admin:
         query = query.filter(User.admin == admin)
 
+    user_ids = [user_id for (user_id,) in query.with_entities(User.id)]
     query.update({User.status: UserStatus.disabled, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    users_counters.invalidate()
+    user_quotas.invalidate()
+    return user_ids
 
 
-def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
+def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None) -> List[int]:
     """
     Activate all disabled users or users under a specific admin.
 
     Args:
         db (Session): Database session.
         admin (Optional[Admin]): Admin to filter users by, if any.
+
+    Returns:
+        List[int]: IDs of the activated (or put on hold) users.
     """
     query_for_active_users = db.query(User).filter(User.status == UserStatus.disabled)
     query_for_on_hold_users = db.query(User).filter(
@@ -708,12 +1041,16 @@ def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
         query_for_active_users = query_for_active_users.filter(User.admin == admin)
         query_for_on_hold_users = query_for_on_hold_users.filter(User.admin == admin)
 
+    user_ids = [user_id for (user_id,) in query_for_active_users.with_entities(User.id)]
     query_for_on_hold_users.update(
         {User.status: UserStatus.on_hold, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
     query_for_active_users.update(
         {User.status: UserStatus.active, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    users_counters.invalidate()
+    user_quotas.invalidate()
+    return user_ids
 
 
 def autodelete_expired_users(db: Session,
@@ -757,7 +1094,7 @@ def autodelete_expired_users(db: Session,
 
 
 def get_all_users_usages(
-        db: Session, admin: Admin, start: datetime, end: datetime
+        db: Session, admin: Admin, start: datetime, end: datetime, granularity: Optional[UsageGranularity] = None
 ) -> List[UserUsageResponse]:
     """
     Retrieves usage data for all users associated with an admin within a specified time range.
@@ -770,39 +1107,92 @@ def get_all_users_usages(
         admin (Admin): The admin user for which to retrieve user usage data.
         start (datetime): The start date and time of the period to consider.
         end (datetime): The end date and time of the period to consider.
+        granularity (Optional[UsageGranularity]): Also break the usages down into buckets of this size.
 
     Returns:
         List[UserUsageResponse]: A list of UserUsageResponse objects, each representing
         the usage data for a specific node or the main core.
     """
-    usages = {0: UserUsageResponse(  # Main Core
-        node_id=None,
-        node_name="Master",
-        used_traffic=0
-    )}
-
-    for node in db.query(Node).all():
-        usages[node.id] = UserUsageResponse(
-            node_id=node.id,
-            node_name=node.name,
-            used_traffic=0
+    usages = _get_node_user_usages(db, start, end, admins=admin, granularity=granularity)
+    return _node_user_usages_response(db, usages, granularity)
+
+
+def _rollup_node_user_usages(db: Session, source: type, target: type, start: datetime, end: datetime) -> None:
+    """Replaces the target tier's row of every user and node in [start, end) with the sum of the source tier."""
+    db.execute(delete(target).where(target.created_at == start))
+    db.execute(
+        insert(target).from_select(
+            ['created_at', 'user_id', 'node_id', 'used_traffic'],
+            select(
+                literal(start, DateTime),
+                source.user_id,
+                source.node_id,
+                func.sum(source.used_traffic)
+            ).where(
+                source.created_at >= start,
+                source.created_at < end
+            ).group_by(source.user_id, source.node_id)
         )
+    )
+    db.commit()
 
-    admin_users = set(user.id for user in get_users(db=db, admins=admin))
 
-    cond = and_(
-        NodeUserUsage.created_at >= start,
-        NodeUserUsage.created_at <= end,
-        NodeUserUsage.user_id.in_(admin_users)
-    )
+def rollup_node_user_usages(db: Session) -> None:
+    """
+    Rolls the hourly per-node user usages up into the daily and monthly tiers.
 
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
+    Only finished days and months are rolled up. The last two rolled up days (and their
+    months) are recomputed on every run, so usages written late for them are picked up too.
 
-    return list(usages.values())
+    Args:
+        db (Session): Database session.
+    """
+    today = _floor_day(datetime.utcnow())
+
+    last_day = db.query(func.max(NodeUserUsageDaily.created_at)).scalar()
+    if last_day:
+        day = _floor_day(last_day) - timedelta(days=1)
+    else:
+        first_hour = db.query(func.min(NodeUserUsage.created_at)).scalar()
+        day = _floor_day(first_hour) if first_hour else today
+
+    first_day = day
+    while day < today:
+        _rollup_node_user_usages(db, NodeUserUsage, NodeUserUsageDaily, day, day + timedelta(days=1))
+        day += timedelta(days=1)
+
+    last_month = db.query(func.max(NodeUserUsageMonthly.created_at)).scalar()
+    if last_month:
+        month = min(_floor_month(last_month), _floor_month(first_day))
+    else:
+        first_daily = db.query(func.min(NodeUserUsageDaily.created_at)).scalar()
+        month = _floor_month(first_daily) if first_daily else _floor_month(today)
+
+    while month < _floor_month(today):
+        _rollup_node_user_usages(db, NodeUserUsageDaily, NodeUserUsageMonthly, month, _next_month(month))
+        month = _next_month(month)
+
+
+def prune_node_user_usages(db: Session, before: datetime) -> int:
+    """
+    Deletes hourly per-node user usages older than the given time that are already rolled up.
+
+    Args:
+        db (Session): Database session.
+        before (datetime): Rows created before this are deleted.
+
+    Returns:
+        int: Number of deleted rows.
+    """
+    last_day = db.query(func.max(NodeUserUsageDaily.created_at)).scalar()
+    if not last_day:
+        return 0
+
+    # the last two rolled up days are recomputed by the next rollup, keep their source rows
+    before = min(_floor_day(before), _floor_day(last_day) - timedelta(days=1))
+    count = db.query(NodeUserUsage).filter(NodeUserUsage.created_at < before).delete(synchronize_session=False)
+    db.commit()
+    return count
 
 
 def update_user_status(db: Session, dbuser: User, status: UserStatus) -> User:
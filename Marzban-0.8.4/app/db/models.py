@@ -67,6 +67,8 @@ class User(Base):
     status = Column(Enum(UserStatus), nullable=False, default=UserStatus.active)
     used_traffic = Column(BigInteger, default=0)
     node_usages = relationship("NodeUserUsage", back_populates="user", cascade="all, delete-orphan")
+    node_usages_daily = relationship("NodeUserUsageDaily", back_populates="user", cascade="all, delete-orphan")
+    node_usages_monthly = relationship("NodeUserUsageMonthly", back_populates="user", cascade="all, delete-orphan")
     notification_reminders = relationship("NotificationReminder", back_populates="user", cascade="all, delete-orphan")
     data_limit = Column(BigInteger, nullable=True)
     data_limit_reset_strategy = Column(
@@ -173,6 +175,14 @@ class NextPlan(Base):
     user = relationship("User", back_populates="next_plan")
 
 
+class UserSearchGram(Base):
+    """Hashed trigram of a user's username or note, maintained by app.db.search."""
+    __tablename__ = "user_search_grams"
+
+    gram = Column(BigInteger, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+
 class UserTemplate(Base):
     __tablename__ = "user_templates"
 
@@ -274,6 +284,14 @@ class System(Base):
     downlink = Column(BigInteger, default=0)
 
 
+class UserUsagesBatch(Base):
+    """Last batch of the user usages spool written to the database, so it isn't written twice."""
+    __tablename__ = "user_usages_batches"
+
+    id = Column(String(64), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 class JWT(Base):
     __tablename__ = "jwt"
 
@@ -307,6 +325,8 @@ class Node(Base):
     uplink = Column(BigInteger, default=0)
     downlink = Column(BigInteger, default=0)
     user_usages = relationship("NodeUserUsage", back_populates="node", cascade="all, delete-orphan")
+    user_usages_daily = relationship("NodeUserUsageDaily", back_populates="node", cascade="all, delete-orphan")
+    user_usages_monthly = relationship("NodeUserUsageMonthly", back_populates="node", cascade="all, delete-orphan")
     usages = relationship("NodeUsage", back_populates="node", cascade="all, delete-orphan")
     usage_coefficient = Column(Float, nullable=False, server_default=text("1.0"), default=1)
 
@@ -326,6 +346,36 @@ class NodeUserUsage(Base):
     used_traffic = Column(BigInteger, default=0)
 
 
+class NodeUserUsageDaily(Base):
+    __tablename__ = "node_user_usages_daily"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one day per record
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="node_usages_daily")
+    node_id = Column(Integer, ForeignKey("nodes.id"))
+    node = relationship("Node", back_populates="user_usages_daily")
+    used_traffic = Column(BigInteger, default=0)
+
+
+class NodeUserUsageMonthly(Base):
+    __tablename__ = "node_user_usages_monthly"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one month per record
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="node_usages_monthly")
+    node_id = Column(Integer, ForeignKey("nodes.id"))
+    node = relationship("Node", back_populates="user_usages_monthly")
+    used_traffic = Column(BigInteger, default=0)
+
+
 class NodeUsage(Base):
     __tablename__ = "node_usages"
     __table_args__ = (
@@ -0,0 +1,150 @@
+"""
+In-memory remaining data of the users, the usage pipeline enforces data limits with it.
+
+They're per process: in the multi-worker mode only the controller's are used, since it
+runs the usage pipeline, and it updates them for the users the API workers change
+(see app.xray.controller).
+"""
+
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.db.base import SessionLocal
+from app.db.models import User
+from app.models.user import UserStatus
+
+
+class UserQuotas:
+    """
+    Remaining bytes of the active users with a data limit, by user id.
+
+    They're loaded with one query, then users created, removed or whose status, data limit
+    or used traffic change through the ORM are updated when their session commits. Usage
+    merged by the usage pipeline doesn't go through the ORM, it's consumed as soon as it's
+    collected instead, and the users whose quota runs out are queued for review.
+
+    Since the queued users are checked against the database before being limited, the
+    quotas only decide who is looked at; the review job reloads them periodically anyway.
+    """
+
+    def __init__(self):
+        self.remaining: Dict[int, int] = {}
+        self.exceeded: Set[int] = set()
+        self.stale = True
+        self._lock = Lock()
+
+    def refresh(self, db: Session):
+        remaining = {
+            user_id: data_limit - (used_traffic or 0)
+            for user_id, data_limit, used_traffic in db.query(User.id, User.data_limit, User.used_traffic)
+            .filter(User.status == UserStatus.active, User.data_limit > 0)
+        }
+
+        with self._lock:
+            self.remaining = remaining
+            self.stale = False
+
+    def invalidate(self):
+        self.stale = True
+
+    def ensure(self, db: Session):
+        if self.stale:
+            self.refresh(db)
+
+    def set(self, user_id: int, remaining: Optional[int]):
+        """Sets the remaining bytes of a user, None if they aren't limited (or active)."""
+        with self._lock:
+            if remaining is None:
+                self.remaining.pop(user_id, None)
+            else:
+                self.remaining[user_id] = remaining
+
+    def set_user(self, dbuser: User):
+        self.set(dbuser.id, _remaining(dbuser.status, dbuser.data_limit, dbuser.used_traffic))
+
+    def consume(self, usages: Dict[int, int]) -> List[int]:
+        """
+        Subtracts usages from the users' quotas and returns the users whose quota ran out.
+
+        They're dropped from the quotas, so they're returned once, until their quota is set again.
+        """
+        exceeded = []
+        with self._lock:
+            for user_id, value in usages.items():
+                remaining = self.remaining.get(user_id)
+                if remaining is None:
+                    continue
+                remaining -= value
+                if remaining > 0:
+                    self.remaining[user_id] = remaining
+                else:
+                    del self.remaining[user_id]
+                    exceeded.append(user_id)
+        return exceeded
+
+    def queue(self, user_ids: Iterable[int]):
+        """Queues users for review, once the usage they exceeded their quota with is in the database."""
+        with self._lock:
+            self.exceeded.update(user_ids)
+
+    def take_exceeded(self) -> List[int]:
+        with self._lock:
+            exceeded, self.exceeded = self.exceeded, set()
+        return sorted(exceeded)
+
+
+user_quotas = UserQuotas()
+
+
+def _remaining(status: UserStatus, data_limit: Optional[int], used_traffic: Optional[int]) -> Optional[int]:
+    if status != UserStatus.active or not data_limit:
+        return None
+    return data_limit - (used_traffic or 0)
+
+
+QUOTA_ATTRS = ('status', 'data_limit', 'used_traffic')
+
+
+def _collect_quota(changes: Dict[int, Optional[int]], obj: User):
+    attrs = inspect(obj).dict
+    if any(attr not in attrs for attr in QUOTA_ATTRS):
+        # the other values weren't loaded
+        user_quotas.invalidate()
+        return
+    changes[obj.id] = _remaining(attrs['status'], attrs['data_limit'], attrs['used_traffic'])
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_quota_changes(session: Session, flush_context):
+    changes = session.info.setdefault("user_quotas", {})
+
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes[obj.id] = None
+
+    for obj in session.new:
+        if isinstance(obj, User):
+            _collect_quota(changes, obj)
+
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[attr].history.has_changes() for attr in QUOTA_ATTRS):
+            _collect_quota(changes, obj)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_quota_changes(session: Session):
+    changes = session.info.pop("user_quotas", None)
+    if changes:
+        for user_id, remaining in changes.items():
+            user_quotas.set(user_id, remaining)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_quota_changes(session: Session):
+    session.info.pop("user_quotas", None)
@@ -0,0 +1,110 @@
+"""
+Trigram index of users' usernames and notes, so searching them doesn't scan the users table.
+
+Every user has a row per distinct (hashed, lowercased) trigram of its username and note,
+written in the same transaction the user is. Searching looks up the users having every
+trigram of the term, then filters those few with the substring match itself, which also
+drops users whose trigrams only match because of hash collisions or across both fields.
+Terms shorter than a trigram are matched by scanning, as they match most users anyway.
+"""
+
+import zlib
+from typing import Set
+
+from sqlalchemy import and_, case, delete, event, func, insert, inspect, or_, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ColumnElement
+
+from app.db.base import SessionLocal
+from app.db.models import User, UserSearchGram
+
+def _grams(text: str) -> Set[int]:
+    text = text.lower()
+    return {zlib.crc32(text[i:i + 3].encode()) for i in range(len(text) - 2)}
+
+
+def user_search_grams(username: str, note: str = None) -> Set[int]:
+    """Hashed trigrams a user is indexed by."""
+    grams = set()
+    for value in (username, note):
+        if value:
+            grams |= _grams(value)
+    return grams
+
+
+def search_users_filter(term: str) -> ColumnElement:
+    """Users whose username or note contains `term`, case insensitively."""
+    matches = or_(User.username.icontains(term, autoescape=True),
+                  User.note.icontains(term, autoescape=True))
+    if len(term) < 3:
+        return matches
+
+    grams = _grams(term)
+    candidates = select(UserSearchGram.user_id). \
+        where(UserSearchGram.gram.in_(grams)). \
+        group_by(UserSearchGram.user_id). \
+        having(func.count(UserSearchGram.gram) == len(grams))
+    return and_(User.id.in_(candidates), matches)
+
+
+def search_rank(term: str) -> ColumnElement:
+    """Ranks matches of `term`, exact usernames first, then usernames starting with it, containing it, and notes."""
+    return case(
+        (func.lower(User.username) == term.lower(), 0),
+        (User.username.istartswith(term, autoescape=True), 1),
+        (User.username.icontains(term, autoescape=True), 2),
+        else_=3
+    )
+
+
+def user_search_rank(user: User, term: str) -> int:
+    """search_rank() of a loaded user."""
+    username, term = user.username.lower(), term.lower()
+    if username == term:
+        return 0
+    if username.startswith(term):
+        return 1
+    if term in username:
+        return 2
+    return 3
+
+
+def rebuild_user_search_grams(db: Session):
+    """Reindexes every user, for users changed without the ORM."""
+    conn = db.connection()
+    conn.execute(delete(UserSearchGram))
+    rows = [
+        {"user_id": user_id, "gram": gram}
+        for user_id, username, note in conn.execute(select(User.id, User.username, User.note))
+        for gram in user_search_grams(username, note)
+    ]
+    if rows:
+        conn.execute(insert(UserSearchGram), rows)
+    db.commit()
+
+
+def _search_fields_changed(user: User) -> bool:
+    attrs = inspect(user).attrs
+    return attrs.username.history.has_changes() or attrs.note.history.has_changes()
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _index_users(session: Session, flush_context):
+    created = [obj for obj in session.new if isinstance(obj, User)]
+    modified = [obj for obj in session.dirty if isinstance(obj, User) and _search_fields_changed(obj)]
+    removed = [obj.id for obj in session.deleted if isinstance(obj, User)]
+    if not (created or modified or removed):
+        return
+
+    conn = session.connection()
+    stale = removed + [user.id for user in modified]
+    if stale:
+        conn.execute(delete(UserSearchGram).where(UserSearchGram.user_id.in_(stale)))
+
+    rows = [
+        {"user_id": user.id, "gram": gram}
+        for user in created + modified
+        for gram in user_search_grams(user.username, user.note)
+    ]
+    if rows:
+        conn.execute(insert(UserSearchGram), rows)
@@ -0,0 +1,109 @@
+"""
+Write-behind buffer of users' subscription fetches (sub_updated_at and sub_last_user_agent).
+
+Fetching a subscription doesn't write to the database, the latest fetch of every user
+is kept here and written for all users at once by the flush sub updates job. Serving
+subscriptions never waits for the database: a full buffer only asks the job to run now,
+and while the writes keep failing the oldest fetches are dropped past twice its size.
+"""
+
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, update
+
+from app.db.base import SessionLocal
+from app.db.models import User
+from config import SUB_UPDATES_BUFFER_SIZE
+
+# user id -> (sub_updated_at, sub_last_user_agent)
+PendingSubUpdates = Dict[int, Tuple[datetime, str]]
+
+
+class SubUpdatesBuffer:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # called (once until the next take) when the buffer fills up
+        self.on_full: Optional[Callable[[], None]] = None
+        # fetches dropped past twice max_size, while the flushes fail or lag behind
+        self.dropped = 0
+        self._pending: PendingSubUpdates = {}
+        self._flush_requested = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _trim(self):
+        # the fetches are kept from the oldest to the latest
+        while len(self._pending) > 2 * self.max_size:
+            del self._pending[next(iter(self._pending))]
+            self.dropped += 1
+
+    def add(self, user_id: int, updated_at: datetime, user_agent: str) -> bool:
+        """Records a fetch, replacing the user's previous one. Returns whether the buffer is full."""
+        with self._lock:
+            self._pending.pop(user_id, None)
+            self._pending[user_id] = (updated_at, user_agent)
+            self._trim()
+            full = len(self._pending) >= self.max_size
+            notify = full and not self._flush_requested
+            if notify:
+                self._flush_requested = True
+
+        if notify and self.on_full:
+            self.on_full()
+        return full
+
+    def take(self) -> PendingSubUpdates:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flush_requested = False
+            return pending
+
+    def restore(self, pending: PendingSubUpdates):
+        """Puts back fetches that couldn't be written, unless the users fetched again since."""
+        with self._lock:
+            restored = {user_id: value for user_id, value in pending.items() if user_id not in self._pending}
+            self._pending = {**restored, **self._pending}
+            self._trim()
+
+
+sub_updates = SubUpdatesBuffer(SUB_UPDATES_BUFFER_SIZE)
+
+
+def _write_sub_updates(pending: PendingSubUpdates):
+    stmt = update(User). \
+        where(User.id == bindparam('uid')). \
+        values(sub_updated_at=bindparam('updated_at'), sub_last_user_agent=bindparam('user_agent'))
+    # ordered by id, so concurrent updates lock the users' rows in the same order
+    # user agents are truncated, a single one too long would fail every update
+    max_length = User.sub_last_user_agent.type.length
+    params = [
+        {"uid": user_id, "updated_at": updated_at, "user_agent": user_agent[:max_length]}
+        for user_id, (updated_at, user_agent) in sorted(pending.items())
+    ]
+
+    db = SessionLocal()
+    try:
+        db.connection().execute(stmt, params)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def flush_sub_updates():
+    """Writes the buffered fetches in a single UPDATE, they're kept for the next flush if it fails."""
+    pending = sub_updates.take()
+    if not pending:
+        return
+
+    try:
+        _write_sub_updates(pending)
+    except Exception:
+        sub_updates.restore(pending)
+        raise
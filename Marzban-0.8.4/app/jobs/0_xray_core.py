@@ -1,11 +1,22 @@
-import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
 from app import app, logger, scheduler, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
 from config import JOB_CORE_HEALTH_CHECK_INTERVAL
-from xray_api import exc as xray_exc
+
+if TYPE_CHECKING:
+    from app.xray.node import XRayNode
+
+
+def check_node(node: "XRayNode") -> bool:
+    try:
+        node.heartbeat(timeout=2)
+        return True
+    except Exception:
+        return False
 
 
 def core_health_check():
@@ -16,36 +27,38 @@ def core_health_check():
         if not config:
             config = xray.config.include_db_users()
         xray.core.restart(config)
+        xray.queues.reset_ledger(None, config)
 
-    # nodes' core
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            try:
-                assert node.started
-                node.api.get_sys_stats(timeout=2)
-            except (ConnectionError, xray_exc.XrayError, AssertionError):
-                if not config:
-                    config = xray.config.include_db_users()
-                xray.operations.restart_node(node_id, config)
-
-        if not node.connected:
+    # nodes' core, only the ones whose heartbeat (or backoff while they're down) is due
+    nodes = [(node_id, node) for node_id, node in list(xray.nodes.items()) if node.health.due()]
+    if not nodes:
+        return
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(check_node, [node for _, node in nodes]))
+
+    for (node_id, node), alive in zip(nodes, results):
+        if alive:
+            node.health.success()
+            continue
+
+        # a single missed heartbeat only degrades the node, it's recovered once it's down
+        if node.health.failure():
             if not config:
                 config = xray.config.include_db_users()
-            xray.operations.connect_node(node_id, config)
+            xray.operations.restart_node(node_id, config)
 
 
 @app.on_event("startup")
 def start_core():
     logger.info("Generating Xray core config")
-
-    start_time = time.time()
     config = xray.config.include_db_users()
-    logger.info(f"Xray core config generated in {(time.time() - start_time):.2f} seconds")
 
     # main core
     logger.info("Starting main Xray core")
     try:
         xray.core.start(config)
+        xray.queues.reset_ledger(None, config)
     except Exception:
         traceback.print_exc()
 
@@ -2,12 +2,19 @@ import glob
 import importlib.util
 from os.path import basename, dirname, join
 
+from config import API_WORKER
+
+# the only jobs run by the API workers of the multi-worker mode, the controller runs them all
+WORKER_JOBS = ("flush_sub_updates", "refresh_users_counters")
+
 modules = glob.glob(join(dirname(__file__), "*.py"))
 
 for file in modules:
     name = basename(file).replace('.py', '')
     if name.startswith('_'):
         continue
+    if API_WORKER and name not in WORKER_JOBS:
+        continue
 
     spec = importlib.util.spec_from_file_location(name, file)
     spec.loader.exec_module(importlib.util.module_from_spec(spec))
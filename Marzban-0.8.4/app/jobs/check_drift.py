@@ -0,0 +1,12 @@
+from app import scheduler, xray
+from config import JOB_CHECK_DRIFT_INTERVAL
+
+
+def check_drift():
+    xray.reconcile.check_drift()
+
+
+if JOB_CHECK_DRIFT_INTERVAL > 0:
+    scheduler.add_job(check_drift, 'interval',
+                      seconds=JOB_CHECK_DRIFT_INTERVAL,
+                      coalesce=True, max_instances=1)
@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+from apscheduler.jobstores.base import JobLookupError
+
+from app import app, logger, scheduler
+from app.db.sub_updates import flush_sub_updates, sub_updates
+from config import JOB_FLUSH_SUB_UPDATES_INTERVAL
+
+JOB_ID = "flush_sub_updates"
+
+_dropped = 0
+
+
+def flush_sub_updates_job():
+    """Flushes the buffer, failures are only logged since the fetches are kept for the next run."""
+    global _dropped
+
+    try:
+        flush_sub_updates()
+    except Exception as err:
+        logger.error(f"Failed to write {len(sub_updates)} buffered subscription updates: {err}")
+
+    if sub_updates.dropped != _dropped:
+        logger.warning(f"{sub_updates.dropped - _dropped} subscription updates were dropped, "
+                       "the buffer was full while they couldn't be written")
+        _dropped = sub_updates.dropped
+
+
+def request_flush():
+    """Runs the job now instead of waiting for its interval, called when the buffer is full."""
+    try:
+        scheduler.modify_job(JOB_ID, next_run_time=datetime.now(timezone.utc))
+    except JobLookupError:
+        pass
+
+
+@app.on_event("shutdown")
+def app_shutdown():
+    logger.info("Flushing %d buffered subscription updates before shutdown...", len(sub_updates))
+    flush_sub_updates_job()
+
+
+sub_updates.on_full = request_flush
+scheduler.add_job(flush_sub_updates_job, 'interval', id=JOB_ID,
+                  seconds=JOB_FLUSH_SUB_UPDATES_INTERVAL,
+                  coalesce=True, max_instances=1)
@@ -1,36 +1,91 @@
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from operator import attrgetter
-from typing import Union
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Set, Union
 
 from pymysql.err import OperationalError
-from sqlalchemy import and_, bindparam, insert, select, update
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Table,
+    and_,
+    bindparam,
+    case,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.mysql import Insert as MySQLInsert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from sqlalchemy.sql.dml import Insert
 
-from app import scheduler, xray
+from app import app, logger, scheduler, xray
 from app.db import GetDB
-from app.db.models import Admin, NodeUsage, NodeUserUsage, System, User
+from app.db.counters import users_counters
+from app.db.models import Admin, NodeUsage, NodeUserUsage, System, User, UserUsagesBatch
+from app.db.quotas import user_quotas
+from app.utils.concurrency import run_coroutine
+from app.utils.spool import Spool, SpoolBatch
 from config import (
     DISABLE_RECORDING_NODE_USAGE,
+    JOB_FLUSH_USER_USAGES_INTERVAL,
     JOB_RECORD_NODE_USAGES_INTERVAL,
     JOB_RECORD_USER_USAGES_INTERVAL,
+    RECORD_USER_USAGES_CHUNK_SIZE,
+    USER_ONLINE_AT_GRANULARITY,
+    USER_USAGES_SPOOL_PATH,
 )
 from xray_api import XRay as XRayAPI
 from xray_api import exc as xray_exc
+from xray_api.aio import AsyncXRay as AsyncXRayAPI
+from xray_api.aio import fan_out, get_async_api
 
 
-def safe_execute(db: Session, stmt, params=None):
+usage_spool = Spool(USER_USAGES_SPOOL_PATH)
+flush_lock = Lock()
+
+# per-connection staging tables the usage deltas are merged from
+staging_metadata = MetaData()
+user_usage_deltas = Table(
+    "user_usage_deltas", staging_metadata,
+    Column("user_id", Integer, primary_key=True, autoincrement=False),
+    Column("value", BigInteger, nullable=False),
+    Column("online_at", DateTime, nullable=False),
+    prefixes=["TEMPORARY"]
+)
+admin_usage_deltas = Table(
+    "admin_usage_deltas", staging_metadata,
+    Column("admin_id", Integer, primary_key=True, autoincrement=False),
+    Column("value", BigInteger, nullable=False),
+    prefixes=["TEMPORARY"]
+)
+
+
+def execute(db: Session, stmt, params=None):
     if db.bind.name == 'mysql':
-        if isinstance(stmt, Insert):
+        if isinstance(stmt, Insert) and not isinstance(stmt, MySQLInsert):
             stmt = stmt.prefix_with('IGNORE')
 
+    db.connection().execute(stmt, params)
+
+
+def safe_execute(db: Session, stmt, params=None):
+    if db.bind.name == 'mysql':
         tries = 0
         done = False
         while not done:
             try:
-                db.connection().execute(stmt, params)
+                execute(db, stmt, params)
                 db.commit()
                 done = True
             except OperationalError as err:
@@ -41,29 +96,56 @@ def safe_execute(db: Session, stmt, params=None):
                 raise err
 
     else:
-        db.connection().execute(stmt, params)
+        execute(db, stmt, params)
         db.commit()
 
 
-def record_user_stats(params: list, node_id: Union[int, None],
-                      consumption_factor: int = 1):
+def safe_transaction(func: Callable[[Session], None]):
+    """Runs func and commits everything it executed at once, retrying the whole transaction on deadlocks."""
+    tries = 0
+    while True:
+        with GetDB() as db:
+            try:
+                func(db)
+                db.commit()
+                return
+            except OperationalError as err:
+                db.rollback()
+                if db.bind.name == 'mysql' and err.args[0] == 1213 and tries < 3:  # Deadlock
+                    tries += 1
+                    continue
+                raise err
+
+
+def upsert_user_stats(db: Session, rows: list):
+    """Adds usages to the hourly rows in a single statement, creating the rows that don't exist yet."""
+    if db.bind.name == 'mysql':
+        stmt = mysql_insert(NodeUserUsage).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            used_traffic=NodeUserUsage.used_traffic + stmt.inserted.used_traffic
+        )
+    else:
+        stmt = (pg_insert if db.bind.name == 'postgresql' else sqlite_insert)(NodeUserUsage).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['created_at', 'user_id', 'node_id'],
+            set_={'used_traffic': NodeUserUsage.used_traffic + stmt.excluded.used_traffic}
+        )
+
+    execute(db, stmt)
+
+
+def record_user_stats(db: Session, params: list, node_id: Union[int, None],
+                      created_at: datetime, consumption_factor: int = 1):
     if not params:
         return
 
-    created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
-
-    with GetDB() as db:
-        # make user usage row if doesn't exist
+    # NULLs never conflict on the unique constraint, so the main core's rows
+    # (node_id is NULL) can't be upserted and are created separately
+    if node_id is None:
         select_stmt = select(NodeUserUsage.user_id) \
-            .where(and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at))
-        existings = [r[0] for r in db.execute(select_stmt).fetchall()]
-        uids_to_insert = set()
-
-        for p in params:
-            uid = int(p['uid'])
-            if uid in existings:
-                continue
-            uids_to_insert.add(uid)
+            .where(and_(NodeUserUsage.node_id.is_(None), NodeUserUsage.created_at == created_at))
+        existings = {r[0] for r in db.execute(select_stmt).fetchall()}
+        uids_to_insert = {int(p['uid']) for p in params} - existings
 
         if uids_to_insert:
             stmt = insert(NodeUserUsage).values(
@@ -72,15 +154,30 @@ def record_user_stats(params: list, node_id: Union[int, None],
                 node_id=node_id,
                 used_traffic=0
             )
-            safe_execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
+            execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
 
-        # record
         stmt = update(NodeUserUsage) \
             .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value') * consumption_factor) \
             .where(and_(NodeUserUsage.user_id == bindparam('uid'),
-                        NodeUserUsage.node_id == node_id,
+                        NodeUserUsage.node_id.is_(None),
                         NodeUserUsage.created_at == created_at))
-        safe_execute(db, stmt, params)
+        execute(db, stmt, params)
+        return
+
+    # ordered by the unique key so concurrent upserts lock rows in the same order
+    rows = sorted(
+        (
+            {
+                'created_at': created_at,
+                'user_id': int(p['uid']),
+                'node_id': node_id,
+                'used_traffic': int(p['value'] * consumption_factor)
+            } for p in params
+        ),
+        key=lambda r: r['user_id']
+    )
+    for i in range(0, len(rows), RECORD_USER_USAGES_CHUNK_SIZE):
+        upsert_user_stats(db, rows[i:i + RECORD_USER_USAGES_CHUNK_SIZE])
 
 
 def record_node_stats(params: dict, node_id: Union[int, None]):
@@ -107,10 +204,10 @@ def record_node_stats(params: dict, node_id: Union[int, None]):
         safe_execute(db, stmt, params)
 
 
-def get_users_stats(api: XRayAPI):
+async def get_users_stats(api: AsyncXRayAPI):
     try:
         params = defaultdict(int)
-        for stat in filter(attrgetter('value'), api.get_users_stats(reset=True, timeout=30)):
+        for stat in filter(attrgetter('value'), await api.get_users_stats(reset=True, timeout=30)):
             params[stat.name.split('.', 1)[0]] += stat.value
         params = list({"uid": uid, "value": value} for uid, value in params.items())
         return params
@@ -118,80 +215,207 @@ def get_users_stats(api: XRayAPI):
         return []
 
 
-def get_outbounds_stats(api: XRayAPI):
+async def get_outbounds_stats(api: AsyncXRayAPI):
     try:
         params = [{"up": stat.value, "down": 0} if stat.link == "uplink" else {"up": 0, "down": stat.value}
-                  for stat in filter(attrgetter('value'), api.get_outbounds_stats(reset=True, timeout=10))]
+                  for stat in filter(attrgetter('value'), await api.get_outbounds_stats(reset=True, timeout=10))]
         return params
     except xray_exc.XrayError:
         return []
 
 
+async def fetch_stats(api_instances: Dict[Union[int, None], XRayAPI],
+                      func: Callable[[AsyncXRayAPI], Awaitable[list]]) -> Dict[Union[int, None], list]:
+    """Queries every core concurrently from the shared event loop."""
+    clients = {node_id: get_async_api(api) for node_id, api in api_instances.items()}
+    results = await fan_out(clients, func)
+    return {node_id: [] if isinstance(params, Exception) else params for node_id, params in results.items()}
+
+
 def record_user_usages():
+    """Collects the counters from the cores into the spool, they are written to the database by flush_user_usages."""
     api_instances = {None: xray.api}
     usage_coefficient = {None: 1}  # default usage coefficient for the main api instance
 
     for node_id, node in list(xray.nodes.items()):
-        if node.connected and node.started:
+        if node.health.available:
             api_instances[node_id] = node.api
             usage_coefficient[node_id] = node.usage_coefficient  # fetch the usage coefficient
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_users_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
+    api_params = run_coroutine(fetch_stats(api_instances, get_users_stats))
 
-    users_usage = defaultdict(int)
-    for node_id, params in api_params.items():
-        coefficient = usage_coefficient.get(node_id, 1)  # get the usage coefficient for the node
-        for param in params:
-            users_usage[param['uid']] += int(param['value'] * coefficient)  # apply the usage coefficient
-    users_usage = list({"uid": uid, "value": value} for uid, value in users_usage.items())
-    if not users_usage:
+    nodes = [
+        {"node_id": node_id, "coefficient": usage_coefficient.get(node_id, 1), "params": params}
+        for node_id, params in api_params.items() if params
+    ]
+    if not nodes:
         return
 
-    with GetDB() as db:
-        user_admin_map = dict(db.query(User.id, User.admin_id).all())
+    # the counters are already reset on the cores, so they must hit the disk before anything else
+    usage_spool.append({"created_at": datetime.utcnow().isoformat(), "nodes": nodes})
 
-    admin_usage = defaultdict(int)
-    for user_usage in users_usage:
-        admin_id = user_admin_map.get(int(user_usage["uid"]))
-        if admin_id:
-            admin_usage[admin_id] += user_usage["value"]
+    enforce_data_limits(nodes)
+
+
+def enforce_data_limits(nodes: list):
+    """
+    Consumes the collected usages from the users' quotas, users whose quota runs out are
+    queued for review right away instead of waiting for the review job to find them.
+    """
+    users_usage = defaultdict(int)
+    for node in nodes:
+        for param in node["params"]:
+            users_usage[int(param["uid"])] += int(param["value"] * node["coefficient"])
 
-    # record users usage
     with GetDB() as db:
-        stmt = update(User). \
-            where(User.id == bindparam('uid')). \
-            values(
-                used_traffic=User.used_traffic + bindparam('value'),
-                online_at=datetime.utcnow()
+        user_quotas.ensure(db)
+    exceeded = user_quotas.consume(users_usage)
+    if exceeded:
+        # they're reviewed against the database, which needs the usage they exceeded their quota with
+        flush_user_usages()
+        user_quotas.queue(exceeded)
+
+
+def coalesce_online_at(dt: datetime) -> datetime:
+    """Floors to USER_ONLINE_AT_GRANULARITY so a busy user's online_at changes at most once per period."""
+    if USER_ONLINE_AT_GRANULARITY <= 0:
+        return dt
+    seconds = (dt - datetime(1970, 1, 1)).total_seconds()
+    return datetime.utcfromtimestamp(seconds - seconds % USER_ONLINE_AT_GRANULARITY)
+
+
+def merge_users_usage(db: Session, users_usage: Dict[int, int], users_online_at: Dict[int, datetime]) -> Set[int]:
+    """
+    Adds the usages to users and their admins through staging tables.
+
+    The deltas are loaded with one insert and merged with one joined update per table,
+    admin totals are summed up in SQL. Both staging tables are keyed (and loaded) by
+    primary key, so concurrent merges lock the users' rows in the same order.
+
+    Returns:
+        Set[int]: ids of the users that still exist.
+    """
+    conn = db.connection()
+    for table in (user_usage_deltas, admin_usage_deltas):
+        table.create(conn, checkfirst=True)
+        conn.execute(delete(table))
+
+    conn.execute(insert(user_usage_deltas), [
+        {"user_id": uid, "value": value, "online_at": coalesce_online_at(users_online_at[uid])}
+        for uid, value in sorted(users_usage.items())
+    ])
+
+    # record users usage
+    conn.execute(
+        update(User).
+        where(User.id == user_usage_deltas.c.user_id).
+        values(
+            used_traffic=User.used_traffic + user_usage_deltas.c.value,
+            online_at=case(
+                (or_(User.online_at.is_(None), User.online_at < user_usage_deltas.c.online_at),
+                 user_usage_deltas.c.online_at),
+                else_=User.online_at
+            )
         )
+    )
+
+    # record admins usage
+    conn.execute(
+        insert(admin_usage_deltas).from_select(
+            ['admin_id', 'value'],
+            select(User.admin_id, func.sum(user_usage_deltas.c.value)).
+            join(user_usage_deltas, user_usage_deltas.c.user_id == User.id).
+            where(User.admin_id.isnot(None)).
+            group_by(User.admin_id)
+        )
+    )
+    conn.execute(
+        update(Admin).
+        where(Admin.id == admin_usage_deltas.c.admin_id).
+        values(users_usage=Admin.users_usage + admin_usage_deltas.c.value)
+    )
+
+    existing_uids = set(conn.execute(
+        select(user_usage_deltas.c.user_id).join(User, User.id == user_usage_deltas.c.user_id)
+    ).scalars())
+
+    for table in (user_usage_deltas, admin_usage_deltas):
+        conn.execute(delete(table))
+
+    return existing_uids
 
-        safe_execute(db, stmt, users_usage)
 
-        admin_data = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
-        if admin_data:
-            admin_update_stmt = update(Admin). \
-                where(Admin.id == bindparam('admin_id')). \
-                values(users_usage=Admin.users_usage + bindparam('value'))
-            safe_execute(db, admin_update_stmt, admin_data)
+def write_user_usages(db: Session, records: list):
+    users_usage = defaultdict(int)
+    users_online_at = {}
+    nodes_usage = defaultdict(lambda: defaultdict(int))
+
+    for record in records:
+        created_at = datetime.fromisoformat(record["created_at"])
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+
+        for node in record["nodes"]:
+            coefficient = node["coefficient"]  # the usage coefficient of the node at collection time
+            for param in node["params"]:
+                uid = int(param["uid"])
+                value = int(param["value"] * coefficient)  # apply the usage coefficient
+                users_usage[uid] += value
+                users_online_at[uid] = max(users_online_at.get(uid, created_at), created_at)
+                nodes_usage[(hour, node["node_id"])][uid] += value
+
+    if not users_usage:
+        return
+
+    existing_uids = merge_users_usage(db, users_usage, users_online_at)
 
     if DISABLE_RECORDING_NODE_USAGE:
         return
 
-    for node_id, params in api_params.items():
-        record_user_stats(params, node_id, usage_coefficient[node_id])
+    # usages of deleted users would break the foreign key of the per-node rows
+    for (hour, node_id), usages in nodes_usage.items():
+        params = [{"uid": uid, "value": value} for uid, value in usages.items() if uid in existing_uids]
+        record_user_stats(db, params, node_id, hour)
+
+
+def write_user_usages_batch(db: Session, batch: SpoolBatch):
+    """
+    Writes a batch taken from the spool, unless it's the last one written already.
+
+    The batch's id is stored in the same transaction as its usages, so a batch replayed
+    because the process stopped between the commit and the spool's cleanup is skipped
+    instead of being counted twice. Batches are written one at a time, in order, so only
+    the last one can come back.
+    """
+    conn = db.connection()
+    if conn.execute(select(UserUsagesBatch.id).where(UserUsagesBatch.id == batch.id)).first():
+        logger.warning(f"Usages batch {batch.id} of the spool is already written, skipping it")
+        return
+
+    conn.execute(delete(UserUsagesBatch))
+    conn.execute(insert(UserUsagesBatch).values(id=batch.id, created_at=datetime.utcnow()))
+    write_user_usages(db, batch.records)
+
+
+def flush_user_usages():
+    """
+    Drains the spool into the database.
+
+    Everything taken from the spool is written in a single transaction and the spool is
+    only cleared after it's committed, so a failed flush is simply retried on the next run.
+    """
+    with flush_lock:
+        while (batch := usage_spool.take()):
+            safe_transaction(lambda db: write_user_usages_batch(db, batch))
+            usage_spool.commit()
 
 
 def record_node_usages():
     api_instances = {None: xray.api}
     for node_id, node in list(xray.nodes.items()):
-        if node.connected and node.started:
+        if node.health.available:
             api_instances[node_id] = node.api
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {node_id: executor.submit(get_outbounds_stats, api) for node_id, api in api_instances.items()}
-    api_params = {node_id: future.result() for node_id, future in futures.items()}
+    api_params = run_coroutine(fetch_stats(api_instances, get_outbounds_stats))
 
     total_up = 0
     total_down = 0
@@ -209,6 +433,7 @@ def record_node_usages():
             downlink=System.downlink + total_down
         )
         safe_execute(db, stmt)
+    users_counters.add_bandwidth(total_up, total_down)
 
     if DISABLE_RECORDING_NODE_USAGE:
         return
@@ -217,9 +442,20 @@ def record_node_usages():
         record_node_stats(params, node_id)
 
 
+@app.on_event("shutdown")
+def app_shutdown():
+    logger.info("Flushing recorded user usages before shutdown...")
+    flush_user_usages()
+
+
 scheduler.add_job(record_user_usages, 'interval',
                   seconds=JOB_RECORD_USER_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
+# first run replays whatever a previous process left in the spool
+scheduler.add_job(flush_user_usages, 'interval',
+                  seconds=JOB_FLUSH_USER_USAGES_INTERVAL,
+                  next_run_time=datetime.utcnow(),
+                  coalesce=True, max_instances=1)
 scheduler.add_job(record_node_usages, 'interval',
                   seconds=JOB_RECORD_NODE_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
@@ -0,0 +1,14 @@
+from app import scheduler
+from app.db import GetDB
+from app.db.counters import users_counters
+from config import JOB_REFRESH_USERS_COUNTERS_INTERVAL
+
+
+def refresh_users_counters():
+    with GetDB() as db:
+        users_counters.refresh(db)
+
+
+scheduler.add_job(refresh_users_counters, 'interval',
+                  seconds=JOB_REFRESH_USERS_COUNTERS_INTERVAL,
+                  coalesce=True, max_instances=1)
@@ -1,21 +1,21 @@
 from datetime import datetime
-from typing import TYPE_CHECKING
 
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
 
 from app import logger, scheduler, xray
 from app.db import (GetDB, get_notification_reminder, get_users,
                     start_user_expire, update_user_status, reset_user_by_next)
+from app.db.crud import get_user_queryset
+from app.db.models import User
+from app.db.quotas import user_quotas
 from app.models.user import ReminderType, UserResponse, UserStatus
 from app.utils import report
 from app.utils.helpers import (calculate_expiration_days,
                                calculate_usage_percent)
-from config import (JOB_REVIEW_USERS_INTERVAL, NOTIFY_DAYS_LEFT,
+from config import (JOB_RECORD_USER_USAGES_INTERVAL, JOB_REVIEW_USERS_INTERVAL, NOTIFY_DAYS_LEFT,
                     NOTIFY_REACHED_USAGE_PERCENT, WEBHOOK_ADDRESS)
 
-if TYPE_CHECKING:
-    from app.db.models import User
-
 
 def add_notification_reminders(db: Session, user: "User", now: datetime = datetime.utcnow()) -> None:
     if user.data_limit:
@@ -51,42 +51,71 @@ def reset_user_by_next_report(db: Session, user: "User"):
     report.user_data_reset_by_next(user=UserResponse.model_validate(user), user_admin=user.admin)
 
 
-def review():
-    now = datetime.utcnow()
-    now_ts = now.timestamp()
-    with GetDB() as db:
-        for user in get_users(db, status=UserStatus.active):
+def review_active_user(db: Session, user: "User", now: datetime) -> bool:
+    """Limits or expires an active user (or moves them to their next plan), returns whether they were."""
+    limited = user.data_limit and user.used_traffic >= user.data_limit
+    expired = user.expire and user.expire <= now.timestamp()
 
-            limited = user.data_limit and user.used_traffic >= user.data_limit
-            expired = user.expire and user.expire <= now_ts
+    if (limited or expired) and user.next_plan is not None:
+        if user.next_plan is not None:
 
-            if (limited or expired) and user.next_plan is not None:
-                if user.next_plan is not None:
+            if user.next_plan.fire_on_either:
+                reset_user_by_next_report(db, user)
+                return True
 
-                    if user.next_plan.fire_on_either:
-                        reset_user_by_next_report(db, user)
-                        continue
+            elif limited and expired:
+                reset_user_by_next_report(db, user)
+                return True
 
-                    elif limited and expired:
-                        reset_user_by_next_report(db, user)
-                        continue
+    if limited:
+        status = UserStatus.limited
+    elif expired:
+        status = UserStatus.expired
+    else:
+        if WEBHOOK_ADDRESS:
+            add_notification_reminders(db, user, now)
+        return False
 
-            if limited:
-                status = UserStatus.limited
-            elif expired:
-                status = UserStatus.expired
-            else:
-                if WEBHOOK_ADDRESS:
-                    add_notification_reminders(db, user, now)
-                continue
+    xray.operations.remove_user(user)
+    update_user_status(db, user, status)
 
-            xray.operations.remove_user(user)
-            update_user_status(db, user, status)
+    report.status_change(username=user.username, status=status,
+                         user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
+    logger.info(f"User \"{user.username}\" status changed to {status}")
+    return True
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
+
+def review_exceeded_users():
+    """Reviews the users whose quota ran out in the usage pipeline, see enforce_data_limits()."""
+    user_ids = user_quotas.take_exceeded()
+    if not user_ids:
+        return
+
+    now = datetime.utcnow()
+    with GetDB() as db:
+        for user in get_user_queryset(db).filter(User.id.in_(user_ids), User.status == UserStatus.active).all():
+            if not review_active_user(db, user, now):
+                # their quota was out of date
+                user_quotas.set_user(user)
+
+
+def review():
+    now = datetime.utcnow()
+    now_ts = now.timestamp()
+    with GetDB() as db:
+        user_quotas.refresh(db)
+
+        query = get_user_queryset(db).filter(User.status == UserStatus.active)
+        if not WEBHOOK_ADDRESS:
+            # limited users are mostly caught by the usage pipeline already, only the
+            # notifications need to look at everyone
+            query = query.filter(or_(
+                and_(User.data_limit > 0, User.used_traffic >= User.data_limit),
+                and_(User.expire.isnot(None), User.expire <= now_ts)
+            ))
+        for user in query.all():
+            review_active_user(db, user, now)
 
         for user in get_users(db, status=UserStatus.on_hold):
 
@@ -118,3 +147,7 @@ def review():
 scheduler.add_job(review, 'interval',
                   seconds=JOB_REVIEW_USERS_INTERVAL,
                   coalesce=True, max_instances=1)
+# users are queued by the usage collection, so they're picked up within one stats tick
+scheduler.add_job(review_exceeded_users, 'interval',
+                  seconds=JOB_RECORD_USER_USAGES_INTERVAL,
+                  coalesce=True, max_instances=1)
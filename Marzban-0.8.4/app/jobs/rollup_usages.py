@@ -0,0 +1,22 @@
+from datetime import datetime, timedelta
+
+from app import logger, scheduler
+from app.db import GetDB, crud
+from config import JOB_ROLLUP_USER_USAGES_INTERVAL, USER_USAGES_HOURLY_RETENTION_DAYS
+
+
+def rollup_usages():
+    with GetDB() as db:
+        crud.rollup_node_user_usages(db)
+
+        if USER_USAGES_HOURLY_RETENTION_DAYS > 0:
+            before = datetime.utcnow() - timedelta(days=USER_USAGES_HOURLY_RETENTION_DAYS)
+            count = crud.prune_node_user_usages(db, before)
+            if count:
+                logger.info(f"{count} hourly user usages pruned")
+
+
+scheduler.add_job(rollup_usages, 'interval',
+                  seconds=JOB_ROLLUP_USER_USAGES_INTERVAL,
+                  start_date=datetime.utcnow() + timedelta(minutes=1),
+                  coalesce=True, max_instances=1)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -18,3 +20,29 @@ class SystemStats(BaseModel):
     outgoing_bandwidth: int
     incoming_bandwidth_speed: int
     outgoing_bandwidth_speed: int
+
+
+class SubscriptionCacheStats(BaseModel):
+    version: int
+    entries: int
+    size: int
+    max_entries: int
+    max_bytes: int
+    hits: int
+    misses: int
+    not_modified: int
+    bytes_sent: int
+    bytes_saved: int
+
+
+class OperationQueueStats(BaseModel):
+    node_id: Optional[int] = None
+    depth: int
+    processed: int
+    coalesced: int
+    retried: int
+    failed: int
+    dropped: int
+    missing: int
+    extra: int
+    repaired: int
@@ -4,7 +4,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Dict, List, Optional, Union
 
-from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, computed_field, field_validator
 
 from app import xray
 from app.models.admin import Admin
@@ -48,6 +48,12 @@ class UserDataLimitResetStrategy(str, Enum):
     year = "year"
 
 
+class UsageGranularity(str, Enum):
+    hour = "hour"
+    day = "day"
+    month = "month"
+
+
 class NextPlanModel(BaseModel):
     data_limit: Optional[int] = None
     expire: Optional[int] = None
@@ -285,30 +291,34 @@ class UserResponse(User):
     used_traffic: int
     lifetime_used_traffic: int = 0
     created_at: datetime
-    links: List[str] = []
-    subscription_url: str = ""
     proxies: dict
     excluded_inbounds: Dict[ProxyTypes, List[str]] = {}
 
     admin: Optional[Admin] = None
     model_config = ConfigDict(from_attributes=True)
 
-    @model_validator(mode="after")
-    def validate_links(self):
-        if not self.links:
-            self.links = generate_v2ray_links(
-                self.proxies, self.inbounds, extra_data=self.model_dump(), reverse=False,
+    _links: Optional[List[str]] = PrivateAttr(None)
+    _subscription_url: Optional[str] = PrivateAttr(None)
+
+    @computed_field
+    @property
+    def links(self) -> List[str]:
+        # generated on first access, e.g. when serialized, not for every validated user
+        if self._links is None:
+            self._links = generate_v2ray_links(
+                self.proxies, self.inbounds, extra_data=self.__dict__, reverse=False,
             )
-        return self
+        return self._links
 
-    @model_validator(mode="after")
-    def validate_subscription_url(self):
-        if not self.subscription_url:
+    @computed_field
+    @property
+    def subscription_url(self) -> str:
+        if self._subscription_url is None:
             salt = secrets.token_hex(8)
             url_prefix = (XRAY_SUBSCRIPTION_URL_PREFIX).replace('*', salt)
             token = create_subscription_token(self.username)
-            self.subscription_url = f"{url_prefix}/{XRAY_SUBSCRIPTION_PATH}/{token}"
-        return self
+            self._subscription_url = f"{url_prefix}/{XRAY_SUBSCRIPTION_PATH}/{token}"
+        return self._subscription_url
 
     @field_validator("proxies", mode="before")
     def validate_proxies(cls, v, values, **kwargs):
@@ -339,12 +349,19 @@ class SubscriptionUserResponse(UserResponse):
 class UsersResponse(BaseModel):
     users: List[UserResponse]
     total: int
+    next_cursor: Optional[str] = None
+
+
+class UserUsageBucket(BaseModel):
+    created_at: datetime
+    used_traffic: int
 
 
 class UserUsageResponse(BaseModel):
     node_id: Union[int, None] = None
     node_name: str
     used_traffic: int
+    buckets: Optional[List[UserUsageBucket]] = None
 
     @field_validator("used_traffic",  mode='before')
     def cast_to_int(cls, v):
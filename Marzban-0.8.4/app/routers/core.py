@@ -88,13 +88,7 @@ def get_core_stats(admin: Admin = Depends(Admin.get_current)):
 @router.post("/core/restart", responses={403: responses._403})
 def restart_core(admin: Admin = Depends(Admin.check_sudo_admin)):
     """Restart the core and all connected nodes."""
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
-
+    xray.reconcile.restart_all(force=True)
     return {}
 
 
@@ -111,22 +105,15 @@ def get_core_config(admin: Admin = Depends(Admin.check_sudo_admin)) -> dict:
 def modify_core_config(
     payload: dict, admin: Admin = Depends(Admin.check_sudo_admin)
 ) -> dict:
-    """Modify the core configuration and restart the core."""
+    """Modify the core configuration, applying changed inbounds and outbounds live or restarting the core."""
     try:
         config = XRayConfig(payload, api_port=xray.config.api_port)
     except ValueError as err:
         raise HTTPException(status_code=400, detail=str(err))
 
-    xray.config = config
     with open(XRAY_JSON, "w") as f:
         f.write(json.dumps(payload, indent=4))
 
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
-
-    xray.hosts.update()
+    xray.operations.apply_config(config)
 
     return payload
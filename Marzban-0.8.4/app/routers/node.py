@@ -35,7 +35,7 @@ def add_host_if_needed(new_node: NodeCreate, db: Session):
         )
         for inbound_tag in xray.config.inbounds_by_tag:
             crud.add_host(db, inbound_tag, host)
-        xray.hosts.update()
+        xray.operations.update_hosts()
 
 
 @router.get("/node/settings", response_model=NodeSettings)
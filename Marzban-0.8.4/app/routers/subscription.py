@@ -1,13 +1,18 @@
+import hashlib
+import json
 import re
 from distutils.version import LooseVersion
+from typing import Optional, Union
 
 from fastapi import APIRouter, Depends, Header, Path, Request, Response
 from fastapi.responses import HTMLResponse
 
 from app.db import Session, crud, get_db
+from app.db.models import User
 from app.dependencies import get_validated_sub, validate_dates
-from app.models.user import SubscriptionUserResponse, UserResponse
-from app.subscription.share import encode_title, generate_subscription
+from app.models.user import SubscriptionUserResponse, UsageGranularity, UserResponse
+from app.subscription.cache import COMPRESSORS, RenderedSubscription, get_subscription, subscription_cache
+from app.subscription.share import encode_title
 from app.templates import render_template
 from config import (
     SUB_PROFILE_TITLE,
@@ -34,8 +39,11 @@ client_config = {
 
 router = APIRouter(tags=['Subscription'], prefix=f'/{XRAY_SUBSCRIPTION_PATH}')
 
+# smaller bodies aren't worth compressing
+MIN_COMPRESSED_SIZE = 1024
 
-def get_subscription_user_info(user: UserResponse) -> dict:
+
+def get_subscription_user_info(user: Union[User, UserResponse]) -> dict:
     """Retrieve user subscription information including upload, download, total data, and expiry."""
     return {
         "upload": 0,
@@ -45,6 +53,67 @@ def get_subscription_user_info(user: UserResponse) -> dict:
     }
 
 
+def get_accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred content coding of COMPRESSORS an Accept-Encoding header allows, if any."""
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        qualities[coding.strip()] = quality
+
+    for encoding in COMPRESSORS:
+        if qualities.get(encoding, qualities.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def get_etag(subscription: RenderedSubscription, headers: dict, encoding: Optional[str] = None) -> str:
+    """
+    Strong ETag of a subscription response.
+
+    It's derived from the headers as well as the body, so clients also fetch it again when
+    the usage in subscription-userinfo changes, and differs per content coding.
+    """
+    digest = hashlib.blake2b(subscription.digest.encode(), digest_size=16)
+    digest.update(json.dumps(headers, sort_keys=True).encode())
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{digest.hexdigest()}{suffix}"'
+
+
+def subscription_response(
+    request: Request, subscription: RenderedSubscription, media_type: str, headers: dict
+) -> Response:
+    """
+    Responds with a subscription, compressed when the client accepts it, or with
+    304 Not Modified when the client's copy has the same ETag.
+    """
+    encoding = None
+    if len(subscription.body) >= MIN_COMPRESSED_SIZE:
+        encoding = get_accepted_encoding(request.headers.get("accept-encoding", ""))
+
+    headers = {**headers, "etag": get_etag(subscription, headers, encoding), "vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if headers["etag"] in tags or "*" in tags:
+            subscription_cache.record_response(len(subscription.body), 0, not_modified=True)
+            return Response(status_code=304, headers=headers)
+
+    content = subscription.body
+    if encoding:
+        content = subscription.encode(encoding)
+        headers["content-encoding"] = encoding
+    subscription_cache.record_response(len(subscription.body), len(content))
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
 @router.get("/{token}/")
 @router.get("/{token}", include_in_schema=False)
 def user_subscription(
@@ -54,89 +123,87 @@ def user_subscription(
     user_agent: str = Header(default="")
 ):
     """Provides a subscription link based on the user agent (Clash, V2Ray, etc.)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
     accept_header = request.headers.get("Accept", "")
     if "text/html" in accept_header:
         return HTMLResponse(
             render_template(
                 SUBSCRIPTION_PAGE_TEMPLATE,
-                {"user": user}
+                {"user": UserResponse.model_validate(dbuser)}
             )
         )
 
     crud.update_user_sub(db, dbuser, user_agent)
     response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
+        "content-disposition": f'attachment; filename="{dbuser.username}"',
         "profile-web-page-url": str(request.url),
         "support-url": SUB_SUPPORT_URL,
         "profile-title": encode_title(SUB_PROFILE_TITLE),
         "profile-update-interval": SUB_UPDATE_INTERVAL,
         "subscription-userinfo": "; ".join(
             f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
+            for key, val in get_subscription_user_info(dbuser).items()
         )
     }
 
     if re.match(r'^([Cc]lash-verge|[Cc]lash[-\.]?[Mm]eta|[Ff][Ll][Cc]lash|[Mm]ihomo)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash-meta", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        conf = get_subscription(dbuser, config_format="clash-meta", as_base64=False, reverse=False)
+        return subscription_response(request, conf, "text/yaml", response_headers)
 
     elif re.match(r'^([Cc]lash|[Ss]tash)', user_agent):
-        conf = generate_subscription(user=user, config_format="clash", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="text/yaml", headers=response_headers)
+        conf = get_subscription(dbuser, config_format="clash", as_base64=False, reverse=False)
+        return subscription_response(request, conf, "text/yaml", response_headers)
 
     elif re.match(r'^(SFA|SFI|SFM|SFT|[Kk]aring|[Hh]iddify[Nn]ext)', user_agent):
-        conf = generate_subscription(user=user, config_format="sing-box", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        conf = get_subscription(dbuser, config_format="sing-box", as_base64=False, reverse=False)
+        return subscription_response(request, conf, "application/json", response_headers)
 
     elif re.match(r'^(SS|SSR|SSD|SSS|Outline|Shadowsocks|SSconf)', user_agent):
-        conf = generate_subscription(user=user, config_format="outline", as_base64=False, reverse=False)
-        return Response(content=conf, media_type="application/json", headers=response_headers)
+        conf = get_subscription(dbuser, config_format="outline", as_base64=False, reverse=False)
+        return subscription_response(request, conf, "application/json", response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYN) and re.match(r'^v2rayN/(\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayN/(\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("6.40"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray-json", as_base64=False, reverse=False)
+            return subscription_response(request, conf, "application/json", response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray", as_base64=True, reverse=False)
+            return subscription_response(request, conf, "text/plain", response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_V2RAYNG) and re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^v2rayNG/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.8.29"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray-json", as_base64=False, reverse=False)
+            return subscription_response(request, conf, "application/json", response_headers)
         elif LooseVersion(version_str) >= LooseVersion("1.8.18"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=True)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray-json", as_base64=False, reverse=True)
+            return subscription_response(request, conf, "application/json", response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray", as_base64=True, reverse=False)
+            return subscription_response(request, conf, "text/plain", response_headers)
 
     elif re.match(r'^[Ss]treisand', user_agent):
         if USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_STREISAND:
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray-json", as_base64=False, reverse=False)
+            return subscription_response(request, conf, "application/json", response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray", as_base64=True, reverse=False)
+            return subscription_response(request, conf, "text/plain", response_headers)
 
     elif (USE_CUSTOM_JSON_DEFAULT or USE_CUSTOM_JSON_FOR_HAPP) and re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent):
         version_str = re.match(r'^Happ/(\d+\.\d+\.\d+)', user_agent).group(1)
         if LooseVersion(version_str) >= LooseVersion("1.63.1"):
-            conf = generate_subscription(user=user, config_format="v2ray-json", as_base64=False, reverse=False)
-            return Response(content=conf, media_type="application/json", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray-json", as_base64=False, reverse=False)
+            return subscription_response(request, conf, "application/json", response_headers)
         else:
-            conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-            return Response(content=conf, media_type="text/plain", headers=response_headers)
+            conf = get_subscription(dbuser, config_format="v2ray", as_base64=True, reverse=False)
+            return subscription_response(request, conf, "text/plain", response_headers)
 
 
 
     else:
-        conf = generate_subscription(user=user, config_format="v2ray", as_base64=True, reverse=False)
-        return Response(content=conf, media_type="text/plain", headers=response_headers)
+        conf = get_subscription(dbuser, config_format="v2ray", as_base64=True, reverse=False)
+        return subscription_response(request, conf, "text/plain", response_headers)
 
 
 @router.get("/{token}/info", response_model=SubscriptionUserResponse)
@@ -152,12 +219,13 @@ def user_get_usage(
     dbuser: UserResponse = Depends(get_validated_sub),
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db)
 ):
     """Fetches the usage statistics for the user within a specified date range."""
     start, end = validate_dates(start, end)
 
-    usages = crud.get_user_usages(db, dbuser, start, end)
+    usages = crud.get_user_usages(db, dbuser, start, end, granularity)
 
     return {"usages": usages, "username": dbuser.username}
 
@@ -171,24 +239,22 @@ def user_subscription_with_client_type(
     user_agent: str = Header(default="")
 ):
     """Provides a subscription link based on the specified client type (e.g., Clash, V2Ray)."""
-    user: UserResponse = UserResponse.model_validate(dbuser)
-
     response_headers = {
-        "content-disposition": f'attachment; filename="{user.username}"',
+        "content-disposition": f'attachment; filename="{dbuser.username}"',
         "profile-web-page-url": str(request.url),
         "support-url": SUB_SUPPORT_URL,
         "profile-title": encode_title(SUB_PROFILE_TITLE),
         "profile-update-interval": SUB_UPDATE_INTERVAL,
         "subscription-userinfo": "; ".join(
             f"{key}={val}"
-            for key, val in get_subscription_user_info(user).items()
+            for key, val in get_subscription_user_info(dbuser).items()
         )
     }
 
     config = client_config.get(client_type)
-    conf = generate_subscription(user=user,
-                                 config_format=config["config_format"],
-                                 as_base64=config["as_base64"],
-                                 reverse=config["reverse"])
+    conf = get_subscription(dbuser,
+                            config_format=config["config_format"],
+                            as_base64=config["as_base64"],
+                            reverse=config["reverse"])
 
-    return Response(content=conf, media_type=config["media_type"], headers=response_headers)
+    return subscription_response(request, conf, config["media_type"], response_headers)
@@ -1,13 +1,15 @@
-from typing import Dict, List, Union
+from typing import Dict, List
 
 from fastapi import APIRouter, Depends, HTTPException
 
 from app import __version__, xray
 from app.db import Session, crud, get_db
+from app.db.counters import users_counters
 from app.models.admin import Admin
 from app.models.proxy import ProxyHost, ProxyInbound, ProxyTypes
-from app.models.system import SystemStats
+from app.models.system import OperationQueueStats, SubscriptionCacheStats, SystemStats
 from app.models.user import UserStatus
+from app.subscription.cache import subscription_cache
 from app.utils import responses
 from app.utils.system import cpu_usage, memory_usage, realtime_bandwidth
 
@@ -21,26 +23,15 @@ def get_system_stats(
     """Fetch system stats including memory, CPU, and user metrics."""
     mem = memory_usage()
     cpu = cpu_usage()
-    system = crud.get_system_usage(db)
-    dbadmin: Union[Admin, None] = crud.get_admin(db, admin.username)
-
-    total_user = crud.get_users_count(db, admin=dbadmin if not admin.is_sudo else None)
-    users_active = crud.get_users_count(
-        db, status=UserStatus.active, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_disabled = crud.get_users_count(
-        db, status=UserStatus.disabled, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_on_hold = crud.get_users_count(
-        db, status=UserStatus.on_hold, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_expired = crud.get_users_count(
-        db, status=UserStatus.expired, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_limited = crud.get_users_count(
-        db, status=UserStatus.limited, admin=dbadmin if not admin.is_sudo else None
-    )
-    online_users = crud.count_online_users(db, 24)
+    owner = None if admin.is_sudo else admin.username
+
+    users_counters.ensure(db)
+    total_user = users_counters.count(db, admin=owner)
+    users_active = users_counters.count(db, UserStatus.active, owner)
+    users_disabled = users_counters.count(db, UserStatus.disabled, owner)
+    users_on_hold = users_counters.count(db, UserStatus.on_hold, owner)
+    users_expired = users_counters.count(db, UserStatus.expired, owner)
+    users_limited = users_counters.count(db, UserStatus.limited, owner)
     realtime_bandwidth_stats = realtime_bandwidth()
 
     return SystemStats(
@@ -50,19 +41,49 @@ def get_system_stats(
         cpu_cores=cpu.cores,
         cpu_usage=cpu.percent,
         total_user=total_user,
-        online_users=online_users,
+        online_users=users_counters.online_users,
         users_active=users_active,
         users_disabled=users_disabled,
         users_expired=users_expired,
         users_limited=users_limited,
         users_on_hold=users_on_hold,
-        incoming_bandwidth=system.uplink,
-        outgoing_bandwidth=system.downlink,
+        incoming_bandwidth=users_counters.uplink,
+        outgoing_bandwidth=users_counters.downlink,
         incoming_bandwidth_speed=realtime_bandwidth_stats.incoming_bytes,
         outgoing_bandwidth_speed=realtime_bandwidth_stats.outgoing_bytes,
     )
 
 
+@router.get(
+    "/system/subscription-cache", response_model=SubscriptionCacheStats, responses={403: responses._403}
+)
+def get_subscription_cache_stats(admin: Admin = Depends(Admin.check_sudo_admin)):
+    """Fetch subscription cache stats, and the bytes saved by compressing or not resending subscriptions."""
+    return SubscriptionCacheStats(
+        version=subscription_cache.version,
+        entries=len(subscription_cache),
+        size=subscription_cache.size,
+        max_entries=subscription_cache.max_entries,
+        max_bytes=subscription_cache.max_bytes,
+        hits=subscription_cache.hits,
+        misses=subscription_cache.misses,
+        not_modified=subscription_cache.not_modified,
+        bytes_sent=subscription_cache.bytes_sent,
+        bytes_saved=subscription_cache.bytes_saved,
+    )
+
+
+@router.get(
+    "/system/operation-queues", response_model=List[OperationQueueStats], responses={403: responses._403}
+)
+def get_operation_queues_stats(admin: Admin = Depends(Admin.check_sudo_admin)):
+    """
+    Fetch the pending user operations of the main core (node_id null) and of every node, their outcomes,
+    and the users each core missed (or shouldn't have had) on the last drift check.
+    """
+    return [OperationQueueStats(**stats) for stats in xray.operations.get_queue_stats()]
+
+
 @router.get("/inbounds", response_model=Dict[ProxyTypes, List[ProxyInbound]])
 def get_inbounds(admin: Admin = Depends(Admin.get_current)):
     """Retrieve inbound configurations grouped by protocol."""
@@ -98,6 +119,6 @@ def modify_hosts(
     for inbound_tag, hosts in modified_hosts.items():
         crud.update_hosts(db, inbound_tag, hosts)
 
-    xray.hosts.update()
+    xray.operations.update_hosts()
 
     return {tag: crud.get_hosts(db, tag) for tag in xray.config.inbounds_by_tag}
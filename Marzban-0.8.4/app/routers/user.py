@@ -1,7 +1,8 @@
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Union
+from typing import List, Optional, Set, Union
 
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
 from sqlalchemy.exc import IntegrityError
 
 from app import logger, xray
@@ -9,6 +10,7 @@ from app.db import Session, crud, get_db
 from app.dependencies import get_expired_users_list, get_validated_user, validate_dates
 from app.models.admin import Admin
 from app.models.user import (
+    UsageGranularity,
     UserCreate,
     UserModify,
     UserResponse,
@@ -22,6 +24,18 @@ from app.utils import report, responses
 router = APIRouter(tags=["User"], prefix="/api", responses={401: responses._401})
 
 
+def parse_user_fields(values: Optional[List[str]]) -> Optional[Set[str]]:
+    """Parses a fields query parameter into UserResponse field names."""
+    if not values:
+        return None
+
+    fields = {field.strip() for value in values for field in value.split(",") if field.strip()}
+    for field in fields:
+        if field not in UserResponse.model_fields and field not in UserResponse.model_computed_fields:
+            raise HTTPException(status_code=400, detail=f'"{field}" is not a valid user field')
+    return fields
+
+
 @router.post("/user", response_model=UserResponse, responses={400: responses._400, 409: responses._409})
 def add_user(
     new_user: UserCreate,
@@ -208,10 +222,24 @@ def get_users(
     owner: Union[List[str], None] = Query(None, alias="admin"),
     status: UserStatus = None,
     sort: str = None,
+    fields: List[str] = Query(None),
+    exclude: List[str] = Query(None),
+    cursor: str = None,
     db: Session = Depends(get_db),
     admin: Admin = Depends(Admin.get_current),
 ):
-    """Get all users"""
+    """
+    Get all users
+
+    Pages can be requested with `offset` or, faster for deep pages, with the `next_cursor`
+    of the previous page (with the same `sort` and filters) as `cursor`.
+
+    `fields` and `exclude` (comma separated or repeated) limit the fields of the returned users,
+    links and subscription_url are only generated when they're returned.
+    """
+    fields = parse_user_fields(fields)
+    exclude = parse_user_fields(exclude)
+
     if sort is not None:
         opts = sort.strip(",").split(",")
         sort = []
@@ -223,33 +251,48 @@ def get_users(
                     status_code=400, detail=f'"{opt}" is not a valid sort option'
                 )
 
-    users, count = crud.get_users(
-        db=db,
-        offset=offset,
-        limit=limit,
-        search=search,
-        usernames=username,
-        status=status,
-        sort=sort,
-        admins=owner if admin.is_sudo else [admin.username],
-        return_with_count=True,
-    )
+    try:
+        users, count = crud.get_users(
+            db=db,
+            offset=offset,
+            limit=limit,
+            search=search,
+            usernames=username,
+            status=status,
+            sort=sort,
+            admins=owner if admin.is_sudo else [admin.username],
+            return_with_count=True,
+            cursor=cursor,
+        )
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
 
-    return {"users": users, "total": count}
+    next_cursor = None
+    if limit and len(users) == limit:
+        next_cursor = crud.encode_users_cursor(users[-1], sort, search)
+
+    if fields is None and exclude is None:
+        return {"users": users, "total": count, "next_cursor": next_cursor}
+
+    return JSONResponse({
+        "users": [
+            UserResponse.model_validate(user).model_dump(mode="json", include=fields, exclude=exclude)
+            for user in users
+        ],
+        "total": count,
+        "next_cursor": next_cursor
+    })
 
 
 @router.post("/users/reset", responses={403: responses._403, 404: responses._404})
 def reset_users_data_usage(
+    bg: BackgroundTasks,
     db: Session = Depends(get_db), admin: Admin = Depends(Admin.check_sudo_admin)
 ):
     """Reset all users data usage"""
     dbadmin = crud.get_admin(db, admin.username)
-    crud.reset_all_users_data_usage(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
+    user_ids = crud.reset_all_users_data_usage(db=db, admin=dbadmin)
+    bg.add_task(xray.reconcile.reconcile_users, user_ids=user_ids)
     return {"detail": "Users successfully reset."}
 
 
@@ -258,12 +301,13 @@ def get_user_usage(
     dbuser: UserResponse = Depends(get_validated_user),
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db),
 ):
-    """Get users usage"""
+    """Get users usage, broken down into hourly, daily or monthly buckets when a granularity is given"""
     start, end = validate_dates(start, end)
 
-    usages = crud.get_user_usages(db, dbuser, start, end)
+    usages = crud.get_user_usages(db, dbuser, start, end, granularity)
 
     return {"usages": usages, "username": dbuser.username}
 
@@ -299,15 +343,16 @@ def active_next_plan(
 def get_users_usage(
     start: str = "",
     end: str = "",
+    granularity: Optional[UsageGranularity] = None,
     db: Session = Depends(get_db),
     owner: Union[List[str], None] = Query(None, alias="admin"),
     admin: Admin = Depends(Admin.get_current),
 ):
-    """Get all users usage"""
+    """Get all users usage, broken down into hourly, daily or monthly buckets when a granularity is given"""
     start, end = validate_dates(start, end)
 
     usages = crud.get_all_users_usages(
-        db=db, start=start, end=end, admin=owner if admin.is_sudo else [admin.username]
+        db=db, start=start, end=end, admin=owner if admin.is_sudo else [admin.username], granularity=granularity
     )
 
     return {"usages": usages}
@@ -0,0 +1,247 @@
+import gzip
+import hashlib
+import json
+from collections import OrderedDict
+from string import Formatter
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, FrozenSet, Hashable, Optional
+
+import brotli
+
+from config import SUB_CACHE_MAX_BYTES, SUB_CACHE_MAX_ENTRIES
+
+if TYPE_CHECKING:
+    from app.db.models import User
+
+# content codings subscriptions are served with, in order of preference
+COMPRESSORS = {
+    "br": lambda body: brotli.compress(body, quality=5),
+    "gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+}
+
+
+class RenderedSubscription:
+    """A rendered subscription body, with the digest its ETags are derived from and its compressed encodings."""
+
+    __slots__ = ("body", "digest", "key", "encoded")
+
+    def __init__(self, content: str, key: Hashable = None):
+        self.body = content.encode()
+        self.digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self.key = key
+        self.encoded: Dict[str, bytes] = {}
+
+    def __len__(self):
+        return len(self.body) + sum(len(data) for data in self.encoded.values())
+
+    def encode(self, encoding: str) -> bytes:
+        """The body compressed with a content coding of COMPRESSORS, compressed once and kept along with it."""
+        data = self.encoded.get(encoding)
+        if data is None:
+            data = COMPRESSORS[encoding](self.body)
+            subscription_cache.add_encoding(self, encoding, data)
+        return data
+
+
+class SubscriptionCache:
+    """
+    LRU cache of rendered subscription bodies, bounded by entries and optionally by bytes.
+
+    Keys carry the cache version, which is bumped whenever hosts or the core config
+    change, so stale bodies are never served and simply age out. Compressed encodings
+    of a body count towards its size.
+
+    It also counts the bytes subscription responses saved, by compression or by being
+    answered with 304 Not Modified.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._used_variables = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[RenderedSubscription]:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: RenderedSubscription, version: int = None):
+        """Stores `value`, unless it was rendered before the cache's `version` was bumped."""
+        size = len(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self.size += size
+
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes and self.size > self.max_bytes)
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def add_encoding(self, value: RenderedSubscription, encoding: str, data: bytes):
+        with self._lock:
+            if encoding in value.encoded:
+                return
+            value.encoded[encoding] = data
+            if self._entries.get(value.key) is value:
+                self.size += len(data)
+
+    def record_response(self, body_size: int, sent: int, not_modified: bool = False):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_saved += body_size - sent
+            if not_modified:
+                self.not_modified += 1
+
+    def bump(self):
+        """Invalidates every cached body, called when hosts or the core config change."""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self.size = 0
+            self._used_variables = None
+
+    def used_variables(self) -> FrozenSet[str]:
+        """Names of the format variables referenced by hosts' remarks, addresses and paths."""
+        used_variables = self._used_variables
+        if used_variables is None:
+            from app import xray
+
+            templates = [
+                inbound.get("path") or "" for inbound in xray.config.inbounds_by_tag.values()
+            ]
+            for hosts in xray.hosts.values():
+                for host in hosts:
+                    templates.append(host["remark"])
+                    templates.extend(host["address"])
+                    templates.append(host["path"] or "")
+
+            used_variables = frozenset(
+                name
+                for template in templates
+                for _, name, _, _ in Formatter().parse(template)
+                if name
+            )
+            self._used_variables = used_variables
+
+        return used_variables
+
+
+subscription_cache = SubscriptionCache(SUB_CACHE_MAX_ENTRIES, SUB_CACHE_MAX_BYTES)
+
+
+def user_fingerprint(dbuser: "User") -> int:
+    """
+    Hash of everything of a user a subscription body is rendered from.
+
+    Includes the values of the format variables hosts reference, so time dependent ones
+    such as DAYS_LEFT rolling over (or DATA_LEFT changing) produce a new key, and so does
+    any modification of the user.
+    """
+    from app.subscription.share import setup_format_variables
+
+    used_variables = subscription_cache.used_variables()
+    format_variables = setup_format_variables({
+        "username": dbuser.username,
+        "status": dbuser.status,
+        "expire": dbuser.expire,
+        "on_hold_expire_duration": dbuser.on_hold_expire_duration,
+        "data_limit": dbuser.data_limit,
+        "used_traffic": dbuser.used_traffic,
+    })
+    proxies = tuple(
+        (
+            proxy.type,
+            json.dumps(proxy.settings, sort_keys=True),
+            tuple(sorted(inbound.tag for inbound in proxy.excluded_inbounds))
+        )
+        for proxy in sorted(dbuser.proxies, key=lambda p: p.type)
+    )
+    return hash((
+        dbuser.username,
+        dbuser.status,
+        tuple((name, str(format_variables[name])) for name in sorted(used_variables)),
+        proxies
+    ))
+
+
+def is_randomized(dbuser: "User") -> bool:
+    """
+    Whether the subscription of a user has hosts picking their address, SNI, host or
+    short id at random, so every fetch spreads the user differently.
+    """
+    from app import xray
+    from app.subscription.share import get_hosts_plan
+
+    randomized_tags = get_hosts_plan().randomized_tags
+    if not randomized_tags:
+        return False
+
+    for proxy in dbuser.proxies:
+        excluded = {inbound.tag for inbound in proxy.excluded_inbounds}
+        for inbound in xray.config.inbounds_by_protocol.get(proxy.type, []):
+            if inbound["tag"] in randomized_tags and inbound["tag"] not in excluded:
+                return True
+    return False
+
+
+def get_subscription(dbuser: "User", config_format: str, as_base64: bool, reverse: bool) -> RenderedSubscription:
+    """
+    Returns the rendered subscription of a user, from the cache when nothing it's rendered from changed.
+
+    Subscriptions with random picks (see is_randomized()) are rendered every time, as
+    caching them would pin the user to the picks of the first render.
+    """
+    from app.models.user import UserResponse
+    from app.subscription.share import generate_subscription
+
+    if not subscription_cache.enabled or is_randomized(dbuser):
+        user = UserResponse.model_validate(dbuser)
+        return RenderedSubscription(
+            generate_subscription(user=user, config_format=config_format, as_base64=as_base64, reverse=reverse)
+        )
+
+    # the fingerprint may load the hosts and bump the version, so it's taken first
+    fingerprint = user_fingerprint(dbuser)
+    version = subscription_cache.version
+    key = (dbuser.id, config_format, as_base64, reverse, version, fingerprint)
+    conf = subscription_cache.get(key)
+    if conf is None:
+        user = UserResponse.model_validate(dbuser)
+        conf = RenderedSubscription(
+            generate_subscription(user=user, config_format=config_format, as_base64=as_base64, reverse=reverse),
+            key
+        )
+        subscription_cache.set(key, conf, version)
+
+    return conf
@@ -1,21 +1,124 @@
 import copy
 import json
+import re
 from random import choice
 from uuid import UUID
 
 import yaml
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app import logger
+from app.subscription.funcs import get_grpc_gun, parse_user_agents, parse_yaml
+from app.templates import get_parsed_template, get_template
 from app.utils.helpers import yml_uuid_representer
 from config import (
+    CLASH_DIRECT_RENDER,
     CLASH_SETTINGS_TEMPLATE,
     CLASH_SUBSCRIPTION_TEMPLATE,
     MUX_TEMPLATE,
     USER_AGENT_TEMPLATE,
 )
 
+try:
+    from yaml import CSafeDumper, CSafeLoader
+except ImportError:
+    CSafeDumper = yaml.SafeDumper
+    CSafeLoader = yaml.SafeLoader
+
+# libyaml escapes characters outside the BMP (e.g. flag emojis), unlike the python emitter
+_ASTRAL = re.compile('[\U00010000-\U0010FFFF]')
+
+# used by the yaml filter of the template
+yaml.add_representer(UUID, yml_uuid_representer)
+
+
+def _placeholder(name: str) -> str:
+    return f"<marzban:{name}>"
+
+
+def _plain(node):
+    """What the template's yaml filter turns a value into once loaded back: sorted keys and no UUIDs."""
+    if isinstance(node, dict):
+        return {key: _plain(node[key]) for key in sorted(node)}
+    if isinstance(node, (list, tuple)):
+        return [_plain(item) for item in node]
+    if isinstance(node, UUID):
+        return str(node)
+    return node
+
+
+def _has_astral(node) -> bool:
+    if isinstance(node, str):
+        return _ASTRAL.search(node) is not None
+    if isinstance(node, dict):
+        return any(_has_astral(key) or _has_astral(value) for key, value in node.items())
+    if isinstance(node, (list, tuple)):
+        return any(_has_astral(item) for item in node)
+    return False
+
+
+def _fill(node, lists: dict):
+    if isinstance(node, dict):
+        return {key: _fill(value, lists) for key, value in node.items()}
+    if isinstance(node, list):
+        items = []
+        for item in node:
+            if isinstance(item, str) and item in lists:
+                items.extend(_plain(value) for value in lists[item])
+            else:
+                items.append(_fill(item, lists))
+        return items
+    return node
+
+
+class ClashSkeleton:
+    """
+    The subscription template rendered once with a placeholder item in place of every
+    non-empty list of a configuration, so rendering a configuration is only putting its
+    lists in and dumping the document once.
+
+    Its first render is compared with the jinja path. Templates that do more than placing
+    the lists (e.g. loop over them) produce a different document and keep being rendered
+    by jinja.
+    """
+
+    def __init__(self, template, empty: frozenset):
+        self.template = template
+        self.verified = False
+        self.document = None
+
+        def placeholder(name: str) -> list:
+            return [] if name in empty else [_placeholder(name)]
+
+        try:
+            self.document = yaml.load(
+                template.render({
+                    "conf": {
+                        "proxies": placeholder("proxies"),
+                        "proxy-groups": placeholder("proxy-groups"),
+                        "rules": placeholder("rules"),
+                    },
+                    "proxy_remarks": placeholder("proxy_remarks"),
+                }),
+                Loader=CSafeLoader
+            )
+        except Exception:
+            pass
+        self.astral = _has_astral(self.document)
+
+    def render(self, lists: dict) -> str:
+        document = _fill(self.document, {_placeholder(name): items for name, items in lists.items()})
+        # the python emitter is only needed for what libyaml would escape
+        if self.astral or any(_has_astral(items) for items in lists.values()):
+            dumper = yaml.SafeDumper
+        else:
+            dumper = CSafeDumper
+        return yaml.dump(document, Dumper=dumper, sort_keys=False, allow_unicode=True)
+
+
+# (template, empty lists) -> ClashSkeleton
+_skeletons = {}
+
 
 class ClashConfiguration(object):
     def __init__(self):
@@ -26,32 +129,53 @@ class ClashConfiguration(object):
             'rules': []
         }
         self.proxy_remarks = []
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
-            self.user_agent_list = user_agent_data['list']
-        else:
-            self.user_agent_list = []
+        self.mux_settings = get_parsed_template(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = get_parsed_template(USER_AGENT_TEMPLATE, parse_user_agents)
 
         try:
-            self.settings = yaml.load(render_template(CLASH_SETTINGS_TEMPLATE), Loader=yaml.SafeLoader)
+            self.settings = get_parsed_template(CLASH_SETTINGS_TEMPLATE, parse_yaml)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data
-
     def render(self, reverse=False):
         if reverse:
             self.data['proxies'].reverse()
 
-        yaml.add_representer(UUID, yml_uuid_representer)
+        template = get_template(CLASH_SUBSCRIPTION_TEMPLATE)
+        if not CLASH_DIRECT_RENDER:
+            return self._render_template(template)
+
+        lists = {
+            "proxies": self.data['proxies'],
+            "proxy-groups": self.data['proxy-groups'],
+            "rules": self.data['rules'],
+            "proxy_remarks": self.proxy_remarks,
+        }
+        key = (template, frozenset(name for name, items in lists.items() if not items))
+        skeleton = _skeletons.get(key)
+        if skeleton is None:
+            if any(k[0] is not template for k in _skeletons):
+                _skeletons.clear()
+            skeleton = _skeletons[key] = ClashSkeleton(*key)
+
+        if skeleton.document is None:
+            return self._render_template(template)
+
+        if not skeleton.verified:
+            expected = self._render_template(template)
+            if skeleton.render(lists) != expected:
+                logger.warning(f"Clash subscription template {CLASH_SUBSCRIPTION_TEMPLATE} "
+                               "can't be rendered directly, rendering it with jinja")
+                skeleton.document = None
+            skeleton.verified = True
+            return expected
+
+        return skeleton.render(lists)
+
+    def _render_template(self, template) -> str:
         return yaml.dump(
             yaml.load(
-                render_template(
-                    CLASH_SUBSCRIPTION_TEMPLATE,
-                    {"conf": self.data, "proxy_remarks": self.proxy_remarks}
-                ),
+                template.render({"conf": self.data, "proxy_remarks": self.proxy_remarks}),
                 Loader=yaml.SafeLoader
 
             ),
@@ -245,8 +369,7 @@ class ClashConfiguration(object):
 
         node[f'{network}-opts'] = net_opts
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["clash"]
+        mux_config = copy.deepcopy(self.mux_settings["clash"])
 
         if mux_enable:
             node['smux'] = mux_config
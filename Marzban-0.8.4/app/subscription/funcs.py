@@ -1,3 +1,8 @@
+import json
+
+import yaml
+
+
 def get_grpc_gun(path: str) -> str:
     if not path.startswith("/"):
         return path
@@ -17,4 +22,14 @@ def get_grpc_multi(path: str) -> str:
     servicename = path.rsplit("/", 1)[0]
     streamname = path.rsplit("/", 1)[1].split("|")[1]
 
-    return "%s%s%s" % (servicename, "/", streamname)
\ No newline at end of file
+    return "%s%s%s" % (servicename, "/", streamname)
+
+def parse_user_agents(text: str) -> list:
+    data = json.loads(text)
+    if 'list' in data and isinstance(data['list'], list):
+        return data['list']
+    return []
+
+
+def parse_yaml(text: str):
+    return yaml.load(text, Loader=yaml.SafeLoader)
@@ -1,7 +1,6 @@
 import base64
 import random
 import secrets
-from collections import defaultdict
 from datetime import datetime as dt
 from datetime import timedelta
 from typing import TYPE_CHECKING, List, Literal, Union
@@ -154,7 +153,7 @@ def format_time_left(seconds_left: int) -> str:
     return " ".join(result)
 
 
-def setup_format_variables(extra_data: dict) -> dict:
+def _expire_variables(extra_data: dict) -> dict:
     from app.models.user import UserStatus
 
     user_status = extra_data.get("status")
@@ -195,6 +194,15 @@ def setup_format_variables(extra_data: dict) -> dict:
             expire_date = "∞"
             jalali_expire_date = "∞"
 
+    return {
+        "DAYS_LEFT": days_left,
+        "EXPIRE_DATE": expire_date,
+        "JALALI_EXPIRE_DATE": jalali_expire_date,
+        "TIME_LEFT": time_left,
+    }
+
+
+def _data_variables(extra_data: dict) -> dict:
     if extra_data.get("data_limit"):
         data_limit = readable_size(extra_data["data_limit"])
         data_left = extra_data["data_limit"] - extra_data["used_traffic"]
@@ -205,28 +213,160 @@ def setup_format_variables(extra_data: dict) -> dict:
         data_limit = "∞"
         data_left = "∞"
 
-    status_emoji = STATUS_EMOJIS.get(extra_data.get("status")) or ""
-    status_text = STATUS_TEXTS.get(extra_data.get("status")) or ""
+    return {
+        "DATA_USAGE": readable_size(extra_data.get("used_traffic")),
+        "DATA_LIMIT": data_limit,
+        "DATA_LEFT": data_left,
+    }
+
+
+class FormatVariables(dict):
+    """
+    Format variables of a user for host remarks, addresses and paths.
+
+    The expire and data ones are only computed once a template references them,
+    unknown ones are rendered as "<missing>".
+    """
+
+    _lazy = {
+        "DAYS_LEFT": _expire_variables,
+        "EXPIRE_DATE": _expire_variables,
+        "JALALI_EXPIRE_DATE": _expire_variables,
+        "TIME_LEFT": _expire_variables,
+        "DATA_USAGE": _data_variables,
+        "DATA_LIMIT": _data_variables,
+        "DATA_LEFT": _data_variables,
+    }
 
-    format_variables = defaultdict(
-        lambda: "<missing>",
-        {
+    def __init__(self, extra_data: dict):
+        super().__init__({
             "SERVER_IP": SERVER_IP,
             "SERVER_IPV6": SERVER_IPV6,
             "USERNAME": extra_data.get("username", "{USERNAME}"),
-            "DATA_USAGE": readable_size(extra_data.get("used_traffic")),
-            "DATA_LIMIT": data_limit,
-            "DATA_LEFT": data_left,
-            "DAYS_LEFT": days_left,
-            "EXPIRE_DATE": expire_date,
-            "JALALI_EXPIRE_DATE": jalali_expire_date,
-            "TIME_LEFT": time_left,
-            "STATUS_EMOJI": status_emoji,
-            "STATUS_TEXT": status_text,
-        },
-    )
-
-    return format_variables
+            "STATUS_EMOJI": STATUS_EMOJIS.get(extra_data.get("status")) or "",
+            "STATUS_TEXT": STATUS_TEXTS.get(extra_data.get("status")) or "",
+        })
+        self.extra_data = extra_data
+
+    def __missing__(self, key):
+        func = self._lazy.get(key)
+        if func is None:
+            self[key] = "<missing>"
+        else:
+            self.update(func(self.extra_data))
+        return self[key]
+
+
+def setup_format_variables(extra_data: dict) -> FormatVariables:
+    return FormatVariables(extra_data)
+
+
+class HostPlan:
+    """
+    A host of an inbound with everything not depending on the user resolved,
+    its remark, addresses and path are only formatted when they have variables.
+    """
+
+    __slots__ = ("remark", "remark_static", "addresses", "sni_list", "host_list", "path", "path_static",
+                 "use_sni_as_host", "sids", "inbound", "randomized")
+
+    def __init__(self, inbound: dict, host: dict):
+        self.remark = host["remark"]
+        self.remark_static = "{" not in self.remark
+        self.addresses = host["address"]
+        self.sni_list = host["sni"] or inbound["sni"]
+        self.host_list = host["host"] or inbound["host"]
+        self.path = host["path"] if host["path"] is not None else inbound.get("path", "")
+        self.path_static = "{" not in self.path
+        self.use_sni_as_host = host.get("use_sni_as_host", False)
+        self.sids = inbound.get("sids")
+        self.inbound = {
+            **inbound,
+            "port": host["port"] or inbound["port"],
+            "tls": inbound["tls"] if host["tls"] is None else host["tls"],
+            "alpn": host["alpn"] if host["alpn"] else None,
+            "fp": host["fingerprint"] or inbound.get("fp", ""),
+            "ais": host["allowinsecure"] or inbound.get("allowinsecure", ""),
+            "mux_enable": host["mux_enable"],
+            "fragment_setting": host["fragment_setting"],
+            "noise_setting": host["noise_setting"],
+            "random_user_agent": host["random_user_agent"],
+        }
+        # whether every render picks its address, SNI, host or short id at random
+        self.randomized = any(
+            len(values) > 1 or any("*" in value for value in values)
+            for values in (self.addresses, self.sni_list, self.host_list)
+        ) or len(self.sids or ()) > 1
+
+    @staticmethod
+    def _pick(values: list) -> str:
+        value = random.choice(values)
+        if "*" in value:
+            value = value.replace("*", secrets.token_hex(8))
+        return value
+
+    def render(self, format_variables: dict) -> dict:
+        sni = self._pick(self.sni_list) if self.sni_list else ""
+        req_host = self._pick(self.host_list) if self.host_list else ""
+
+        address = ""
+        if self.addresses:
+            address = self._pick(self.addresses)
+            if "{" in address:
+                address = address.format_map(format_variables)
+
+        if self.use_sni_as_host and sni:
+            req_host = sni
+
+        inbound = {
+            **self.inbound,
+            "sni": sni,
+            "host": req_host,
+            "path": self.path if self.path_static else self.path.format_map(format_variables),
+        }
+        if self.sids:
+            inbound["sid"] = random.choice(self.sids)
+
+        return {
+            "remark": self.remark if self.remark_static else self.remark.format_map(format_variables),
+            "address": address,
+            "inbound": inbound,
+        }
+
+
+class HostsPlan:
+    """Hosts of every inbound compiled for rendering, rebuilt when the core config or hosts change."""
+
+    def __init__(self, config, hosts: dict):
+        self.order = {tag: index for index, tag in enumerate(config.inbounds_by_tag.keys())}
+        self.networks = {}
+        self.hosts = {}
+        for tag, inbound in config.inbounds_by_tag.items():
+            self.networks[tag] = inbound["network"]
+            self.hosts[tag] = [HostPlan(inbound, host) for host in hosts.get(tag, [])]
+        # inbounds with a host rendered differently every time
+        self.randomized_tags = frozenset(
+            tag for tag, tag_hosts in self.hosts.items() if any(host.randomized for host in tag_hosts)
+        )
+
+
+_hosts_plan = None
+_hosts_plan_key = None
+
+
+def get_hosts_plan() -> HostsPlan:
+    global _hosts_plan, _hosts_plan_key
+
+    from app.subscription.cache import subscription_cache
+
+    if _hosts_plan_key is None \
+            or _hosts_plan_key[0] is not xray.config \
+            or _hosts_plan_key[1] != subscription_cache.version:
+        _hosts_plan = HostsPlan(xray.config, xray.hosts)
+        # building may have loaded the hosts, which bumps the version
+        _hosts_plan_key = (xray.config, subscription_cache.version)
+
+    return _hosts_plan
 
 
 def process_inbounds_and_tags(
@@ -243,82 +383,28 @@ def process_inbounds_and_tags(
         ],
         reverse=False,
 ) -> Union[List, str]:
-    _inbounds = []
-    for protocol, tags in inbounds.items():
-        for tag in tags:
-            _inbounds.append((protocol, [tag]))
-    index_dict = {proxy: index for index, proxy in enumerate(
-        xray.config.inbounds_by_tag.keys())}
+    plan = get_hosts_plan()
     inbounds = sorted(
-        _inbounds, key=lambda x: index_dict.get(x[1][0], float('inf')))
+        ((protocol, tag) for protocol, tags in inbounds.items() for tag in tags),
+        key=lambda x: plan.order.get(x[1], float('inf'))
+    )
 
-    for protocol, tags in inbounds:
+    dumped_settings = {}
+    for protocol, tag in inbounds:
         settings = proxies.get(protocol)
         if not settings:
             continue
 
-        format_variables.update({"PROTOCOL": protocol.name})
-        for tag in tags:
-            inbound = xray.config.inbounds_by_tag.get(tag)
-            if not inbound:
-                continue
-
-            format_variables.update({"TRANSPORT": inbound["network"]})
-            host_inbound = inbound.copy()
-            for host in xray.hosts.get(tag, []):
-                sni = ""
-                sni_list = host["sni"] or inbound["sni"]
-                if sni_list:
-                    salt = secrets.token_hex(8)
-                    sni = random.choice(sni_list).replace("*", salt)
-
-                if sids := inbound.get("sids"):
-                    inbound["sid"] = random.choice(sids)
-
-                req_host = ""
-                req_host_list = host["host"] or inbound["host"]
-                if req_host_list:
-                    salt = secrets.token_hex(8)
-                    req_host = random.choice(req_host_list).replace("*", salt)
-
-                address = ""
-                address_list = host['address']
-                if host['address']:
-                    salt = secrets.token_hex(8)
-                    address = random.choice(address_list).replace('*', salt)
-
-                if host["path"] is not None:
-                    path = host["path"].format_map(format_variables)
-                else:
-                    path = inbound.get("path", "").format_map(format_variables)
-
-                if host.get("use_sni_as_host", False) and sni:
-                    req_host = sni
-
-                host_inbound.update(
-                    {
-                        "port": host["port"] or inbound["port"],
-                        "sni": sni,
-                        "host": req_host,
-                        "tls": inbound["tls"] if host["tls"] is None else host["tls"],
-                        "alpn": host["alpn"] if host["alpn"] else None,
-                        "path": path,
-                        "fp": host["fingerprint"] or inbound.get("fp", ""),
-                        "ais": host["allowinsecure"]
-                        or inbound.get("allowinsecure", ""),
-                        "mux_enable": host["mux_enable"],
-                        "fragment_setting": host["fragment_setting"],
-                        "noise_setting": host["noise_setting"],
-                        "random_user_agent": host["random_user_agent"],
-                    }
-                )
-
-                conf.add(
-                    remark=host["remark"].format_map(format_variables),
-                    address=address.format_map(format_variables),
-                    inbound=host_inbound,
-                    settings=settings.model_dump()
-                )
+        hosts = plan.hosts.get(tag)
+        if hosts is None:
+            continue
+
+        if protocol not in dumped_settings:
+            dumped_settings[protocol] = settings.model_dump()
+
+        format_variables.update({"PROTOCOL": protocol.name, "TRANSPORT": plan.networks[tag]})
+        for host in hosts:
+            conf.add(**host.render(format_variables), settings=dumped_settings[protocol])
 
     return conf.render(reverse=reverse)
 
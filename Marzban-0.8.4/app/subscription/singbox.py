@@ -5,8 +5,8 @@ from random import choice
 from app.utils.helpers import UUIDEncoder
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.subscription.funcs import get_grpc_gun, parse_user_agents
+from app.templates import get_parsed_template
 from config import (
     MUX_TEMPLATE,
     SINGBOX_SETTINGS_TEMPLATE,
@@ -19,22 +19,15 @@ class SingBoxConfiguration(str):
 
     def __init__(self):
         self.proxy_remarks = []
-        self.config = json.loads(render_template(SINGBOX_SUBSCRIPTION_TEMPLATE))
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
-            self.user_agent_list = user_agent_data['list']
-        else:
-            self.user_agent_list = []
+        self.config = json.loads(get_parsed_template(SINGBOX_SUBSCRIPTION_TEMPLATE))
+        self.mux_settings = get_parsed_template(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = get_parsed_template(USER_AGENT_TEMPLATE, parse_user_agents)
 
         try:
-            self.settings = json.loads(render_template(SINGBOX_SETTINGS_TEMPLATE))
+            self.settings = get_parsed_template(SINGBOX_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data
-
     def _remark_validation(self, remark):
         if not remark in self.proxy_remarks:
             return remark
@@ -274,8 +267,7 @@ class SingBoxConfiguration(str):
                                             pbk=pbk, sid=sid, alpn=alpn,
                                             ais=ais)
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["sing-box"]
+        mux_config = copy.deepcopy(self.mux_settings["sing-box"])
 
         config['multiplex'] = mux_config
         if config['multiplex']["enabled"]:
@@ -9,8 +9,8 @@ from uuid import UUID
 
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun, get_grpc_multi
-from app.templates import render_template
+from app.subscription.funcs import get_grpc_gun, get_grpc_multi, parse_user_agents
+from app.templates import get_parsed_template
 from app.utils.helpers import UUIDEncoder
 from config import (
     EXTERNAL_CONFIG,
@@ -489,29 +489,16 @@ class V2rayJsonConfig(str):
 
     def __init__(self):
         self.config = []
-        self.template = render_template(V2RAY_SUBSCRIPTION_TEMPLATE)
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
-            self.user_agent_list = user_agent_data['list']
-        else:
-            self.user_agent_list = []
-
-        grpc_user_agent_data = json.loads(render_template(GRPC_USER_AGENT_TEMPLATE))
-
-        if 'list' in grpc_user_agent_data and isinstance(grpc_user_agent_data['list'], list):
-            self.grpc_user_agent_data = grpc_user_agent_data['list']
-        else:
-            self.grpc_user_agent_data = []
+        self.template = get_parsed_template(V2RAY_SUBSCRIPTION_TEMPLATE)
+        self.mux_settings = get_parsed_template(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = get_parsed_template(USER_AGENT_TEMPLATE, parse_user_agents)
+        self.grpc_user_agent_data = get_parsed_template(GRPC_USER_AGENT_TEMPLATE, parse_user_agents)
 
         try:
-            self.settings = json.loads(render_template(V2RAY_SETTINGS_TEMPLATE))
+            self.settings = get_parsed_template(V2RAY_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data, grpc_user_agent_data
-
     def add_config(self, remarks, outbounds):
         json_template = json.loads(self.template)
         json_template["remarks"] = remarks
@@ -708,9 +695,9 @@ class V2rayJsonConfig(str):
                 "header": {}
             }))
         else:
-            config = self.settings.get("httpSettings", {
+            config = copy.deepcopy(self.settings.get("httpSettings", {
                 "header": {}
-            })
+            }))
         if "header" not in config:
             config["header"] = {}
 
@@ -1072,8 +1059,7 @@ class V2rayJsonConfig(str):
             keepAlivePeriod=inbound.get("keepAlivePeriod", 0),
         )
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["v2ray"]
+        mux_config = copy.deepcopy(self.mux_settings["v2ray"])
 
         if inbound.get('mux_enable', False):
             outbound["mux"] = mux_config
@@ -1,7 +1,7 @@
 import importlib.util
 from os.path import dirname
 from threading import Thread
-from config import TELEGRAM_API_TOKEN, TELEGRAM_PROXY_URL
+from config import API_WORKER, TELEGRAM_API_TOKEN, TELEGRAM_PROXY_URL
 from app import app
 from telebot import TeleBot, apihelper
 
@@ -15,7 +15,8 @@ handler_names = ["admin", "report", "user"]
 
 @app.on_event("startup")
 def start_bot():
-    if bot:
+    # only the controller process polls, the API workers just send reports
+    if bot and not API_WORKER:
         handler_dir = dirname(__file__) + "/handlers/"
         for name in handler_names:
             spec = importlib.util.spec_from_file_location(name, f"{handler_dir}{name}.py")
@@ -1,5 +1,6 @@
+import os
 from datetime import datetime
-from typing import Union
+from typing import Callable, Optional, TypeVar, Union
 
 import jinja2
 
@@ -7,15 +8,70 @@ from config import CUSTOM_TEMPLATES_DIRECTORY
 
 from .filters import CUSTOM_FILTERS
 
+T = TypeVar("T")
+
 template_directories = ["app/templates"]
 if CUSTOM_TEMPLATES_DIRECTORY:
     # User's templates have priority over default templates
     template_directories.insert(0, CUSTOM_TEMPLATES_DIRECTORY)
 
-env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_directories))
+env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(template_directories),
+    bytecode_cache=jinja2.FileSystemBytecodeCache()
+)
 env.filters.update(CUSTOM_FILTERS)
 env.globals['now'] = datetime.utcnow
 
+# template -> mtime of the custom directory it'd be overridden in
+_custom_directory_mtimes = {}
+# (template, parser) -> (jinja template, parsed value)
+_parsed_templates = {}
+
 
 def render_template(template: str, context: Union[dict, None] = None) -> str:
-    return env.get_template(template).render(context or {})
+    return get_template(template).render(context or {})
+
+
+def _custom_directory_mtime(template: str) -> Optional[float]:
+    """mtime of the custom directory the template would be overridden in, changes when one is added or removed."""
+    if not CUSTOM_TEMPLATES_DIRECTORY:
+        return None
+    try:
+        return os.stat(os.path.join(CUSTOM_TEMPLATES_DIRECTORY, os.path.dirname(template))).st_mtime
+    except OSError:
+        return None
+
+
+def get_template(template: str) -> jinja2.Template:
+    """
+    Loads a template, the same object is returned until its file changes or a template
+    overriding it is added to (or removed from) CUSTOM_TEMPLATES_DIRECTORY.
+    """
+    mtime = _custom_directory_mtime(template)
+    if _custom_directory_mtimes.get(template, mtime) != mtime:
+        # jinja only checks the file it loaded the template from
+        env.cache.clear()
+    _custom_directory_mtimes[template] = mtime
+
+    return env.get_template(template)
+
+
+def get_parsed_template(template: str, parser: Callable[[str], T] = None) -> Union[T, str]:
+    """
+    Renders a template without context and parses it with `parser`, only once.
+
+    It's rendered again whenever get_template() loads it again. The value is shared by
+    every caller, so it must not be modified, copy the parts that are.
+    """
+    key = (template, parser)
+    jinja_template = get_template(template)
+    cached = _parsed_templates.get(key)
+    if cached is not None and cached[0] is jinja_template:
+        return cached[1]
+
+    value = jinja_template.render()
+    if parser is not None:
+        value = parser(value)
+
+    _parsed_templates[key] = (jinja_template, value)
+    return value
@@ -1,8 +1,16 @@
-from threading import Thread
+import asyncio
+from concurrent.futures import Executor
+from threading import Lock, Thread
+from typing import Awaitable, TypeVar
 
 import anyio
 from fastapi import BackgroundTasks
 
+T = TypeVar("T")
+
+_loop = None
+_loop_lock = Lock()
+
 
 def threaded_function(func):
     def wrapper(*args, **kwargs):
@@ -11,6 +19,31 @@ def threaded_function(func):
     return wrapper
 
 
+def pooled_function(executor: Executor):
+    """Like threaded_function, but runs the calls on `executor`, bounding how many run at once."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            return executor.submit(func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_coroutine(coro: Awaitable[T]) -> T:
+    """
+    Runs a coroutine on the shared background event loop and waits for its result.
+
+    Lets sync code (jobs, threads) use async clients whose channels are bound to one loop.
+    """
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, daemon=True).start()
+
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
 class GetBG:
     """
     context manager for fastapi.BackgroundTasks
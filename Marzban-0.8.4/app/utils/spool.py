@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+from threading import Lock
+from typing import List, NamedTuple, Optional
+
+
+class SpoolBatch(NamedTuple):
+    # digest of the pending journal, the same every time it's taken again
+    id: str
+    records: List[dict]
+
+
+class Spool:
+    """
+    Append-only, fsync'ed journal of JSON records.
+
+    Records are appended to `path`. Draining is two-phased: `take` moves the journal
+    aside to `<path>.pending` and returns its records, and `commit` deletes it once they
+    have been stored elsewhere. A pending journal left by a failed flush or a crash is
+    returned again by the next `take`, so records are delivered at least once; the batch's
+    id lets consumers recognize one they already stored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending_path = f"{path}.pending"
+        self._lock = Lock()
+        # created on the first append, so merely importing the jobs doesn't need write access to it
+        self._directory_ready = False
+
+        # terminate a record torn by a crash so it doesn't swallow the next one
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+
+    def append(self, record: dict):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            if not self._directory_ready:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._directory_ready = True
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def take(self) -> Optional[SpoolBatch]:
+        with self._lock:
+            if not os.path.exists(self.pending_path):
+                if not os.path.exists(self.path) or not os.path.getsize(self.path):
+                    return None
+                os.replace(self.path, self.pending_path)
+
+        with open(self.pending_path, 'rb') as f:
+            data = f.read()
+        return SpoolBatch(hashlib.sha256(data).hexdigest(), self._parse(data))
+
+    def commit(self):
+        with self._lock:
+            try:
+                os.remove(self.pending_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _parse(data: bytes) -> List[dict]:
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:  # torn write of the last record
+                continue
+        return records
@@ -1,32 +1,45 @@
 from random import randint
-from typing import TYPE_CHECKING, Dict, Sequence
+from typing import TYPE_CHECKING, Dict, Optional, Sequence
 
 from app.models.proxy import ProxyHostSecurity
 from app.utils.store import DictStorage
 from app.utils.system import check_port
-from app.xray import operations
 from app.xray.config import XRayConfig
 from app.xray.core import XRayCore
 from app.xray.node import XRayNode
-from config import XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH, XRAY_JSON
+from config import API_WORKER, XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH, XRAY_JSON
 from xray_api import XRay as XRayAPI
 from xray_api import exceptions, types
 from xray_api import exceptions as exc
 
-core = XRayCore(XRAY_EXECUTABLE_PATH, XRAY_ASSETS_PATH)
+api: Optional[XRayAPI] = None
 
-# Search for a free API port
-try:
-    for api_port in range(randint(10000, 60000), 65536):
-        if not check_port(api_port):
-            break
-finally:
-    config = XRayConfig(XRAY_JSON, api_port=api_port)
-    del api_port
+if API_WORKER:
+    # the core and the nodes are run by the controller process, the workers
+    # only read the inbounds of the config, see app.xray.remote
+    from app.xray import remote
 
-api = XRayAPI(config.api_host, config.api_port)
+    core = remote.core
+    nodes = remote.nodes
+    operations = remote.operations
+    reconcile = remote.reconcile
+    config = XRayConfig(XRAY_JSON)
+else:
+    from app.xray import operations, reconcile
 
-nodes: Dict[int, XRayNode] = {}
+    core = XRayCore(XRAY_EXECUTABLE_PATH, XRAY_ASSETS_PATH)
+    nodes: Dict[int, XRayNode] = {}
+
+    # Search for a free API port
+    try:
+        for api_port in range(randint(10000, 60000), 65536):
+            if not check_port(api_port):
+                break
+    finally:
+        config = XRayConfig(XRAY_JSON, api_port=api_port)
+        del api_port
+
+    api = XRayAPI(config.api_host, config.api_port)
 
 
 if TYPE_CHECKING:
@@ -36,8 +49,10 @@ if TYPE_CHECKING:
 @DictStorage
 def hosts(storage: dict):
     from app.db import GetDB, crud
+    from app.subscription.cache import subscription_cache
 
     storage.clear()
+    subscription_cache.bump()
     with GetDB() as db:
         for inbound_tag in config.inbounds_by_tag:
             inbound_hosts: Sequence[ProxyHost] = crud.get_hosts(db, inbound_tag)
@@ -74,6 +89,7 @@ __all__ = [
     "api",
     "nodes",
     "operations",
+    "reconcile",
     "exceptions",
     "exc",
     "types",
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
 import json
-from collections import defaultdict
+import time
 from copy import deepcopy
+from itertools import groupby
+from operator import itemgetter
 from pathlib import PosixPath
-from typing import Union
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
 
 import commentjson
-from sqlalchemy import func
 
+from app import logger
 from app.db import GetDB
 from app.db import models as db_models
 from app.models.proxy import ProxyTypes
@@ -16,6 +19,9 @@ from app.models.user import UserStatus
 from app.utils.crypto import get_cert_SANs
 from config import DEBUG, XRAY_EXCLUDE_INBOUND_TAGS, XRAY_FALLBACKS_INBOUND_TAG
 
+if TYPE_CHECKING:
+    from app.db.models import User as DBUser
+
 
 def merge_dicts(a, b):  # B will override A dictionary key and values
     for key, value in b.items():
@@ -26,6 +32,122 @@ def merge_dicts(a, b):  # B will override A dictionary key and values
     return a
 
 
+class UsersClients:
+    """
+    The clients of the active and on-hold users, by inbound tag and user id.
+
+    They're streamed from the database once, on the first include_db_users() of the config,
+    then the users added, modified or removed by app.xray.operations (and reconcile) are
+    patched in, so the cores can be restarted without querying every user again. A new
+    config (a core config change) starts over with a full load.
+
+    Client dicts are shared between the inbounds (and configs) they're in, so they must
+    not be modified.
+    """
+
+    def __init__(self, config: XRayConfig):
+        self._config = config
+        # inbound tag -> user id -> client
+        self._clients: Optional[Dict[str, Dict[int, dict]]] = None
+        self._lock = Lock()
+
+    def __deepcopy__(self, memo):
+        # copies of the config get their own, generated when needed
+        return UsersClients(memo.get(id(self._config), self._config))
+
+    def _user_clients(self, user_id: int, username: str,
+                      proxies: Iterable[Tuple[ProxyTypes, dict, List[str]]]) -> Dict[str, dict]:
+        """The clients of a user by inbound tag, from its proxies' (type, settings, excluded inbound tags)."""
+        clients = {}
+        for proxy_type, settings, excluded_tags in proxies:
+            client = {"email": f"{user_id}.{username}", **settings}
+            flowless = None
+
+            for inbound in self._config.inbounds_by_protocol.get(proxy_type, []):
+                if inbound['tag'] in excluded_tags:
+                    continue
+
+                if client.get('flow') and not XRayConfig.supports_xtls(inbound):
+                    if flowless is None:
+                        flowless = {key: value for key, value in client.items() if key != 'flow'}
+                    clients[inbound['tag']] = flowless
+                else:
+                    clients[inbound['tag']] = client
+
+        return clients
+
+    def _load(self) -> Dict[str, Dict[int, dict]]:
+        all_clients = {tag: {} for tag in self._config.inbounds_by_tag}
+
+        with GetDB() as db:
+            rows = db.query(
+                db_models.User.id,
+                db_models.User.username,
+                db_models.Proxy.id,
+                db_models.Proxy.type,
+                db_models.Proxy.settings,
+                db_models.excluded_inbounds_association.c.inbound_tag
+            ).join(
+                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
+            ).outerjoin(
+                db_models.excluded_inbounds_association,
+                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
+            ).filter(
+                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
+            ).order_by(
+                db_models.Proxy.id
+            ).yield_per(1000)
+
+            # one row per excluded inbound of each proxy
+            for _, proxy_rows in groupby(rows, key=itemgetter(2)):
+                proxy_rows = list(proxy_rows)
+                user_id, username, _, proxy_type, settings, _ = proxy_rows[0]
+                excluded_tags = [row[5] for row in proxy_rows if row[5]]
+
+                for tag, client in self._user_clients(
+                        user_id, username, [(proxy_type, settings, excluded_tags)]).items():
+                    all_clients[tag][user_id] = client
+
+        return all_clients
+
+    def query(self) -> Dict[str, Dict[int, dict]]:
+        """The clients by inbound tag and user id, straight from the database. The loaded ones are left as they are."""
+        return self._load()
+
+    def get(self, rebuild: bool = False) -> Dict[str, List[dict]]:
+        """The clients by inbound tag, loaded from the database the first time or when `rebuild`."""
+        with self._lock:
+            if rebuild or self._clients is None:
+                self._clients = self._load()
+            return {tag: list(clients.values()) for tag, clients in self._clients.items()}
+
+    def update_user(self, dbuser: "DBUser"):
+        """Patches in the current clients of a user, removing them if they're not active or on hold."""
+        clients = {}
+        if dbuser.status in (UserStatus.active, UserStatus.on_hold):
+            clients = self._user_clients(dbuser.id, dbuser.username, [
+                (proxy.type, proxy.settings, [inbound.tag for inbound in proxy.excluded_inbounds])
+                for proxy in dbuser.proxies
+            ])
+
+        with self._lock:
+            if self._clients is None:
+                return
+            for tag, inbound_clients in self._clients.items():
+                client = clients.get(tag)
+                if client is None:
+                    inbound_clients.pop(dbuser.id, None)
+                else:
+                    inbound_clients[dbuser.id] = client
+
+    def remove_user(self, user_id: int):
+        with self._lock:
+            if self._clients is None:
+                return
+            for inbound_clients in self._clients.values():
+                inbound_clients.pop(user_id, None)
+
+
 class XRayConfig(dict):
     def __init__(self,
                  config: Union[dict, str, PosixPath] = {},
@@ -58,6 +180,7 @@ class XRayConfig(dict):
         self.inbounds_by_tag = {}
         self._fallbacks_inbound = self.get_inbound(XRAY_FALLBACKS_INBOUND_TAG)
         self._resolve_inbounds()
+        self.users_clients = UsersClients(self)
 
         self._apply_api()
 
@@ -342,6 +465,21 @@ class XRayConfig(dict):
             except KeyError:
                 self.inbounds_by_protocol[inbound['protocol']] = [settings]
 
+    @staticmethod
+    def supports_xtls(inbound: dict) -> bool:
+        """XTLS currently only supports transmission methods of TCP and mKCP"""
+        return not (
+            inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
+            or
+            (
+                inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
+                and
+                inbound.get('tls') not in ('tls', 'reality')
+            )
+            or
+            inbound.get('header_type') == 'http'
+        )
+
     def get_inbound(self, tag) -> dict:
         for inbound in self['inbounds']:
             if inbound['tag'] == tag:
@@ -356,81 +494,66 @@ class XRayConfig(dict):
         return json.dumps(self, **json_kwargs)
 
     def copy(self):
+        """Deep copy of the config, without the users' clients."""
         return deepcopy(self)
 
-    def include_db_users(self) -> XRayConfig:
-        config = self.copy()
+    def include_db_users(self, rebuild: bool = False) -> XRayConfig:
+        """
+        A copy of the config with the active and on-hold users added to the inbounds' clients.
 
-        with GetDB() as db:
-            query = db.query(
-                db_models.User.id,
-                db_models.User.username,
-                func.lower(db_models.Proxy.type).label('type'),
-                db_models.Proxy.settings,
-                func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
-            ).join(
-                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
-            ).outerjoin(
-                db_models.excluded_inbounds_association,
-                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
-            ).filter(
-                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
-            ).group_by(
-                func.lower(db_models.Proxy.type),
-                db_models.User.id,
-                db_models.User.username,
-                db_models.Proxy.settings,
-            )
-            result = query.all()
-
-            grouped_data = defaultdict(list)
-
-            for row in result:
-                grouped_data[row.type].append((
-                    row.id,
-                    row.username,
-                    row.settings,
-                    [i for i in row.excluded_inbound_tags.split(',') if i] if row.excluded_inbound_tags else None
-                ))
-
-            for proxy_type, rows in grouped_data.items():
-
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
-                if not inbounds:
-                    continue
-
-                for inbound in inbounds:
-                    clients = config.get_inbound(inbound['tag'])['settings']['clients']
-
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
-                            continue
-
-                        client = {
-                            "email": f"{user_id}.{username}",
-                            **settings
-                        }
+        The clients are generated once and then patched as users are added, modified or
+        removed (see UsersClients), `rebuild` generates them again from the database.
+        """
+        start_time = time.time()
+        config = self.copy()
 
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get('flow') and (
-                                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
-                                or
-                                (
-                                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
-                                    and
-                                    inbound.get('tls') not in ('tls', 'reality')
-                                )
-                                or
-                                inbound.get('header_type') == 'http'
-                        ):
-                            del client['flow']
+        inbounds = {inbound['tag']: inbound for inbound in config['inbounds']}
+        for tag, clients in self.users_clients.get(rebuild).items():
+            inbounds[tag]['settings']['clients'].extend(clients)
 
-                        clients.append(client)
+        logger.info(f"Xray core config generated in {(time.time() - start_time):.2f} seconds")
 
         if DEBUG:
             with open('generated_config-debug.json', 'w') as f:
                 f.write(config.to_json(indent=4))
 
         return config
+
+
+class ConfigDiff:
+    """
+    The differences between a running core config and a new one.
+
+    Inbounds and outbounds added, removed or modified can be swapped on the running cores
+    through the HandlerService (see app.xray.handlers), everything else (log, api, routing,
+    dns, policy...) or a new default (first) outbound needs the cores restarted, which
+    `restart_reasons` lists. Modified handlers are both in the removed tags and the added ones.
+    """
+
+    def __init__(self, old: XRayConfig, new: XRayConfig):
+        self.restart_reasons: List[str] = [
+            key for key in sorted(set(old) | set(new), key=str)
+            if key not in ("inbounds", "outbounds") and old.get(key) != new.get(key)
+        ]
+        self.removed_inbounds, self.added_inbounds = self._diff_handlers(old, new, "inbounds")
+        self.removed_outbounds, self.added_outbounds = self._diff_handlers(old, new, "outbounds")
+
+        if old["outbounds"][0] != new["outbounds"][0]:
+            self.restart_reasons.append("default outbound")
+
+    def _diff_handlers(self, old: XRayConfig, new: XRayConfig, key: str) -> Tuple[List[str], List[dict]]:
+        old_handlers = {handler["tag"]: handler for handler in old[key]}
+        new_handlers = {handler["tag"]: handler for handler in new[key]}
+        if len(old_handlers) < len(old[key]) or len(new_handlers) < len(new[key]):
+            # handlers sharing a tag can't be told apart
+            if old[key] != new[key]:
+                self.restart_reasons.append(key)
+            return [], []
+
+        removed = [tag for tag, handler in old_handlers.items() if new_handlers.get(tag) != handler]
+        added = [handler for tag, handler in new_handlers.items() if old_handlers.get(tag) != handler]
+        return removed, added
+
+    def __bool__(self):
+        return bool(self.restart_reasons or self.removed_inbounds or self.added_inbounds
+                    or self.removed_outbounds or self.added_outbounds)
@@ -0,0 +1,169 @@
+"""
+Controller process of the multi-worker mode (UVICORN_WORKERS > 1).
+
+The process running main.py keeps the scheduler jobs, the main core and the nodes, and
+runs the xray operations of the API workers, which reach it on CONTROLLER_SOCKET (see
+app.xray.remote). Whenever the hosts or the core config change, it tells every worker
+to reload them, which also invalidates the caches depending on them.
+"""
+
+import os
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+from typing import Callable, Dict, Optional
+
+import rpyc
+from rpyc.utils.server import ThreadedServer
+
+from app import logger, xray
+from app.db import GetDB, crud
+from app.db.quotas import user_quotas
+from app.xray.config import XRayConfig
+from config import CONTROLLER_SOCKET, XRAY_JSON
+
+# connection -> the worker's reload callback
+_subscribers: Dict[rpyc.Connection, Callable[[str], None]] = {}
+_subscribers_lock = Lock()
+
+
+def reload(what: str):
+    """Reloads the hosts ("hosts") or the core config and the hosts ("config") of this process."""
+    if what == "config":
+        xray.config = XRayConfig(XRAY_JSON, api_port=xray.config.api_port)
+    xray.hosts.update()
+
+
+def broadcast(what: str, exclude: rpyc.Connection = None):
+    """Tells every API worker (but `exclude`) to reload(what)."""
+    with _subscribers_lock:
+        subscribers = [(conn, callback) for conn, callback in _subscribers.items() if conn is not exclude]
+
+    for conn, callback in subscribers:
+        try:
+            rpyc.async_(callback)(what)
+        except Exception:
+            with _subscribers_lock:
+                _subscribers.pop(conn, None)
+
+
+class LogsWatcher:
+    """Passes the logs of the main core (or of a node) to a worker's callback until it's stopped."""
+
+    def __init__(self, node_id: Optional[int], callback: Callable[[str], None]):
+        self._stopped = Event()
+        Thread(target=self._watch, args=(node_id, callback), daemon=True).start()
+
+    def _watch(self, node_id: Optional[int], callback: Callable[[str], None]):
+        target = xray.core if node_id is None else xray.nodes.get(node_id)
+        if target is None:
+            return
+
+        try:
+            with target.get_logs() as logs:
+                while not self._stopped.is_set():
+                    if not logs:
+                        self._stopped.wait(0.2)
+                        continue
+                    callback(logs.popleft())
+        except Exception:
+            # the worker or the node disconnected
+            pass
+
+    def exposed_stop(self):
+        self._stopped.set()
+
+
+class ControllerService(rpyc.Service):
+    def on_connect(self, conn):
+        self._conn = conn
+
+    def on_disconnect(self, conn):
+        with _subscribers_lock:
+            _subscribers.pop(conn, None)
+
+    def exposed_subscribe(self, callback: Callable[[str], None]):
+        with _subscribers_lock:
+            _subscribers[self._conn] = callback
+
+    def exposed_invalidate(self, what: str):
+        reload(what)
+        broadcast(what, exclude=self._conn)
+
+    def exposed_add_user(self, user_id: int):
+        with GetDB() as db:
+            dbuser = crud.get_user_by_id(db, user_id)
+            if dbuser:
+                # the worker changed it, in its own process
+                user_quotas.set_user(dbuser)
+                xray.operations.add_user(dbuser)
+
+    def exposed_update_user(self, user_id: int):
+        with GetDB() as db:
+            dbuser = crud.get_user_by_id(db, user_id)
+            if dbuser:
+                # the worker changed it, in its own process
+                user_quotas.set_user(dbuser)
+                xray.operations.update_user(dbuser)
+
+    def exposed_remove_user(self, user_id: int, username: str):
+        # the user is already removed from the database
+        xray.operations.remove_user(SimpleNamespace(id=user_id, username=username))
+
+    def exposed_connect_node(self, node_id: int):
+        xray.operations.connect_node(node_id)
+
+    def exposed_restart_node(self, node_id: int, force: bool = False):
+        xray.operations.restart_node(node_id, force=force)
+
+    def exposed_remove_node(self, node_id: int):
+        xray.operations.remove_node(node_id)
+
+    def exposed_reconcile_users(self, user_ids: tuple):
+        xray.reconcile.reconcile_users(user_ids)
+
+    def exposed_restart_all(self, force: bool = False):
+        xray.reconcile.restart_all(force=force)
+
+    def exposed_apply_config(self):
+        # the worker already wrote it to XRAY_JSON
+        xray.operations.apply_config(XRayConfig(XRAY_JSON, api_port=xray.config.api_port))
+
+    def exposed_core_status(self) -> tuple:
+        return xray.core.version, xray.core.started
+
+    def exposed_node_key(self, node_id: int) -> Optional[int]:
+        """Identifies the node's current connection, it changes when the node is added again."""
+        node = xray.nodes.get(node_id)
+        return id(node) if node else None
+
+    def exposed_node_connected(self, node_id: int) -> bool:
+        node = xray.nodes.get(node_id)
+        return bool(node and node.connected)
+
+    def exposed_queue_stats(self) -> tuple:
+        return tuple(tuple(stats.items()) for stats in xray.operations.get_queue_stats())
+
+    def exposed_fetch_logs(self, node_id: Optional[int], callback: Callable[[str], None]) -> LogsWatcher:
+        return LogsWatcher(node_id, callback)
+
+
+def serve() -> ThreadedServer:
+    """Starts serving the API workers on CONTROLLER_SOCKET, in a background thread."""
+    if os.path.exists(CONTROLLER_SOCKET):
+        os.remove(CONTROLLER_SOCKET)
+
+    server = ThreadedServer(ControllerService, socket_path=CONTROLLER_SOCKET, logger=logger,
+                            protocol_config={"sync_request_timeout": 300})
+    # anyone able to connect could control the cores
+    os.chmod(CONTROLLER_SOCKET, 0o600)
+
+    Thread(target=server.start, daemon=True).start()
+    logger.info(f"Controller listening on {CONTROLLER_SOCKET}")
+    return server
+
+
+__all__ = [
+    "reload",
+    "broadcast",
+    "serve",
+]
@@ -0,0 +1,390 @@
+"""
+Inbounds and outbounds of the core config as HandlerService messages, so a config change
+can swap them on the running cores instead of restarting them (see app.xray.config.ConfigDiff).
+
+Only the settings Marzban's configs commonly use are converted, anything else raises a
+ValueError and the cores are restarted with the new config instead.
+"""
+
+import base64
+import ipaddress
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set
+
+from app.models.proxy import ProxyTypes
+from xray_api.exceptions import TagNotFoundError
+from xray_api.proto.app.proxyman import config_pb2 as proxyman_pb2
+from xray_api.proto.common.net import address_pb2, network_pb2, port_pb2
+from xray_api.proto.common.protocol import user_pb2
+from xray_api.proto.core import config_pb2 as core_pb2
+from xray_api.proto.proxy.blackhole import config_pb2 as blackhole_pb2
+from xray_api.proto.proxy.freedom import config_pb2 as freedom_pb2
+from xray_api.proto.proxy.shadowsocks import config_pb2 as shadowsocks_pb2
+from xray_api.proto.proxy.trojan import config_pb2 as trojan_pb2
+from xray_api.proto.proxy.vless.inbound import config_pb2 as vless_pb2
+from xray_api.proto.proxy.vmess.inbound import config_pb2 as vmess_pb2
+from xray_api.proto.transport.internet import config_pb2 as internet_pb2
+from xray_api.proto.transport.internet.grpc import config_pb2 as grpc_pb2
+from xray_api.proto.transport.internet.httpupgrade import config_pb2 as httpupgrade_pb2
+from xray_api.proto.transport.internet.reality import config_pb2 as reality_pb2
+from xray_api.proto.transport.internet.tcp import config_pb2 as tcp_pb2
+from xray_api.proto.transport.internet.tls import config_pb2 as tls_pb2
+from xray_api.proto.transport.internet.websocket import config_pb2 as websocket_pb2
+from xray_api.types.message import Message
+
+if TYPE_CHECKING:
+    from app.xray.config import ConfigDiff
+    from xray_api import XRay as XRayAPI
+
+FREEDOM_DOMAIN_STRATEGIES = {
+    "AsIs": freedom_pb2.Config.AS_IS,
+    "UseIP": freedom_pb2.Config.USE_IP,
+    "UseIPv4": freedom_pb2.Config.USE_IP4,
+    "UseIPv6": freedom_pb2.Config.USE_IP6,
+    "UseIPv4v6": freedom_pb2.Config.USE_IP46,
+    "UseIPv6v4": freedom_pb2.Config.USE_IP64,
+    "ForceIP": freedom_pb2.Config.FORCE_IP,
+    "ForceIPv4": freedom_pb2.Config.FORCE_IP4,
+    "ForceIPv6": freedom_pb2.Config.FORCE_IP6,
+    "ForceIPv4v6": freedom_pb2.Config.FORCE_IP46,
+    "ForceIPv6v4": freedom_pb2.Config.FORCE_IP64,
+}
+
+CERTIFICATE_USAGES = {
+    "encipherment": tls_pb2.Certificate.ENCIPHERMENT,
+    "verify": tls_pb2.Certificate.AUTHORITY_VERIFY,
+    "issue": tls_pb2.Certificate.AUTHORITY_ISSUE,
+}
+
+
+def _check_keys(name: str, settings: dict, supported: Iterable[str]):
+    unsupported = set(settings) - set(supported)
+    if unsupported:
+        raise ValueError(f"{name} {', '.join(sorted(unsupported))} can't be applied live")
+
+
+def _address(address: str) -> address_pb2.IPOrDomain:
+    if not isinstance(address, str) or address.startswith(('/', '@')):
+        raise ValueError(f"listening on {address} can't be applied live")
+    try:
+        return address_pb2.IPOrDomain(ip=ipaddress.ip_address(address).packed)
+    except ValueError:
+        return address_pb2.IPOrDomain(domain=address)
+
+
+def _port_list(port) -> port_pb2.PortList:
+    ranges = []
+    for part in str(port).split(','):
+        start, _, end = part.strip().partition('-')
+        ranges.append(port_pb2.PortRange(From=int(start), To=int(end or start)))
+    return port_pb2.PortList(range=ranges)
+
+
+def _pem(certificate: dict, key: str) -> bytes:
+    """A certificate's (or key's) PEM, read from its file or joined from its lines."""
+    path = certificate.get(f"{key}File")
+    if path:
+        with open(path, 'rb') as file:
+            return file.read()
+    return "\n".join(certificate.get(key, [])).encode()
+
+
+def _version(version: str) -> bytes:
+    return bytes(int(part) for part in version.split('.')).ljust(3, b'\0')
+
+
+def _tls(settings: dict) -> tls_pb2.Config:
+    _check_keys("tlsSettings", settings, (
+        "serverName", "alpn", "certificates", "minVersion", "maxVersion", "cipherSuites", "rejectUnknownSni"
+    ))
+
+    certificates = []
+    for certificate in settings.get("certificates", []):
+        _check_keys("certificate", certificate, (
+            "certificateFile", "keyFile", "certificate", "key", "usage", "ocspStapling", "oneTimeLoading"
+        ))
+        certificates.append(tls_pb2.Certificate(
+            certificate=_pem(certificate, "certificate"),
+            key=_pem(certificate, "key"),
+            usage=CERTIFICATE_USAGES[certificate.get("usage", "encipherment")],
+            ocsp_stapling=certificate.get("ocspStapling", 3600),
+            One_time_loading=certificate.get("oneTimeLoading", False),
+        ))
+
+    return tls_pb2.Config(
+        certificate=certificates,
+        server_name=settings.get("serverName", ""),
+        next_protocol=settings.get("alpn", []),
+        min_version=settings.get("minVersion", ""),
+        max_version=settings.get("maxVersion", ""),
+        cipher_suites=settings.get("cipherSuites", ""),
+        reject_unknown_sni=settings.get("rejectUnknownSni", False),
+    )
+
+
+def _reality(settings: dict) -> reality_pb2.Config:
+    _check_keys("realitySettings", settings, (
+        "show", "dest", "target", "xver", "serverNames", "privateKey",
+        "minClientVer", "maxClientVer", "maxTimeDiff", "shortIds"
+    ))
+
+    dest = str(settings.get("target", settings.get("dest", "")))
+    if dest.isdigit():
+        dest = f"127.0.0.1:{dest}"
+    if dest.startswith(('/', '@')):
+        raise ValueError(f"reality dest {dest} can't be applied live")
+
+    private_key = settings.get("privateKey", "")
+    private_key = base64.urlsafe_b64decode(private_key + '=' * (-len(private_key) % 4))
+    if len(private_key) != 32:
+        raise ValueError("invalid reality private key")
+
+    return reality_pb2.Config(
+        show=settings.get("show", False),
+        dest=dest,
+        type="tcp",
+        xver=settings.get("xver", 0),
+        server_names=settings.get("serverNames", []),
+        private_key=private_key,
+        min_client_ver=_version(settings["minClientVer"]) if settings.get("minClientVer") else b'',
+        max_client_ver=_version(settings["maxClientVer"]) if settings.get("maxClientVer") else b'',
+        max_time_diff=settings.get("maxTimeDiff", 0),
+        # xray decodes them into 8 bytes long buffers
+        short_ids=[bytes.fromhex(short_id).ljust(8, b'\0') for short_id in settings.get("shortIds", [])],
+    )
+
+
+def _http_like(name: str, settings: dict) -> dict:
+    """Settings shared by the websocket and httpupgrade transports."""
+    _check_keys(name, settings, ("path", "host", "headers", "acceptProxyProtocol"))
+    path = settings.get("path", "")
+    if '?' in path:
+        # e.g. early data
+        raise ValueError(f"{name} path {path} can't be applied live")
+
+    headers = dict(settings.get("headers", {}))
+    host = settings.get("host") or headers.pop("Host", "")
+    return dict(host=host, path=path, header=headers,
+                accept_proxy_protocol=settings.get("acceptProxyProtocol", False))
+
+
+def _stream(stream: dict) -> internet_pb2.StreamConfig:
+    network = stream.get("network", "tcp")
+    security = stream.get("security", "none")
+
+    if network in ("tcp", "raw"):
+        name = "rawSettings" if "rawSettings" in stream else "tcpSettings"
+        settings = stream.get(name, {})
+        _check_keys(name, settings, ("header", "acceptProxyProtocol"))
+        if settings.get("header", {}).get("type", "none") != "none":
+            raise ValueError(f"{name} header can't be applied live")
+        protocol_name = "tcp"
+        transport = tcp_pb2.Config(accept_proxy_protocol=settings.get("acceptProxyProtocol", False))
+
+    elif network in ("ws", "websocket"):
+        name = "wsSettings"
+        protocol_name = "websocket"
+        transport = websocket_pb2.Config(**_http_like(name, stream.get(name, {})))
+
+    elif network == "httpupgrade":
+        name = "httpupgradeSettings"
+        protocol_name = "httpupgrade"
+        transport = httpupgrade_pb2.Config(**_http_like(name, stream.get(name, {})))
+
+    elif network in ("grpc", "gun"):
+        name = "grpcSettings"
+        settings = stream.get(name, {})
+        _check_keys(name, settings, (
+            "serviceName", "multiMode", "authority", "idle_timeout", "health_check_timeout",
+            "permit_without_stream", "initial_windows_size", "user_agent"
+        ))
+        protocol_name = "grpc"
+        transport = grpc_pb2.Config(
+            service_name=settings.get("serviceName", ""),
+            multi_mode=settings.get("multiMode", False),
+            authority=settings.get("authority", ""),
+            idle_timeout=settings.get("idle_timeout", 0),
+            health_check_timeout=settings.get("health_check_timeout", 0),
+            permit_without_stream=settings.get("permit_without_stream", False),
+            initial_windows_size=settings.get("initial_windows_size", 0),
+            user_agent=settings.get("user_agent", ""),
+        )
+
+    else:
+        raise ValueError(f"{network} transport can't be applied live")
+
+    _check_keys("streamSettings", stream, ("network", "security", name, "tlsSettings", "realitySettings"))
+
+    security_settings = []
+    if security == "tls":
+        security_settings.append(Message(_tls(stream.get("tlsSettings", {}))))
+    elif security == "reality":
+        security_settings.append(Message(_reality(stream.get("realitySettings", {}))))
+    elif security not in ("none", ""):
+        raise ValueError(f"{security} security can't be applied live")
+
+    return internet_pb2.StreamConfig(
+        protocol_name=protocol_name,
+        transport_settings=[internet_pb2.TransportConfig(protocol_name=protocol_name, settings=Message(transport))],
+        security_type=security_settings[0].type if security_settings else "",
+        security_settings=security_settings,
+    )
+
+
+def _sniffing(sniffing: dict) -> proxyman_pb2.SniffingConfig:
+    _check_keys("sniffing", sniffing, ("enabled", "destOverride", "domainsExcluded", "metadataOnly", "routeOnly"))
+    return proxyman_pb2.SniffingConfig(
+        enabled=sniffing.get("enabled", False),
+        destination_override=sniffing.get("destOverride", []),
+        domains_excluded=sniffing.get("domainsExcluded", []),
+        metadata_only=sniffing.get("metadataOnly", False),
+        route_only=sniffing.get("routeOnly", False),
+    )
+
+
+def _users(proxy_type: ProxyTypes, clients: Iterable[dict]) -> List[user_pb2.User]:
+    users = []
+    for client in clients:
+        account = proxy_type.account_model(**client)
+        users.append(user_pb2.User(level=account.level, email=account.email, account=account.message))
+    return users
+
+
+def _fallbacks(fallbacks: List[dict], model) -> list:
+    result = []
+    for fallback in fallbacks:
+        _check_keys("fallback", fallback, ("name", "alpn", "path", "type", "dest", "xver"))
+        dest = str(fallback.get("dest", ""))
+        if dest.isdigit():
+            dest = f"localhost:{dest}"
+        if dest.startswith(('/', '@')):
+            raise ValueError(f"fallback to {dest} can't be applied live")
+        result.append(model(
+            name=fallback.get("name", ""),
+            alpn=fallback.get("alpn", ""),
+            path=fallback.get("path", ""),
+            type=fallback.get("type") or "tcp",
+            dest=dest,
+            xver=fallback.get("xver", 0),
+        ))
+    return result
+
+
+def _proxy_settings(inbound: dict, clients: List[dict]):
+    settings = inbound.get("settings", {})
+    try:
+        proxy_type = ProxyTypes(inbound["protocol"])
+    except ValueError:
+        raise ValueError(f"{inbound['protocol']} inbounds can't be applied live")
+    users = _users(proxy_type, settings.get("clients", []) + clients)
+
+    if proxy_type == ProxyTypes.VLESS:
+        _check_keys("vless settings", settings, ("clients", "decryption", "fallbacks"))
+        return vless_pb2.Config(clients=users, decryption=settings.get("decryption", "none"),
+                                fallbacks=_fallbacks(settings.get("fallbacks", []), vless_pb2.Fallback))
+
+    if proxy_type == ProxyTypes.VMess:
+        _check_keys("vmess settings", settings, ("clients",))
+        return vmess_pb2.Config(user=users)
+
+    if proxy_type == ProxyTypes.Trojan:
+        _check_keys("trojan settings", settings, ("clients", "fallbacks"))
+        return trojan_pb2.ServerConfig(users=users,
+                                       fallbacks=_fallbacks(settings.get("fallbacks", []), trojan_pb2.Fallback))
+
+    _check_keys("shadowsocks settings", settings, ("clients", "network"))
+    networks = [network.strip() for network in settings.get("network", "tcp").split(',')]
+    return shadowsocks_pb2.ServerConfig(
+        users=users,
+        network=[network_pb2.TCP if network == "tcp" else network_pb2.UDP for network in networks],
+    )
+
+
+def build_inbound(inbound: dict, clients: List[dict] = ()) -> core_pb2.InboundHandlerConfig:
+    """The inbound of a core config as a HandlerService message, with `clients` added to its own."""
+    _check_keys("inbound", inbound, ("tag", "protocol", "port", "listen", "settings", "streamSettings", "sniffing"))
+
+    receiver = proxyman_pb2.ReceiverConfig(
+        port_list=_port_list(inbound["port"]),
+        stream_settings=_stream(inbound.get("streamSettings", {})),
+    )
+    if inbound.get("listen"):
+        receiver.listen.CopyFrom(_address(inbound["listen"]))
+    if inbound.get("sniffing"):
+        receiver.sniffing_settings.CopyFrom(_sniffing(inbound["sniffing"]))
+
+    return core_pb2.InboundHandlerConfig(
+        tag=inbound["tag"],
+        receiver_settings=Message(receiver),
+        proxy_settings=Message(_proxy_settings(inbound, list(clients))),
+    )
+
+
+def build_outbound(outbound: dict) -> core_pb2.OutboundHandlerConfig:
+    """The outbound of a core config as a HandlerService message."""
+    _check_keys("outbound", outbound, ("tag", "protocol", "settings"))
+    settings = outbound.get("settings") or {}
+
+    if outbound["protocol"] == "freedom":
+        _check_keys("freedom settings", settings, ("domainStrategy",))
+        proxy_settings = freedom_pb2.Config(
+            domain_strategy=FREEDOM_DOMAIN_STRATEGIES[settings.get("domainStrategy", "AsIs")]
+        )
+    elif outbound["protocol"] == "blackhole":
+        _check_keys("blackhole settings", settings, ("response",))
+        response = blackhole_pb2.HTTPResponse() if settings.get("response", {}).get("type") == "http" \
+            else blackhole_pb2.NoneResponse()
+        proxy_settings = blackhole_pb2.Config(response=Message(response))
+    else:
+        raise ValueError(f"{outbound['protocol']} outbounds can't be applied live")
+
+    return core_pb2.OutboundHandlerConfig(
+        tag=outbound["tag"],
+        sender_settings=Message(proxyman_pb2.SenderConfig()),
+        proxy_settings=Message(proxy_settings),
+    )
+
+
+class HandlerChanges:
+    """
+    The HandlerService calls applying a ConfigDiff without its restart reasons, built once
+    for every core. Added (and modified) inbounds carry their users' `clients`.
+    """
+
+    def __init__(self, diff: "ConfigDiff", clients: Dict[str, List[dict]]):
+        self.removed_inbounds = diff.removed_inbounds
+        self.removed_outbounds = diff.removed_outbounds
+        self.outbounds = [build_outbound(outbound) for outbound in diff.added_outbounds]
+        self.inbounds = []
+        # inbound tag -> emails, None if removed, for the cores' ledgers
+        self.ledger: Dict[str, Optional[Set[str]]] = dict.fromkeys(diff.removed_inbounds)
+
+        for inbound in diff.added_inbounds:
+            inbound_clients = clients.get(inbound["tag"], [])
+            self.inbounds.append(build_inbound(inbound, inbound_clients))
+            self.ledger[inbound["tag"]] = {
+                client["email"] for client in inbound.get("settings", {}).get("clients", []) + inbound_clients
+            }
+
+    def apply(self, api: "XRayAPI", timeout: int = 30):
+        for tag in self.removed_outbounds:
+            try:
+                api.remove_outbound(tag, timeout=timeout)
+            except TagNotFoundError:
+                pass
+        for outbound in self.outbounds:
+            api.add_outbound(outbound, timeout=timeout)
+
+        for tag in self.removed_inbounds:
+            try:
+                api.remove_inbound(tag, timeout=timeout)
+            except TagNotFoundError:
+                pass
+        for inbound in self.inbounds:
+            api.add_inbound(inbound, timeout=timeout)
+
+
+__all__ = [
+    "build_inbound",
+    "build_outbound",
+    "HandlerChanges",
+]
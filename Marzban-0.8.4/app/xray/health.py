@@ -0,0 +1,90 @@
+import time
+from enum import Enum
+from threading import Lock
+
+from config import (
+    JOB_CORE_HEALTH_CHECK_INTERVAL,
+    NODE_HEALTH_FAILURE_THRESHOLD,
+    NODE_HEALTH_MAX_BACKOFF,
+    NODE_HEALTH_RECOVERY_THRESHOLD,
+)
+
+
+class NodeState(str, Enum):
+    connecting = "connecting"
+    healthy = "healthy"
+    degraded = "degraded"
+    down = "down"
+
+
+class NodeHealth:
+    """
+    Cached health of a node, updated by the core health check heartbeat.
+
+    A healthy node that misses a heartbeat is only degraded, it goes down after
+    NODE_HEALTH_FAILURE_THRESHOLD misses in a row. A down node is retried with an
+    exponential backoff (capped at NODE_HEALTH_MAX_BACKOFF seconds) and becomes healthy
+    again after NODE_HEALTH_RECOVERY_THRESHOLD successful heartbeats or a successful
+    (re)start of its core.
+    """
+
+    def __init__(self):
+        self.state = NodeState.connecting
+        self.failures = 0
+        self.successes = 0
+        self.backoff = 0
+        self.next_check_at = 0.0
+        self._lock = Lock()
+
+    @property
+    def available(self) -> bool:
+        """Whether users should be pushed to the node, read by the hot paths instead of pinging it."""
+        return self.state in (NodeState.healthy, NodeState.degraded)
+
+    def due(self) -> bool:
+        return self.state != NodeState.connecting and time.monotonic() >= self.next_check_at
+
+    def connecting(self):
+        with self._lock:
+            self.state = NodeState.connecting
+            self.failures = 0
+            self.successes = 0
+
+    def up(self):
+        with self._lock:
+            self.state = NodeState.healthy
+            self.failures = 0
+            self.successes = 0
+            self.backoff = 0
+            self.next_check_at = 0.0
+
+    def down(self):
+        with self._lock:
+            self.state = NodeState.down
+            self.successes = 0
+            self.backoff = min(max(self.backoff * 2, JOB_CORE_HEALTH_CHECK_INTERVAL), NODE_HEALTH_MAX_BACKOFF)
+            self.next_check_at = time.monotonic() + self.backoff
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.successes += 1
+            if self.state == NodeState.degraded:
+                self.state = NodeState.healthy
+            elif self.state == NodeState.down and self.successes >= NODE_HEALTH_RECOVERY_THRESHOLD:
+                self.state = NodeState.healthy
+                self.backoff = 0
+            self.next_check_at = 0.0
+
+    def failure(self) -> bool:
+        """Records a missed heartbeat, returns whether the node's core should be recovered."""
+        with self._lock:
+            self.successes = 0
+            self.failures += 1
+            if self.state in (NodeState.healthy, NodeState.degraded):
+                if self.failures < NODE_HEALTH_FAILURE_THRESHOLD:
+                    self.state = NodeState.degraded
+                    return False
+                self.state = NodeState.down
+                return True
+            return self.state == NodeState.down
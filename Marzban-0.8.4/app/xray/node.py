@@ -1,9 +1,13 @@
+import hashlib
+import json
 import socket
 import re
 import ssl
 import tempfile
 import threading
 import time
+import weakref
+import zlib
 from collections import deque
 from contextlib import contextmanager
 from typing import List
@@ -12,11 +16,16 @@ import grpc
 import requests
 import rpyc
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
 from requests.packages.urllib3.poolmanager import PoolManager
 from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException, create_connection
 
+from app.utils.concurrency import run_coroutine
 from app.xray.config import XRayConfig
+from app.xray.health import NodeHealth
+from config import NODE_ROLLOUT_TIMEOUT
 from xray_api import XRay as XRayAPI
+from xray_api.aio import release_async_api
 
 
 def string_to_temp_file(content: str):
@@ -26,12 +35,112 @@ def string_to_temp_file(content: str):
     return file
 
 
+def close_async_api(api: XRayAPI):
+    """Closes the grpc.aio channel cached for a node's API client that's replaced or dropped."""
+    client = release_async_api(api)
+    if client is not None:
+        try:
+            run_coroutine(client.close())
+        except Exception:
+            pass
+
+
+def _read_pem(path: str) -> List[str]:
+    with open(path) as file:
+        return [line.strip() for line in file.readlines()]
+
+
+def prepare_config(config: XRayConfig) -> dict:
+    """
+    The config as nodes need it, with the certificate files it references inlined.
+
+    Only the inbounds with certificate files are copied (without their clients), the
+    config itself is left as is since the main core reads the files.
+    """
+    inbounds = []
+    for inbound in config.get("inbounds", []):
+        streamSettings = inbound.get("streamSettings") or {}
+        tlsSettings = streamSettings.get("tlsSettings") or {}
+        certificates = tlsSettings.get("certificates") or []
+        if any(certificate.get("certificateFile") or certificate.get("keyFile") for certificate in certificates):
+            prepared_certificates = []
+            for certificate in certificates:
+                certificate = dict(certificate)
+                if certificate.get("certificateFile"):
+                    certificate['certificate'] = _read_pem(certificate.pop('certificateFile'))
+                if certificate.get("keyFile"):
+                    certificate['key'] = _read_pem(certificate.pop('keyFile'))
+                prepared_certificates.append(certificate)
+
+            inbound = {**inbound, "streamSettings": {
+                **streamSettings, "tlsSettings": {**tlsSettings, "certificates": prepared_certificates}
+            }}
+        inbounds.append(inbound)
+
+    return {**config, "inbounds": inbounds}
+
+
+class NodeConfig:
+    """
+    A core config prepared for the nodes and serialized once, shared by every node it's
+    rolled out to. Nodes remember the digest of the config they run.
+    """
+
+    def __init__(self, config: XRayConfig):
+        self.json = json.dumps(prepare_config(config))
+        self.digest = hashlib.blake2b(self.json.encode(), digest_size=16).hexdigest()
+        # body of the REST nodes' requests but the session id, the config comes first so
+        # it's encoded (and compressed) only once
+        self._body_prefix = f'{{"config": {json.dumps(self.json)}, "session_id": '.encode()
+        self._gzip_prefix = None
+        self._gzip_compressor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, config: XRayConfig) -> "NodeConfig":
+        """
+        The NodeConfig of a config, created by the first node it's rolled out to.
+
+        It's kept aside by the config's identity until the config is collected, so copies
+        of the config (which may be modified) never share it.
+        """
+        key = id(config)
+        with _node_configs_lock:
+            node_config = _node_configs.get(key)
+            if node_config is None:
+                node_config = _node_configs[key] = cls(config)
+                weakref.finalize(config, _node_configs.pop, key, None)
+            return node_config
+
+    def body(self, session_id: str, compressed: bool = False) -> bytes:
+        """The JSON body of the REST nodes' start and restart requests, gzipped if `compressed`."""
+        tail = f'{json.dumps(session_id)}}}'.encode()
+        if not compressed:
+            return self._body_prefix + tail
+
+        with self._lock:
+            if self._gzip_compressor is None:
+                self._gzip_compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                self._gzip_prefix = self._gzip_compressor.compress(self._body_prefix)
+            compressor = self._gzip_compressor.copy()
+
+        return self._gzip_prefix + compressor.compress(tail) + compressor.flush()
+
+
+_node_configs = {}
+_node_configs_lock = threading.Lock()
+
+
 class SANIgnoringAdaptor(HTTPAdapter):
     def init_poolmanager(self, connections, maxsize, block=False):
+        # keep the control connection open between heartbeats instead of handshaking every time
         self.poolmanager = PoolManager(num_pools=connections,
                                        maxsize=maxsize,
                                        block=block,
-                                       assert_hostname=False)
+                                       assert_hostname=False,
+                                       socket_options=HTTPConnection.default_socket_options + [
+                                           (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                                       ])
 
 
 class NodeAPIError(Exception):
@@ -76,33 +185,25 @@ class ReSTXRayNode:
 
         self._api = None
         self._started = False
+        self._accepts_gzip = False
+        self.config_digest = None
 
-    def _prepare_config(self, config: XRayConfig):
-        for inbound in config.get("inbounds", []):
-            streamSettings = inbound.get("streamSettings") or {}
-            tlsSettings = streamSettings.get("tlsSettings") or {}
-            certificates = tlsSettings.get("certificates") or []
-            for certificate in certificates:
-                if certificate.get("certificateFile"):
-                    with open(certificate['certificateFile']) as file:
-                        certificate['certificate'] = [
-                            line.strip() for line in file.readlines()
-                        ]
-                        del certificate['certificateFile']
+        self.health = NodeHealth()
 
-                if certificate.get("keyFile"):
-                    with open(certificate['keyFile']) as file:
-                        certificate['key'] = [
-                            line.strip() for line in file.readlines()
-                        ]
-                        del certificate['keyFile']
+    def make_request(self, path: str, timeout: int, **params):
+        return self._post(path, timeout, json={"session_id": self._session_id, **params})
 
-        return config
+    def send_config(self, path: str, node_config: NodeConfig):
+        """Posts a config to the node, gzipped if it accepts it."""
+        headers = {"Content-Type": "application/json"}
+        if self._accepts_gzip:
+            headers["Content-Encoding"] = "gzip"
+        body = node_config.body(self._session_id, compressed=self._accepts_gzip)
+        return self._post(path, NODE_ROLLOUT_TIMEOUT, data=body, headers=headers)
 
-    def make_request(self, path: str, timeout: int, **params):
+    def _post(self, path: str, timeout: int, **kwargs):
         try:
-            res = self.session.post(self._rest_api_url + path, timeout=timeout,
-                                    json={"session_id": self._session_id, **params})
+            res = self.session.post(self._rest_api_url + path, timeout=timeout, **kwargs)
             data = res.json()
         except Exception as e:
             exc = NodeAPIError(0, str(e))
@@ -129,6 +230,15 @@ class ReSTXRayNode:
         res = self.make_request("/", timeout=3)
         return res.get('started', False)
 
+    def heartbeat(self, timeout: int = 2):
+        """Checks the session, the core and its API, raises if any of them is unreachable."""
+        if not self._session_id:
+            raise ConnectionError("Node is not connected")
+        self.make_request("/ping", timeout=timeout)
+        if not self.make_request("/", timeout=timeout).get('started', False):
+            raise ConnectionError("Node is not started")
+        self.api.get_sys_stats(timeout=timeout)
+
     @property
     def api(self):
         if not self._session_id:
@@ -154,11 +264,22 @@ class ReSTXRayNode:
 
         res = self.make_request("/connect", timeout=3)
         self._session_id = res['session_id']
+        # nodes accepting compressed configs advertise it
+        self._accepts_gzip = "gzip" in (res.get('accept_encoding') or ())
+        self.config_digest = None
 
     def disconnect(self):
+        self.config_digest = None
+        self.release_api()
         self.make_request("/disconnect", timeout=3)
         self._session_id = None
 
+    def release_api(self):
+        """Drops the API client, closing its cached async channel."""
+        if self._api is not None:
+            close_async_api(self._api)
+        self._api = None
+
     def get_version(self):
         res = self.make_request("/", timeout=3)
         return res.get('core_version')
@@ -167,11 +288,10 @@ class ReSTXRayNode:
         if not self.connected:
             self.connect()
 
-        config = self._prepare_config(config)
-        json_config = config.to_json()
+        node_config = NodeConfig.of(config)
 
         try:
-            res = self.make_request("/start", timeout=10, config=json_config)
+            res = self.send_config("/start", node_config)
         except NodeAPIError as exc:
             if exc.detail == 'Xray is started already':
                 return self.restart(config)
@@ -179,7 +299,9 @@ class ReSTXRayNode:
                 raise exc
 
         self._started = True
+        self.config_digest = node_config.digest
 
+        self.release_api()
         self._api = XRayAPI(
             address=self.address,
             port=self.api_port,
@@ -198,21 +320,24 @@ class ReSTXRayNode:
         if not self.connected:
             self.connect()
 
+        self.config_digest = None
         self.make_request('/stop', timeout=5)
-        self._api = None
+        self.release_api()
         self._started = False
 
     def restart(self, config: XRayConfig):
         if not self.connected:
             self.connect()
 
-        config = self._prepare_config(config)
-        json_config = config.to_json()
+        node_config = NodeConfig.of(config)
+        self.config_digest = None
 
-        res = self.make_request("/restart", timeout=10, config=json_config)
+        res = self.send_config("/restart", node_config)
 
         self._started = True
+        self.config_digest = node_config.digest
 
+        self.release_api()
         self._api = XRayAPI(
             address=self.address,
             port=self.api_port,
@@ -321,8 +446,12 @@ class RPyCXRayNode:
 
         self._service = Service()
         self._api = None
+        self.config_digest = None
+
+        self.health = NodeHealth()
 
     def disconnect(self):
+        self.config_digest = None
         try:
             self.connection.close()
             del self.connection
@@ -378,38 +507,22 @@ class RPyCXRayNode:
 
         return self._api
 
+    def heartbeat(self, timeout: int = 2):
+        """Checks the connection, the core and its API, raises if any of them is unreachable."""
+        self.api.get_sys_stats(timeout=timeout)
+
     def get_version(self):
         return self.remote.fetch_xray_version()
 
-    def _prepare_config(self, config: XRayConfig):
-        for inbound in config.get("inbounds", []):
-            streamSettings = inbound.get("streamSettings") or {}
-            tlsSettings = streamSettings.get("tlsSettings") or {}
-            certificates = tlsSettings.get("certificates") or []
-            for certificate in certificates:
-                if certificate.get("certificateFile"):
-                    with open(certificate['certificateFile']) as file:
-                        certificate['certificate'] = [
-                            line.strip() for line in file.readlines()
-                        ]
-                        del certificate['certificateFile']
-
-                if certificate.get("keyFile"):
-                    with open(certificate['keyFile']) as file:
-                        certificate['key'] = [
-                            line.strip() for line in file.readlines()
-                        ]
-                        del certificate['keyFile']
-
-        return config
-
     def start(self, config: XRayConfig):
-        config = self._prepare_config(config)
-        json_config = config.to_json()
-        self.remote.start(json_config)
+        node_config = NodeConfig.of(config)
+        self.config_digest = None
+        self.remote.start(node_config.json)
         self.started = True
+        self.config_digest = node_config.digest
 
         # connect to API
+        self.release_api()
         self._api = XRayAPI(
             address=self.address,
             port=self.api_port,
@@ -437,16 +550,24 @@ class RPyCXRayNode:
             raise ConnectionError('Failed to connect to node\'s API')
 
     def stop(self):
+        self.config_digest = None
         self.remote.stop()
         self.started = False
+        self.release_api()
+
+    def release_api(self):
+        """Drops the API client, closing its cached async channel."""
+        if self._api is not None:
+            close_async_api(self._api)
         self._api = None
 
     def restart(self, config: XRayConfig):
+        node_config = NodeConfig.of(config)
         self.started = False
-        config = self._prepare_config(config)
-        json_config = config.to_json()
-        self.remote.restart(json_config)
+        self.config_digest = None
+        self.remote.restart(node_config.json)
         self.started = True
+        self.config_digest = node_config.digest
 
     @contextmanager
     def get_logs(self):
@@ -1,3 +1,5 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from typing import TYPE_CHECKING
 
@@ -7,16 +9,23 @@ from app import logger, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
 from app.models.user import UserResponse
-from app.utils.concurrency import threaded_function
-from app.xray.node import XRayNode
-from xray_api import XRay as XRayAPI
-from xray_api.types.account import Account, XTLSFlows
+from app.utils.concurrency import pooled_function
+from app.xray import controller, queues
+from app.xray.config import ConfigDiff, XRayConfig
+from app.xray.handlers import HandlerChanges
+from app.xray.node import NodeConfig, XRayNode
+from config import NODE_ROLLOUT_MAX_WORKERS
+from xray_api.types.account import XTLSFlows
 
 if TYPE_CHECKING:
     from app.db import User as DBUser
     from app.db.models import Node as DBNode
 
 
+# connects and restarts of nodes, which send them the whole core config
+rollout_pool = ThreadPoolExecutor(max_workers=NODE_ROLLOUT_MAX_WORKERS, thread_name_prefix="node-rollout")
+
+
 @lru_cache(maxsize=None)
 def get_tls():
     from app.db import GetDB, get_tls_certificate
@@ -28,35 +37,8 @@ def get_tls():
         }
 
 
-@threaded_function
-def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
-
-
-@threaded_function
-def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
-
-
-@threaded_function
-def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=account.email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
-
-
 def add_user(dbuser: "DBUser"):
+    xray.config.users_clients.update_user(dbuser)
     user = UserResponse.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
 
@@ -70,37 +52,22 @@ def add_user(dbuser: "DBUser"):
                 pass
             account = proxy_type.account_model(email=email, **proxy_settings)
 
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
+            if getattr(account, 'flow', None) and not XRayConfig.supports_xtls(inbound):
                 account.flow = XTLSFlows.NONE
 
-            _add_user_to_inbound(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _add_user_to_inbound(node.api, inbound_tag, account)
+            queues.put("add", inbound_tag, email, account)
 
 
 def remove_user(dbuser: "DBUser"):
+    xray.config.users_clients.remove_user(dbuser.id)
     email = f"{dbuser.id}.{dbuser.username}"
 
     for inbound_tag in xray.config.inbounds_by_tag:
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        queues.put("remove", inbound_tag, email)
 
 
 def update_user(dbuser: "DBUser"):
+    xray.config.users_clients.update_user(dbuser)
     user = UserResponse.model_validate(dbuser)
     email = f"{dbuser.id}.{dbuser.username}"
 
@@ -116,36 +83,20 @@ def update_user(dbuser: "DBUser"):
                 pass
             account = proxy_type.account_model(email=email, **proxy_settings)
 
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
+            if getattr(account, 'flow', None) and not XRayConfig.supports_xtls(inbound):
                 account.flow = XTLSFlows.NONE
 
-            _alter_inbound_user(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _alter_inbound_user(node.api, inbound_tag, account)
+            queues.put("alter", inbound_tag, email, account)
 
     for inbound_tag in xray.config.inbounds_by_tag:
         if inbound_tag in active_inbounds:
             continue
         # remove disabled inbounds
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        queues.put("remove", inbound_tag, email)
 
 
 def remove_node(node_id: int):
+    queues.remove_queue(node_id)
     if node_id in xray.nodes:
         try:
             xray.nodes[node_id].disconnect()
@@ -153,7 +104,7 @@ def remove_node(node_id: int):
             pass
         finally:
             try:
-                del xray.nodes[node_id]
+                xray.nodes.pop(node_id).release_api()
             except KeyError:
                 pass
 
@@ -192,7 +143,7 @@ global _connecting_nodes
 _connecting_nodes = {}
 
 
-@threaded_function
+@pooled_function(rollout_pool)
 def connect_node(node_id, config=None):
     global _connecting_nodes
 
@@ -214,18 +165,25 @@ def connect_node(node_id, config=None):
     try:
         _connecting_nodes[node_id] = True
 
+        node.health.connecting()
         _change_node_status(node_id, NodeStatus.connecting)
         logger.info(f"Connecting to \"{dbnode.name}\" node")
 
         if config is None:
             config = xray.config.include_db_users()
 
+        start_time = time.time()
         node.start(config)
+        queues.reset_ledger(node_id, config)
+        elapsed = time.time() - start_time
         version = node.get_version()
+        node.health.up()
         _change_node_status(node_id, NodeStatus.connected, version=version)
-        logger.info(f"Connected to \"{dbnode.name}\" node, xray run on v{version}")
+        logger.info(f"Connected to \"{dbnode.name}\" node, xray run on v{version}"
+                    f" (config {node.config_digest[:12]} rolled out in {elapsed:.2f} seconds)")
 
     except Exception as e:
+        node.health.down()
         _change_node_status(node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to connect to \"{dbnode.name}\" node")
 
@@ -236,8 +194,13 @@ def connect_node(node_id, config=None):
             pass
 
 
-@threaded_function
-def restart_node(node_id, config=None):
+@pooled_function(rollout_pool)
+def restart_node(node_id, config=None, force: bool = False):
+    """
+    Restarts the core of a node with the config, unless it's healthy and already runs it.
+
+    The restart is done anyway when `force`d, as when an admin asks for it.
+    """
     with GetDB() as db:
         dbnode = crud.get_node_by_id(db, node_id)
 
@@ -253,14 +216,23 @@ def restart_node(node_id, config=None):
         return connect_node(node_id, config)
 
     try:
-        logger.info(f"Restarting Xray core of \"{dbnode.name}\" node")
-
         if config is None:
             config = xray.config.include_db_users()
 
+        node_config = NodeConfig.of(config)
+        if not force and node.config_digest == node_config.digest and node.health.available:
+            logger.info(f"Xray core of \"{dbnode.name}\" node already runs config {node_config.digest[:12]}")
+            return
+
+        logger.info(f"Restarting Xray core of \"{dbnode.name}\" node")
+        start_time = time.time()
         node.restart(config)
-        logger.info(f"Xray core of \"{dbnode.name}\" node restarted")
+        queues.reset_ledger(node_id, config)
+        node.health.up()
+        logger.info(f"Xray core of \"{dbnode.name}\" node restarted with config {node_config.digest[:12]}"
+                    f" in {(time.time() - start_time):.2f} seconds")
     except Exception as e:
+        node.health.down()
         _change_node_status(node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to restart node {node_id}")
         try:
@@ -269,6 +241,82 @@ def restart_node(node_id, config=None):
             pass
 
 
+def update_hosts():
+    """Reloads the hosts, in the API workers too in the multi-worker mode."""
+    xray.hosts.update()
+    controller.broadcast("hosts")
+
+
+@pooled_function(rollout_pool)
+def _apply_node_changes(node_id: int, changes: HandlerChanges):
+    node = xray.nodes.get(node_id)
+    if node is None:
+        return
+
+    try:
+        changes.apply(node.api)
+        queues.get_queue(node_id).update_ledger(changes.ledger)
+    except Exception as e:
+        logger.warning(f"Unable to apply the config change to node {node_id} live, restarting it: {e}")
+        restart_node(node_id)
+
+
+def _apply_changes(changes: HandlerChanges):
+    if xray.core.started:
+        try:
+            changes.apply(xray.api)
+            queues.get_queue(None).update_ledger(changes.ledger)
+        except Exception as e:
+            logger.warning(f"Unable to apply the config change to the main core live, restarting it: {e}")
+            startup_config = xray.config.include_db_users()
+            xray.core.restart(startup_config)
+            queues.reset_ledger(None, startup_config)
+
+    for node_id, node in list(xray.nodes.items()):
+        if node.health.available:
+            _apply_node_changes(node_id, changes)
+        elif node.connected:
+            # it may come back without being restarted
+            restart_node(node_id)
+
+
+def apply_config(config: XRayConfig):
+    """
+    Switches to a new core config and reloads the hosts.
+
+    Inbounds and outbounds added, removed or modified are swapped on the running cores through
+    the API, modified inbounds getting their users' clients again. The cores are restarted only
+    for changes of the other sections (see ConfigDiff), or handlers app.xray.handlers can't convert.
+    """
+    diff = ConfigDiff(xray.config, config)
+    xray.config = config
+
+    changes = None
+    if diff.restart_reasons:
+        logger.info(f"Restarting Xray cores for the changed {', '.join(diff.restart_reasons)}")
+    elif diff:
+        try:
+            changes = HandlerChanges(diff, config.users_clients.get())
+        except Exception as e:
+            logger.info(f"Restarting Xray cores, the config change can't be applied live: {e}")
+
+    if changes is not None:
+        _apply_changes(changes)
+        logger.info(f"Config change applied live: {len(diff.removed_inbounds)} inbounds removed, "
+                    f"{len(diff.added_inbounds)} added, {len(diff.removed_outbounds)} outbounds removed, "
+                    f"{len(diff.added_outbounds)} added (modified ones are both)")
+    elif diff:
+        xray.reconcile.restart_all()
+
+    xray.hosts.update()
+    controller.broadcast("config")
+
+
+def get_queue_stats() -> list:
+    """The depth and counters of the operation queues, with the drift of their core (see queues.get_stats)."""
+    return queues.get_stats()
+
+
 __all__ = [
     "add_user",
     "remove_user",
@@ -276,4 +324,7 @@ __all__ = [
     "remove_node",
     "connect_node",
     "restart_node",
+    "update_hosts",
+    "apply_config",
+    "get_queue_stats",
 ]
@@ -0,0 +1,343 @@
+"""
+Per-core queues of the user operations sent through the Xray API, applied by a fixed pool of threads,
+and the ledgers of the users each core was acknowledged to have.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Timer
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app import logger, xray
+from app.utils.concurrency import run_coroutine
+from config import (
+    JOB_CORE_HEALTH_CHECK_INTERVAL,
+    XRAY_OPERATIONS_BATCH_SIZE,
+    XRAY_OPERATIONS_MAX_WORKERS,
+    XRAY_OPERATIONS_PUT_TIMEOUT,
+    XRAY_OPERATIONS_QUEUE_SIZE,
+    XRAY_OPERATIONS_RETRIES,
+)
+from xray_api.aio import AsyncXRay as AsyncXRayAPI
+from xray_api.aio import get_async_api
+from xray_api.types.account import Account
+
+# (inbound tag, email)
+OperationKey = Tuple[str, str]
+# (action, account, tries), action is "add", "alter" (remove then add) or "remove"
+Operation = Tuple[str, Optional[Account], int]
+
+pool = ThreadPoolExecutor(max_workers=XRAY_OPERATIONS_MAX_WORKERS, thread_name_prefix="xray-operations")
+
+
+async def _apply_operation(api: AsyncXRayAPI, key: OperationKey, action: str, account: Optional[Account]):
+    inbound_tag, email = key
+    if action in ("alter", "remove"):
+        try:
+            await api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
+        except xray.exc.EmailNotFoundError:
+            pass
+    if action in ("add", "alter"):
+        try:
+            await api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
+        except xray.exc.EmailExistsError:
+            pass
+
+
+async def _apply_batch(api: AsyncXRayAPI, batch: List[Tuple[OperationKey, Operation]]) -> list:
+    return await asyncio.gather(
+        *(_apply_operation(api, key, action, account) for key, (action, account, _) in batch),
+        return_exceptions=True
+    )
+
+
+class OperationQueue:
+    """
+    Pending user operations of a core (the main core, or a node), by inbound tag and email.
+
+    An operation replaces the one pending for the same inbound and user, so a user modified
+    several times before the core is reached costs a single call. The queue is drained by
+    the shared pool, one batch of up to XRAY_OPERATIONS_BATCH_SIZE concurrent calls at a
+    time. put() blocks while XRAY_OPERATIONS_QUEUE_SIZE operations are pending, for up to
+    XRAY_OPERATIONS_PUT_TIMEOUT seconds, then drops the operation (the drift check catches
+    the user up later).
+
+    Calls failing to connect are retried XRAY_OPERATIONS_RETRIES times, backing off between
+    the rounds, before they're dropped. So are the operations of a node that's down, it's
+    started with every user's current clients once it recovers.
+
+    The queue also keeps the ledger of the core: the emails of every inbound, as of the config
+    the core was (re)started with and the operations it acknowledged since. Checked against
+    the database, it tells the users the core missed (see app.xray.reconcile.check_drift).
+    """
+
+    def __init__(self, node_id: Optional[int]):
+        self.node_id = node_id
+        self.processed = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        # of the last drift check
+        self.missing = 0
+        self.extra = 0
+        self.repaired = 0
+        # inbound tag -> emails, None until the core is started
+        self.ledger: Optional[Dict[str, Set[str]]] = None
+        self._inflight: Set[OperationKey] = set()
+        self._pending: Dict[OperationKey, Operation] = OrderedDict()
+        self._cond = Condition()
+        self._draining = False
+        self._closed = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def core(self) -> str:
+        return f"node {self.node_id}" if self.node_id is not None else "main core"
+
+    def put(self, action: str, inbound_tag: str, email: str, account: Account = None):
+        key = (inbound_tag, email)
+        deadline = time.monotonic() + XRAY_OPERATIONS_PUT_TIMEOUT
+        with self._cond:
+            while key not in self._pending and len(self._pending) >= XRAY_OPERATIONS_QUEUE_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.dropped += 1
+                    logger.warning(f"Operation queue of {self.core} is full, "
+                                   f"dropped {action} of {email} on inbound {inbound_tag}")
+                    return
+                self._cond.wait(remaining)
+
+            if key in self._pending:
+                self.coalesced += 1
+                # the pending operation may have added the user already
+                if action == "add":
+                    action = "alter"
+            self._pending[key] = (action, account, 0)
+            self._schedule()
+
+    def reset_ledger(self, config: dict):
+        """Sets the ledger to the clients of the config the core was just (re)started with."""
+        ledger = {
+            inbound['tag']: {client['email'] for client in inbound.get('settings', {}).get('clients', [])
+                             if client.get('email')}
+            for inbound in config.get('inbounds', [])
+            if inbound.get('tag')
+        }
+        with self._cond:
+            self.ledger = ledger
+
+    def update_ledger(self, inbounds: Dict[str, Optional[Set[str]]]):
+        """Sets the emails of inbounds added to the running core, or drops them if None (removed)."""
+        with self._cond:
+            if self.ledger is None:
+                return
+            for inbound_tag, emails in inbounds.items():
+                if emails is None:
+                    self.ledger.pop(inbound_tag, None)
+                else:
+                    self.ledger[inbound_tag] = set(emails)
+
+    def acknowledge(self, operations: Iterable[Tuple[str, str, str]]):
+        """Records (action, inbound tag, email) operations the core applied in the ledger."""
+        with self._cond:
+            if self.ledger is None:
+                return
+            for action, inbound_tag, email in operations:
+                if action == "remove":
+                    self.ledger.get(inbound_tag, set()).discard(email)
+                else:
+                    self.ledger.setdefault(inbound_tag, set()).add(email)
+
+    def snapshot(self) -> Optional[Tuple[Dict[str, Set[str]], Set[OperationKey]]]:
+        """
+        A copy of the ledger and the keys of the operations pending or in flight, which it may
+        not reflect yet. None if the ledger isn't known.
+        """
+        with self._cond:
+            if self.ledger is None:
+                return None
+            ledger = {tag: set(emails) for tag, emails in self.ledger.items()}
+            return ledger, set(self._pending) | self._inflight
+
+    def _schedule(self, delay: float = 0):
+        if self._draining or self._closed:
+            return
+        self._draining = True
+        if delay:
+            Timer(delay, pool.submit, args=(self._drain,)).start()
+        else:
+            pool.submit(self._drain)
+
+    def _api(self):
+        if self.node_id is None:
+            return xray.api
+        node = xray.nodes.get(self.node_id)
+        if node is None or not node.health.available:
+            return None
+        try:
+            return node.api
+        except ConnectionError:
+            return None
+
+    def _drain(self):
+        delay = 0
+        try:
+            delay = self._drain_batches()
+        except Exception as exc:
+            logger.error(f"Unable to drain the operation queue of {self.core}: {exc!r}")
+            delay = 1
+        finally:
+            # whatever happened, the queue must not be left waiting for a drain that never comes
+            with self._cond:
+                # the batch the failure interrupted is lost
+                self.dropped += len(self._inflight)
+                self._inflight.clear()
+                self._draining = False
+                self._cond.notify_all()
+                if self._pending:
+                    self._schedule(delay)
+
+    def _drain_batches(self) -> float:
+        """Applies batches until the queue is empty (returns 0) or calls are to be retried (returns the backoff)."""
+        while True:
+            with self._cond:
+                batch = [self._pending.popitem(last=False)
+                         for _ in range(min(XRAY_OPERATIONS_BATCH_SIZE, len(self._pending)))]
+                self._cond.notify_all()
+                if not batch:
+                    return 0
+                self._inflight.update(key for key, _ in batch)
+
+            api = self._api()
+            if api is None:
+                with self._cond:
+                    self._inflight.difference_update(key for key, _ in batch)
+                    self.dropped += len(batch)
+                continue
+
+            try:
+                results = run_coroutine(_apply_batch(get_async_api(api), batch))
+            except Exception as exc:
+                results = [exc] * len(batch)
+
+            retries = []
+            applied = []
+            failures = []
+            dropped = 0
+            for (key, (action, account, op_tries)), result in zip(batch, results):
+                if result is None:
+                    applied.append((action, *key))
+                elif isinstance(result, (xray.exc.ConnectionError, xray.exc.TimeoutError)) \
+                        and op_tries < XRAY_OPERATIONS_RETRIES:
+                    retries.append((key, (action, account, op_tries + 1)))
+                elif isinstance(result, (xray.exc.ConnectionError, xray.exc.TimeoutError)):
+                    dropped += 1
+                else:
+                    failures.append((key, action, result))
+
+            with self._cond:
+                self.acknowledge(applied)
+                self.processed += len(applied)
+                self.dropped += dropped
+                self.failed += len(failures)
+                for key, operation in retries:
+                    # unless a newer one is pending already
+                    if key not in self._pending:
+                        self._pending[key] = operation
+                        self._pending.move_to_end(key, last=False)
+                        self.retried += 1
+                self._inflight.difference_update(key for key, _ in batch)
+
+            for (inbound_tag, email), action, result in failures:
+                logger.warning(f"Unable to {action} {email} on inbound {inbound_tag} of {self.core}: {result}")
+
+            if retries:
+                tries = max(operation[2] for _, operation in retries)
+                return min(2 ** tries, JOB_CORE_HEALTH_CHECK_INTERVAL)
+
+    def record_drift(self, missing: int, extra: int, repaired: int = 0):
+        """Records the result of a drift check of the core."""
+        with self._cond:
+            self.missing = missing
+            self.extra = extra
+            self.repaired += repaired
+
+    def stats(self) -> dict:
+        """The depth and counters of the queue, with the drift its core had on the last check."""
+        with self._cond:
+            return {
+                "node_id": self.node_id,
+                "depth": len(self._pending),
+                "processed": self.processed,
+                "coalesced": self.coalesced,
+                "retried": self.retried,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "missing": self.missing,
+                "extra": self.extra,
+                "repaired": self.repaired,
+            }
+
+    def close(self):
+        """Drops the pending operations, for a removed node."""
+        with self._cond:
+            self._closed = True
+            self.dropped += len(self._pending)
+            self._pending.clear()
+            self.ledger = None
+            self._cond.notify_all()
+
+
+_queues: Dict[Optional[int], OperationQueue] = {}
+_queues_lock = Lock()
+
+
+def get_queue(node_id: Optional[int] = None) -> OperationQueue:
+    """The queue of a node, or of the main core if None."""
+    with _queues_lock:
+        queue = _queues.get(node_id)
+        if queue is None:
+            queue = _queues[node_id] = OperationQueue(node_id)
+        return queue
+
+
+def remove_queue(node_id: int):
+    with _queues_lock:
+        queue = _queues.pop(node_id, None)
+    if queue is not None:
+        queue.close()
+
+
+def reset_ledger(node_id: Optional[int], config: dict):
+    """Sets the ledger of a core (the main core if None) to the config it was just (re)started with."""
+    get_queue(node_id).reset_ledger(config)
+
+
+def put(action: str, inbound_tag: str, email: str, account: Account = None):
+    """Queues an operation for the main core and every available node."""
+    get_queue(None).put(action, inbound_tag, email, account)
+    for node_id, node in list(xray.nodes.items()):
+        if node.health.available:
+            get_queue(node_id).put(action, inbound_tag, email, account)
+
+
+def get_stats() -> List[dict]:
+    """The depth and counters of every queue, with the drift its core had on the last check."""
+    with _queues_lock:
+        queues = list(_queues.values())
+    return [queue.stats() for queue in queues]
+
+
+__all__ = [
+    "OperationQueue",
+    "get_queue",
+    "remove_queue",
+    "reset_ledger",
+    "put",
+    "get_stats",
+]
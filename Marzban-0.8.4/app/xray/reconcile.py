@@ -0,0 +1,262 @@
+import asyncio
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from sqlalchemy.orm import selectinload
+
+from app import logger, xray
+from app.db import GetDB
+from app.db.models import Proxy, User
+from app.models.proxy import ProxyTypes
+from app.models.user import UserStatus
+from app.utils.concurrency import run_coroutine
+from app.xray import queues
+from app.xray.config import XRayConfig
+from config import (
+    XRAY_RECONCILE_BATCH_SIZE,
+    XRAY_RECONCILE_MAX_WORKERS,
+    XRAY_RECONCILE_RESTART_THRESHOLD,
+)
+from xray_api.aio import AsyncXRay as AsyncXRayAPI
+from xray_api.aio import fan_out, get_async_api
+from xray_api.types.account import Account, XTLSFlows
+
+if TYPE_CHECKING:
+    from xray_api import XRay as XRayAPI
+
+# ("add", inbound_tag, Account) or ("remove", inbound_tag, email)
+Operation = Tuple[str, str, Union[Account, str]]
+
+
+def _make_account(proxy: Proxy, email: str, inbound: dict) -> Account:
+    account = proxy.type.account_model(email=email, **proxy.settings)
+
+    if getattr(account, 'flow', None) and not XRayConfig.supports_xtls(inbound):
+        account.flow = XTLSFlows.NONE
+
+    return account
+
+
+def get_user_operations(user_ids: Iterable[int]) -> Tuple[int, List[Operation]]:
+    """
+    Works out the API calls needed to bring the cores in line with the database for the given users.
+
+    Active and on-hold users are added to every inbound they are allowed on,
+    everyone else is removed from all inbounds.
+    The users' clients of the config are patched along the way.
+
+    Returns:
+        Tuple[int, List[Operation]]: number of users involved and the operations to apply.
+    """
+    user_ids = list(set(user_ids))
+    operations = []
+    count = 0
+
+    with GetDB() as db:
+        for i in range(0, len(user_ids), 1000):
+            dbusers = db.query(User) \
+                .filter(User.id.in_(user_ids[i:i + 1000])) \
+                .options(selectinload(User.proxies).selectinload(Proxy.excluded_inbounds)) \
+                .all()
+
+            for dbuser in dbusers:
+                count += 1
+                email = f"{dbuser.id}.{dbuser.username}"
+                xray.config.users_clients.update_user(dbuser)
+
+                if dbuser.status not in (UserStatus.active, UserStatus.on_hold):
+                    for inbound_tag in xray.config.inbounds_by_tag:
+                        operations.append(("remove", inbound_tag, email))
+                    continue
+
+                for proxy in dbuser.proxies:
+                    excluded_tags = [i.tag for i in proxy.excluded_inbounds]
+                    for inbound in xray.config.inbounds_by_protocol.get(proxy.type, []):
+                        if inbound["tag"] in excluded_tags:
+                            continue
+                        operations.append(("add", inbound["tag"], _make_account(proxy, email, inbound)))
+
+    return count, operations
+
+
+async def _apply_operation(api: AsyncXRayAPI, action: str, inbound_tag: str, target: Union[Account, str]):
+    """Applies an operation, raises if the core didn't acknowledge it."""
+    try:
+        if action == "add":
+            await api.add_inbound_user(tag=inbound_tag, user=target, timeout=30)
+        else:
+            await api.remove_inbound_user(tag=inbound_tag, email=target, timeout=30)
+    except (xray.exc.EmailExistsError, xray.exc.EmailNotFoundError):
+        pass
+
+
+async def _apply_operations(api: AsyncXRayAPI, operations: List[Operation]) -> Tuple[List[Tuple[str, str, str]], list]:
+    """
+    Applies the operations in batches, a failed call doesn't stop the others.
+
+    Returns:
+        Tuple[List[Tuple[str, str, str]], list]: (action, inbound tag, email) of the applied
+        operations, and the errors of the failed ones.
+    """
+    applied = []
+    errors = []
+    for i in range(0, len(operations), XRAY_RECONCILE_BATCH_SIZE):
+        batch = operations[i:i + XRAY_RECONCILE_BATCH_SIZE]
+        results = await asyncio.gather(*(_apply_operation(api, *operation) for operation in batch),
+                                       return_exceptions=True)
+        for (action, inbound_tag, target), result in zip(batch, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                applied.append((action, inbound_tag, target if action == "remove" else target.email))
+    return applied, errors
+
+
+async def _fan_out_operations(apis: Dict[Optional[int], "XRayAPI"], operations: List[Operation]):
+    clients = {node_id: get_async_api(api) for node_id, api in apis.items()}
+    results = await fan_out(clients, lambda api: _apply_operations(api, operations),
+                            limit=XRAY_RECONCILE_MAX_WORKERS)
+    for node_id, result in results.items():
+        core = f'node {node_id}' if node_id else 'main core'
+        if isinstance(result, Exception):
+            logger.warning(f"Unable to reconcile users on {core}: {result}")
+            continue
+
+        applied, errors = result
+        queues.get_queue(node_id).acknowledge(applied)
+        if errors:
+            # the drift check catches them up
+            logger.warning(f"{len(errors)} of {len(operations)} reconcile calls failed on {core}, "
+                           f"last error: {errors[-1]!r}")
+
+
+def apply_operations(operations: List[Operation]):
+    """Sends the operations to the main core and every started node concurrently, in batches."""
+    api_instances = {None: xray.api}
+    for node_id, node in list(xray.nodes.items()):
+        if node.health.available:
+            api_instances[node_id] = node.api
+
+    run_coroutine(_fan_out_operations(api_instances, operations))
+
+
+def restart_all(force: bool = False):
+    """
+    Restarts the main core and the connected nodes with the users' clients generated again.
+
+    Healthy nodes already running the same config are left alone unless `force`d.
+    """
+    startup_config = xray.config.include_db_users(rebuild=True)
+    xray.core.restart(startup_config)
+    queues.reset_ledger(None, startup_config)
+    for node_id, node in list(xray.nodes.items()):
+        if node.connected:
+            xray.operations.restart_node(node_id, startup_config, force=force)
+
+
+def reconcile_users(user_ids: Iterable[int]):
+    """
+    Applies a bulk change of users to the running cores.
+
+    The exact add/remove calls are sent through the API, so live connections of untouched
+    users are kept. Only when the change is bigger than XRAY_RECONCILE_RESTART_THRESHOLD
+    users are the cores restarted with a freshly generated config instead.
+    """
+    count, operations = get_user_operations(user_ids)
+    if not operations:
+        return
+
+    if count > XRAY_RECONCILE_RESTART_THRESHOLD:
+        logger.info(f"{count} users changed, restarting Xray cores instead of reconciling")
+        return restart_all()
+
+    apply_operations(operations)
+    logger.info(f"Reconciled {count} users with {len(operations)} API calls per core")
+
+
+def _static_emails() -> Dict[str, Set[str]]:
+    """Emails of the clients the core config itself has, by inbound tag."""
+    return {
+        inbound['tag']: {client.get('email') for client in inbound.get('settings', {}).get('clients', [])}
+        for inbound in xray.config.get('inbounds', [])
+        if inbound.get('tag')
+    }
+
+
+def check_drift(repair: bool = True) -> Dict[Optional[int], Tuple[int, int]]:
+    """
+    Compares the users every running core is known to have with the database.
+
+    The known users of a core are the clients of the config it was started with and the
+    operations it acknowledged since (see app.xray.queues.OperationQueue). Users it misses
+    are added and the ones it shouldn't have are removed, through its operation queue, so
+    failed calls are caught up without restarting it. Users with operations pending on the
+    core are left out, those are still being applied.
+
+    Returns:
+        Dict[Optional[int], Tuple[int, int]]: number of missing and extra users by node id,
+        None being the main core.
+    """
+    targets = [None] if xray.core.started else []
+    targets.extend(node_id for node_id, node in list(xray.nodes.items()) if node.health.available)
+
+    # taken before querying the database, so the ledgers can only be behind it
+    snapshots = {}
+    for node_id in targets:
+        snapshot = queues.get_queue(node_id).snapshot()
+        if snapshot is not None:
+            snapshots[node_id] = snapshot
+    if not snapshots:
+        return {}
+
+    # inbound tag -> email -> client
+    expected = {
+        tag: {client['email']: client for client in clients.values()}
+        for tag, clients in xray.config.users_clients.query().items()
+    }
+    static_emails = _static_emails()
+
+    drift = {}
+    for node_id, (ledger, busy) in snapshots.items():
+        missing = [
+            (tag, email)
+            for tag, clients in expected.items()
+            for email in clients
+            if email not in ledger.get(tag, ()) and (tag, email) not in busy
+        ]
+        extra = [
+            (tag, email)
+            for tag in expected
+            for email in ledger.get(tag, ())
+            if email not in expected[tag] and email not in static_emails.get(tag, ()) and (tag, email) not in busy
+        ]
+        drift[node_id] = (len(missing), len(extra))
+
+        queue = queues.get_queue(node_id)
+        if not (missing or extra):
+            queue.record_drift(0, 0)
+            continue
+
+        logger.warning(f"{f'Node {node_id}' if node_id else 'Main core'} drifted from the database: "
+                       f"{len(missing)} missing and {len(extra)} extra users"
+                       + (", repairing" if repair else ""))
+        if not repair:
+            queue.record_drift(len(missing), len(extra))
+            continue
+
+        for tag, email in missing:
+            protocol = xray.config.inbounds_by_tag[tag]['protocol']
+            queue.put("add", tag, email, ProxyTypes(protocol).account_model(**expected[tag][email]))
+        for tag, email in extra:
+            queue.put("remove", tag, email)
+        queue.record_drift(len(missing), len(extra), repaired=len(missing) + len(extra))
+
+    return drift
+
+
+__all__ = [
+    "get_user_operations",
+    "apply_operations",
+    "restart_all",
+    "reconcile_users",
+    "check_drift",
+]
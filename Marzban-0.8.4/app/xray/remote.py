@@ -0,0 +1,171 @@
+"""
+The core, nodes, operations and reconcile of app.xray in the API workers of the
+multi-worker mode, they forward everything to the controller process (see app.xray.controller).
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import TYPE_CHECKING, Iterable, Optional
+
+import rpyc
+from rpyc.utils.factory import unix_connect
+
+from app import app, logger, xray
+from app.xray import controller
+from app.xray.config import XRayConfig
+from app.xray.core import XRayCore
+from config import CONTROLLER_SOCKET, XRAY_EXECUTABLE_PATH
+
+if TYPE_CHECKING:
+    from app.db import User as DBUser
+
+_connection: Optional[rpyc.Connection] = None
+_connection_lock = Lock()
+
+
+def get_controller():
+    """The controller's service, connecting (again) to it if needed."""
+    global _connection
+
+    with _connection_lock:
+        if _connection is None or _connection.closed:
+            try:
+                connection = unix_connect(CONTROLLER_SOCKET, config={"sync_request_timeout": 300})
+            except OSError as err:
+                raise ConnectionError(f"Unable to connect to the controller on {CONTROLLER_SOCKET}: {err}")
+
+            # serves the controller's calls to the reload and logs callbacks
+            rpyc.BgServingThread(connection)
+            connection.root.subscribe(controller.reload)
+            if _connection is not None:
+                # invalidations may have been missed while disconnected
+                controller.reload("config")
+            _connection = connection
+
+        return _connection.root
+
+
+@app.on_event("startup")
+def connect_to_controller():
+    get_controller()
+    logger.info(f"Connected to the controller on {CONTROLLER_SOCKET}")
+
+
+@contextmanager
+def _get_logs(node_id: Optional[int] = None):
+    buf = deque(maxlen=100)
+    watcher = get_controller().fetch_logs(node_id, buf.append)
+    try:
+        yield buf
+    finally:
+        try:
+            watcher.stop()
+        except EOFError:
+            pass
+
+
+class RemoteCore:
+    def __init__(self, executable_path: str):
+        self.executable_path = executable_path
+
+    # only runs the xray executable
+    get_x25519 = XRayCore.get_x25519
+
+    @property
+    def version(self) -> str:
+        return get_controller().core_status()[0]
+
+    @property
+    def started(self) -> bool:
+        return get_controller().core_status()[1]
+
+    def get_logs(self):
+        return _get_logs()
+
+
+class RemoteNode:
+    def __init__(self, node_id: int, key: int):
+        self.node_id = node_id
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, RemoteNode) and (self.node_id, self.key) == (other.node_id, other.key)
+
+    @property
+    def connected(self) -> bool:
+        return get_controller().node_connected(self.node_id)
+
+    def get_logs(self):
+        return _get_logs(self.node_id)
+
+
+class RemoteNodes:
+    def get(self, node_id: int, default=None) -> Optional[RemoteNode]:
+        key = get_controller().node_key(node_id)
+        return RemoteNode(node_id, key) if key is not None else default
+
+    def __getitem__(self, node_id: int) -> RemoteNode:
+        node = self.get(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def __contains__(self, node_id: int) -> bool:
+        return self.get(node_id) is not None
+
+
+class RemoteOperations:
+    def add_user(self, dbuser: "DBUser"):
+        get_controller().add_user(dbuser.id)
+
+    def update_user(self, dbuser: "DBUser"):
+        get_controller().update_user(dbuser.id)
+
+    def remove_user(self, dbuser: "DBUser"):
+        get_controller().remove_user(dbuser.id, dbuser.username)
+
+    def connect_node(self, node_id: int, config=None):
+        get_controller().connect_node(node_id)
+
+    def restart_node(self, node_id: int, config=None, force: bool = False):
+        get_controller().restart_node(node_id, force)
+
+    def remove_node(self, node_id: int):
+        get_controller().remove_node(node_id)
+
+    def update_hosts(self):
+        xray.hosts.update()
+        get_controller().invalidate("hosts")
+
+    def apply_config(self, config: XRayConfig):
+        # the controller and the other workers load it from XRAY_JSON
+        xray.config = config
+        xray.hosts.update()
+        get_controller().apply_config()
+
+    def get_queue_stats(self) -> list:
+        return [dict(stats) for stats in get_controller().queue_stats()]
+
+
+class RemoteReconcile:
+    def reconcile_users(self, user_ids: Iterable[int]):
+        get_controller().reconcile_users(tuple(user_ids))
+
+    def restart_all(self, force: bool = False):
+        get_controller().restart_all(force)
+
+
+core = RemoteCore(XRAY_EXECUTABLE_PATH)
+nodes = RemoteNodes()
+operations = RemoteOperations()
+reconcile = RemoteReconcile()
+
+
+__all__ = [
+    "get_controller",
+    "core",
+    "nodes",
+    "operations",
+    "reconcile",
+]
@@ -14,6 +14,13 @@ UVICORN_UDS = config("UVICORN_UDS", default=None)
 UVICORN_SSL_CERTFILE = config("UVICORN_SSL_CERTFILE", default=None)
 UVICORN_SSL_KEYFILE = config("UVICORN_SSL_KEYFILE", default=None)
 UVICORN_SSL_CA_TYPE = config("UVICORN_SSL_CA_TYPE", default="public").lower()
+# API worker processes, with more than one the jobs, the core and the nodes run in a separate controller process
+UVICORN_WORKERS = config("UVICORN_WORKERS", cast=int, default=1)
+# unix socket the API workers reach the controller process through, relative paths are to the working directory
+# main.py starts them all from
+CONTROLLER_SOCKET = config("CONTROLLER_SOCKET", default="marzban-controller.sock")
+# set by main.py in the API worker processes
+API_WORKER = config("MARZBAN_API_WORKER", cast=bool, default=False)
 DASHBOARD_PATH = config("DASHBOARD_PATH", default="/dashboard/")
 
 DEBUG = config("DEBUG", default=False, cast=bool)
@@ -35,6 +42,21 @@ XRAY_EXCLUDE_INBOUND_TAGS = config("XRAY_EXCLUDE_INBOUND_TAGS", default='').spli
 XRAY_SUBSCRIPTION_URL_PREFIX = config("XRAY_SUBSCRIPTION_URL_PREFIX", default="").strip("/")
 XRAY_SUBSCRIPTION_PATH = config("XRAY_SUBSCRIPTION_PATH", default="sub").strip("/")
 
+# bulk user changes touching more users than this are applied by restarting the cores
+XRAY_RECONCILE_RESTART_THRESHOLD = config("XRAY_RECONCILE_RESTART_THRESHOLD", cast=int, default=5000)
+# number of add/remove calls in flight on a core at once
+XRAY_RECONCILE_BATCH_SIZE = config("XRAY_RECONCILE_BATCH_SIZE", cast=int, default=100)
+# number of cores reconciled at once
+XRAY_RECONCILE_MAX_WORKERS = config("XRAY_RECONCILE_MAX_WORKERS", cast=int, default=20)
+# threads applying the queued user operations of every core, in batches of at most this many calls
+XRAY_OPERATIONS_MAX_WORKERS = config("XRAY_OPERATIONS_MAX_WORKERS", cast=int, default=8)
+XRAY_OPERATIONS_BATCH_SIZE = config("XRAY_OPERATIONS_BATCH_SIZE", cast=int, default=100)
+# pending user operations of a core before adding more blocks, and retries of those failing to connect
+XRAY_OPERATIONS_QUEUE_SIZE = config("XRAY_OPERATIONS_QUEUE_SIZE", cast=int, default=10000)
+XRAY_OPERATIONS_RETRIES = config("XRAY_OPERATIONS_RETRIES", cast=int, default=3)
+# seconds adding an operation waits on a full queue before dropping it
+XRAY_OPERATIONS_PUT_TIMEOUT = config("XRAY_OPERATIONS_PUT_TIMEOUT", cast=int, default=30)
+
 TELEGRAM_API_TOKEN = config("TELEGRAM_API_TOKEN", default="")
 TELEGRAM_ADMIN_ID = config(
     'TELEGRAM_ADMIN_ID',
@@ -53,6 +75,8 @@ HOME_PAGE_TEMPLATE = config("HOME_PAGE_TEMPLATE", default="home/index.html")
 
 CLASH_SUBSCRIPTION_TEMPLATE = config("CLASH_SUBSCRIPTION_TEMPLATE", default="clash/default.yml")
 CLASH_SETTINGS_TEMPLATE = config("CLASH_SETTINGS_TEMPLATE", default="clash/settings.yml")
+# build clash subscriptions from the template rendered once instead of rendering it with jinja per request
+CLASH_DIRECT_RENDER = config("CLASH_DIRECT_RENDER", default=True, cast=bool)
 
 SINGBOX_SUBSCRIPTION_TEMPLATE = config("SINGBOX_SUBSCRIPTION_TEMPLATE", default="singbox/default.json")
 SINGBOX_SETTINGS_TEMPLATE = config("SINGBOX_SETTINGS_TEMPLATE", default="singbox/settings.json")
@@ -130,12 +154,33 @@ NOTIFY_DAYS_LEFT = config(
 )
 
 DISABLE_RECORDING_NODE_USAGE = config("DISABLE_RECORDING_NODE_USAGE", cast=bool, default=False)
+# how many per-node user usage rows are upserted in one statement
+RECORD_USER_USAGES_CHUNK_SIZE = config("RECORD_USER_USAGES_CHUNK_SIZE", cast=int, default=1000)
+# usages taken from the cores are journaled here until they are written to the database
+USER_USAGES_SPOOL_PATH = config("USER_USAGES_SPOOL_PATH", default="user_usages.spool")
+# users' latest subscription fetches are buffered and written every JOB_FLUSH_SUB_UPDATES_INTERVAL seconds,
+# or as soon as this many users fetched theirs, the oldest are dropped past twice as many while they can't be written
+SUB_UPDATES_BUFFER_SIZE = config("SUB_UPDATES_BUFFER_SIZE", cast=int, default=10000)
+# users' online_at is only moved forward in steps of this many seconds
+USER_ONLINE_AT_GRANULARITY = config("USER_ONLINE_AT_GRANULARITY", cast=int, default=60)
+# hourly per-node user usages are rolled up into daily and monthly ones, and removed after this many days
+# set to 0 to keep them forever
+USER_USAGES_HOURLY_RETENTION_DAYS = config("USER_USAGES_HOURLY_RETENTION_DAYS", cast=int, default=90)
+# user counts of the users list are cached this many seconds (and dropped when users are created or removed)
+USERS_COUNT_CACHE_TTL = config("USERS_COUNT_CACHE_TTL", cast=int, default=30)
 
 # headers: profile-update-interval, support-url, profile-title
 SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
 SUB_SUPPORT_URL = config("SUB_SUPPORT_URL", default="https://t.me/")
 SUB_PROFILE_TITLE = config("SUB_PROFILE_TITLE", default="Subscription")
 
+# rendered subscriptions are cached until the user, the hosts or the core config change,
+# except those with hosts picking at random (several addresses, SNIs, hosts or short ids, or a * wildcard),
+# which are rendered on every fetch so users keep being spread over them
+# set SUB_CACHE_MAX_ENTRIES to 0 to disable the cache, SUB_CACHE_MAX_BYTES to 0 to only bound it by entries
+SUB_CACHE_MAX_ENTRIES = config("SUB_CACHE_MAX_ENTRIES", cast=int, default=10000)
+SUB_CACHE_MAX_BYTES = config("SUB_CACHE_MAX_BYTES", cast=int, default=64 * 1024 * 1024)
+
 # discord webhook log
 DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 
@@ -144,5 +189,20 @@ DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 JOB_CORE_HEALTH_CHECK_INTERVAL = config("JOB_CORE_HEALTH_CHECK_INTERVAL", cast=int, default=10)
 JOB_RECORD_NODE_USAGES_INTERVAL = config("JOB_RECORD_NODE_USAGES_INTERVAL", cast=int, default=30)
 JOB_RECORD_USER_USAGES_INTERVAL = config("JOB_RECORD_USER_USAGES_INTERVAL", cast=int, default=10)
+JOB_FLUSH_USER_USAGES_INTERVAL = config("JOB_FLUSH_USER_USAGES_INTERVAL", cast=int, default=10)
+JOB_ROLLUP_USER_USAGES_INTERVAL = config("JOB_ROLLUP_USER_USAGES_INTERVAL", cast=int, default=3600)
 JOB_REVIEW_USERS_INTERVAL = config("JOB_REVIEW_USERS_INTERVAL", cast=int, default=10)
 JOB_SEND_NOTIFICATIONS_INTERVAL = config("JOB_SEND_NOTIFICATIONS_INTERVAL", cast=int, default=30)
+JOB_REFRESH_USERS_COUNTERS_INTERVAL = config("JOB_REFRESH_USERS_COUNTERS_INTERVAL", cast=int, default=60)
+JOB_FLUSH_SUB_UPDATES_INTERVAL = config("JOB_FLUSH_SUB_UPDATES_INTERVAL", cast=int, default=5)
+JOB_CHECK_DRIFT_INTERVAL = config("JOB_CHECK_DRIFT_INTERVAL", cast=int, default=300)
+
+# a node is marked down after this many missed heartbeats in a row (it's only degraded before that)
+# and healthy again after this many successful ones, the heartbeat runs every JOB_CORE_HEALTH_CHECK_INTERVAL
+NODE_HEALTH_FAILURE_THRESHOLD = config("NODE_HEALTH_FAILURE_THRESHOLD", cast=int, default=3)
+NODE_HEALTH_RECOVERY_THRESHOLD = config("NODE_HEALTH_RECOVERY_THRESHOLD", cast=int, default=2)
+# upper bound of the exponential backoff between recovery attempts of a down node, in seconds
+NODE_HEALTH_MAX_BACKOFF = config("NODE_HEALTH_MAX_BACKOFF", cast=int, default=300)
+# nodes a core config is rolled out to at once, and seconds a node has to receive it
+NODE_ROLLOUT_MAX_WORKERS = config("NODE_ROLLOUT_MAX_WORKERS", cast=int, default=10)
+NODE_ROLLOUT_TIMEOUT = config("NODE_ROLLOUT_TIMEOUT", cast=int, default=60)
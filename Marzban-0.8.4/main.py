@@ -1,3 +1,4 @@
+import asyncio
 import click
 import logging
 import os
@@ -9,7 +10,8 @@ from cryptography.hazmat.backends import default_backend
 
 from app import app, logger
 from config import (DEBUG, UVICORN_HOST, UVICORN_PORT, UVICORN_SSL_CERTFILE,
-                    UVICORN_SSL_KEYFILE, UVICORN_SSL_CA_TYPE, UVICORN_UDS)
+                    UVICORN_SSL_KEYFILE, UVICORN_SSL_CA_TYPE, UVICORN_UDS,
+                    UVICORN_WORKERS)
 
 
 def validate_cert_and_key(cert_file_path, key_file_path, ca_type):
@@ -45,8 +47,10 @@ Self-signed CAs are useful in testing or internal use cases, they’re not suita
 
 
 if __name__ == "__main__":
-    # Do NOT change workers count for now
-    # multi-workers support isn't implemented yet for APScheduler and XRay module
+    # With more than one worker, this process becomes the controller: it runs the jobs,
+    # the core and the nodes, and the API workers forward their xray operations to it
+    # (see app.xray.controller)
+    workers = 1 if DEBUG else max(UVICORN_WORKERS, 1)
 
     bind_args = {}
     if UVICORN_SSL_CA_TYPE not in ["public", "private"]:
@@ -92,13 +96,26 @@ Then, navigate to {click.style(f'http://127.0.0.1:{UVICORN_PORT}', bold=True)} o
         bind_args['uds'] = None
         bind_args['host'] = '0.0.0.0'
 
+    controller_server = None
+    if workers > 1:
+        from app.xray import controller
+
+        asyncio.run(app.router.startup())
+        controller_server = controller.serve()
+        # read by config.py in the spawned workers
+        os.environ["MARZBAN_API_WORKER"] = "1"
+
     try:
         uvicorn.run(
             "main:app",
             **bind_args,
-            workers=1,
+            workers=workers,
             reload=DEBUG,
             log_level=logging.DEBUG if DEBUG else logging.INFO
         )
     except FileNotFoundError:  # to prevent error on removing unix sock
         pass
+    finally:
+        if controller_server is not None:
+            controller_server.close()
+            asyncio.run(app.router.shutdown())
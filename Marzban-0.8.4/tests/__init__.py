@@ -0,0 +1,36 @@
+"""
+Tests of the panel, run with `python -m pytest tests` from the project root.
+
+The environment is set up here, before anything imports `config`: the tests (and the
+benchmarks under tests/benchmarks) use a throwaway SQLite database and usage spool, and
+a stand-in for the xray executable, which is only asked for its version.
+"""
+
+import atexit
+import os
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = Path(tempfile.mkdtemp(prefix="marzban-tests-"))
+atexit.register(shutil.rmtree, TMP, ignore_errors=True)
+
+_xray = TMP / "xray"
+_xray.write_text(
+    '#!/bin/sh\n'
+    'case "$1" in\n'
+    '  version) echo "Xray 1.8.24 (Xray, Penetrates Everything.)";;\n'
+    '  x25519) printf "Private key: aaaa\\nPublic key: bbbb\\n";;\n'
+    'esac\n'
+)
+_xray.chmod(_xray.stat().st_mode | stat.S_IXUSR)
+
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URL": f"sqlite:///{TMP / 'db.sqlite3'}",
+    "USER_USAGES_SPOOL_PATH": str(TMP / "user_usages.spool"),
+    "XRAY_EXECUTABLE_PATH": str(_xray),
+    "XRAY_JSON": str(ROOT / "xray_config.json"),
+    "TELEGRAM_API_TOKEN": "",
+})
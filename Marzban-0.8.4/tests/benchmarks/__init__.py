@@ -0,0 +1,5 @@
+"""
+Benchmarks, run from the project root as modules, e.g. `python -m tests.benchmarks.subscription_hosts`.
+
+They aren't collected by pytest and use the same throwaway database as the tests.
+"""
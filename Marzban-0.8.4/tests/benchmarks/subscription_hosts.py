@@ -0,0 +1,181 @@
+"""
+Renders the subscriptions of a user on 20 inbounds with 10 hosts each, through the compiled
+hosts plan and through the per-host loop it replaced, which is kept below for comparison.
+"""
+
+import random
+import secrets
+import time
+import timeit
+from datetime import datetime
+
+from app import xray
+from app.models.proxy import ProxyTypes
+from app.models.user import UserResponse, UserStatus
+from app.subscription import share
+from app.subscription.cache import subscription_cache
+from app.xray.config import XRayConfig
+
+INBOUNDS = 20
+HOSTS = 10
+NUMBER = 50
+
+
+def legacy_process_inbounds_and_tags(inbounds, proxies, format_variables, conf, reverse=False):
+    """process_inbounds_and_tags as it was before the hosts plan, minus the unchanged bits."""
+    index_dict = {tag: index for index, tag in enumerate(xray.config.inbounds_by_tag.keys())}
+    inbounds = sorted(
+        ((protocol, tag) for protocol, tags in inbounds.items() for tag in tags),
+        key=lambda x: index_dict.get(x[1], float('inf'))
+    )
+
+    for protocol, tag in inbounds:
+        settings = proxies.get(protocol)
+        if not settings:
+            continue
+
+        format_variables.update({"PROTOCOL": protocol.name})
+        inbound = xray.config.inbounds_by_tag.get(tag)
+        if not inbound:
+            continue
+
+        format_variables.update({"TRANSPORT": inbound["network"]})
+        host_inbound = inbound.copy()
+        for host in xray.hosts.get(tag, []):
+            sni = ""
+            sni_list = host["sni"] or inbound["sni"]
+            if sni_list:
+                sni = random.choice(sni_list).replace("*", secrets.token_hex(8))
+
+            req_host = ""
+            req_host_list = host["host"] or inbound["host"]
+            if req_host_list:
+                req_host = random.choice(req_host_list).replace("*", secrets.token_hex(8))
+
+            address = ""
+            if host['address']:
+                address = random.choice(host['address']).replace('*', secrets.token_hex(8))
+
+            if host["path"] is not None:
+                path = host["path"].format_map(format_variables)
+            else:
+                path = inbound.get("path", "").format_map(format_variables)
+
+            host_inbound.update({
+                "port": host["port"] or inbound["port"],
+                "sni": sni,
+                "host": req_host,
+                "tls": inbound["tls"] if host["tls"] is None else host["tls"],
+                "alpn": host["alpn"] if host["alpn"] else None,
+                "path": path,
+                "fp": host["fingerprint"] or inbound.get("fp", ""),
+                "ais": host["allowinsecure"] or inbound.get("allowinsecure", ""),
+                "mux_enable": host["mux_enable"],
+                "fragment_setting": host["fragment_setting"],
+                "noise_setting": host["noise_setting"],
+                "random_user_agent": host["random_user_agent"],
+            })
+
+            conf.add(
+                remark=host["remark"].format_map(format_variables),
+                address=address.format_map(format_variables),
+                inbound=host_inbound,
+                settings=settings.model_dump()
+            )
+
+    return conf.render(reverse=reverse)
+
+
+def legacy_generate_v2ray_links(user: UserResponse) -> list:
+    format_variables = share.setup_format_variables(user.__dict__)
+    # they were all computed upfront
+    for name in share.FormatVariables._lazy:
+        format_variables[name]
+    return legacy_process_inbounds_and_tags(user.inbounds, user.proxies, format_variables, share.V2rayShareLink())
+
+
+def setup() -> UserResponse:
+    xray.config = XRayConfig({
+        "inbounds": [
+            {
+                "tag": f"VLESS WS {i}",
+                "protocol": "vless",
+                "port": 2000 + i,
+                "settings": {"clients": [], "decryption": "none"},
+                "streamSettings": {"network": "ws", "wsSettings": {"path": f"/{i}" if i % 2 else "/{USERNAME}"}},
+            } for i in range(INBOUNDS)
+        ],
+        "outbounds": [{"tag": "DIRECT", "protocol": "freedom"}],
+    })
+
+    hosts = {
+        tag: [{
+            "remark": f"{{USERNAME}} {tag} {j} [{{DAYS_LEFT}} days, {{DATA_LEFT}} left]" if j % 2 else f"{tag} {j}",
+            "address": [f"{j}.example.com"],
+            "port": None,
+            "path": None,
+            "sni": [],
+            "host": [],
+            "alpn": "",
+            "fingerprint": "",
+            "tls": None,
+            "allowinsecure": False,
+            "mux_enable": False,
+            "fragment_setting": None,
+            "noise_setting": None,
+            "random_user_agent": False,
+            "use_sni_as_host": False,
+        } for j in range(HOSTS)]
+        for tag in xray.config.inbounds_by_tag
+    }
+    dict.clear(xray.hosts)
+    dict.update(xray.hosts, hosts)
+    subscription_cache.bump()
+
+    return UserResponse(
+        username="benchmark",
+        proxies={ProxyTypes.VLESS: {}},
+        inbounds={ProxyTypes.VLESS: list(xray.config.inbounds_by_tag)},
+        status=UserStatus.active,
+        expire=int(time.time()) + 40 * 86400,
+        data_limit=100 * 1024 ** 3,
+        used_traffic=3 * 1024 ** 3,
+        created_at=datetime.utcnow(),
+        links=[],
+        subscription_url="",
+    )
+
+
+def main():
+    user = setup()
+
+    links = share.generate_v2ray_links(user.proxies, user.inbounds, user.__dict__, reverse=False)
+    assert links == legacy_generate_v2ray_links(user), "the hosts plan renders different links"
+    print(f"{len(links)} links ({INBOUNDS} inbounds x {HOSTS} hosts)")
+
+    def plan():
+        share.generate_v2ray_links(user.proxies, user.inbounds, user.__dict__, reverse=False)
+
+    def plan_rebuilt():
+        subscription_cache.bump()
+        plan()
+
+    def legacy():
+        legacy_generate_v2ray_links(user)
+
+    results = {}
+    for name, func in (("per-host loop", legacy), ("hosts plan, rebuilt", plan_rebuilt), ("hosts plan", plan)):
+        results[name] = min(timeit.repeat(func, number=NUMBER, repeat=3)) / NUMBER
+        print(f"{name:20} {results[name] * 1000:8.3f} ms")
+    print(f"speedup {results['per-host loop'] / results['hosts plan']:.2f}x")
+
+    for config_format in ("v2ray", "clash-meta", "sing-box", "v2ray-json"):
+        seconds = min(timeit.repeat(
+            lambda: share.generate_subscription(user=user, config_format=config_format, as_base64=False, reverse=False),
+            number=NUMBER // 5, repeat=3
+        )) / (NUMBER // 5)
+        print(f"{config_format:20} {seconds * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Searches users by username and note through the trigram index and with the plain
+`ilike('%term%')` scan it replaced, on 100k users (or the number given as argument).
+"""
+
+import random
+import string
+import sys
+import time
+
+from sqlalchemy import func, insert, or_
+
+from app.db import crud
+from app.db.base import Base, SessionLocal, engine
+from app.db.models import User, UserSearchGram
+from app.db.search import rebuild_user_search_grams, search_users_filter
+
+WORDS = ["vip", "family", "office", "trial", "reseller", "mobile", "ali", "reza", "test", "paid"]
+TERMS = ["vip_a", "k3x9", "_12345", "reseller_q", "office", "Family trial", "99999", "zzzz", "v", "of"]
+
+
+def populate(db, count: int):
+    rnd = random.Random(1)
+    rows = [{
+        "username": f"{rnd.choice(WORDS)}_{''.join(rnd.choices(string.ascii_lowercase + string.digits, k=8))}_{i}",
+        "note": " ".join(rnd.choices(WORDS, k=3)) if i % 3 else None,
+        "status": "active",
+        "used_traffic": 0,
+        "data_limit_reset_strategy": "no_reset",
+    } for i in range(count)]
+    for i in range(0, count, 10000):
+        db.execute(insert(User), rows[i:i + 10000])
+    db.commit()
+
+    started = time.perf_counter()
+    rebuild_user_search_grams(db)
+    print(f"indexed {count} users in {time.perf_counter() - started:.1f} s, "
+          f"{db.query(func.count()).select_from(UserSearchGram).scalar()} trigrams")
+
+
+def timed(query):
+    started = time.perf_counter()
+    ids = {user_id for user_id, in query}
+    return ids, time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    if db.query(func.count(User.id)).scalar() < count:
+        populate(db, count)
+
+    print(f"{'term':16} {'matches':>8} {'ilike':>10} {'index':>10}")
+    for term in TERMS:
+        scan = or_(User.username.icontains(term, autoescape=True), User.note.icontains(term, autoescape=True))
+        expected, scan_seconds = timed(db.query(User.id).filter(scan))
+        ids, index_seconds = timed(db.query(User.id).filter(search_users_filter(term)))
+        assert ids == expected, f"the index finds different users for {term!r}"
+        print(f"{term!r:16} {len(ids):8} {scan_seconds * 1000:8.1f}ms {index_seconds * 1000:8.1f}ms")
+
+    started = time.perf_counter()
+    users, total = crud.get_users(db, search="reza_1", limit=10, return_with_count=True)
+    print(f"get_users(search='reza_1', limit=10): {total} users, first {users[0].username!r} "
+          f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
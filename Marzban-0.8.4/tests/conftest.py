@@ -0,0 +1,99 @@
+import copy
+import itertools
+
+import pytest
+
+from app import xray
+from app.db import GetDB, crud
+from app.db.base import Base, engine
+from app.models.user import UserCreate
+from app.xray.config import XRayConfig
+
+CONFIG = {
+    "log": {"loglevel": "warning"},
+    "inbounds": [
+        {
+            "tag": "VLESS TCP REALITY",
+            "protocol": "vless",
+            "port": 8443,
+            "settings": {"clients": [], "decryption": "none"},
+            "streamSettings": {
+                "network": "tcp",
+                "security": "reality",
+                "realitySettings": {
+                    "dest": "example.com:443",
+                    "serverNames": ["example.com"],
+                    "privateKey": "kKPN8bGrxlBCJ5RUUo9hZ4LcTwm2Z7Dpp0ggUmjq7RY",
+                    "shortIds": ["", "ab12"],
+                },
+            },
+        },
+        {
+            "tag": "VLESS WS",
+            "protocol": "vless",
+            "port": 2053,
+            "settings": {"clients": [{"id": "5d3f5bd8-4c0c-4a5e-8f0a-2c1b1e0b7a11", "email": "static"}],
+                         "decryption": "none"},
+            "streamSettings": {"network": "ws", "wsSettings": {"path": "/vless"}},
+        },
+        {
+            "tag": "VMess WS",
+            "protocol": "vmess",
+            "port": 2083,
+            "settings": {"clients": []},
+            "streamSettings": {"network": "ws", "wsSettings": {"path": "/vmess"}},
+        },
+        {
+            "tag": "Trojan gRPC",
+            "protocol": "trojan",
+            "port": 2087,
+            "settings": {"clients": []},
+            "streamSettings": {"network": "grpc", "grpcSettings": {"serviceName": "trojan"}},
+        },
+        {
+            "tag": "Shadowsocks TCP",
+            "protocol": "shadowsocks",
+            "port": 1080,
+            "settings": {"clients": [], "network": "tcp,udp"},
+        },
+    ],
+    "outbounds": [
+        {"tag": "DIRECT", "protocol": "freedom"},
+        {"tag": "BLOCK", "protocol": "blackhole"},
+    ],
+    "routing": {"rules": []},
+}
+
+Base.metadata.create_all(engine)
+xray.config = XRayConfig(CONFIG, api_port=62789)
+
+_usernames = itertools.count()
+
+
+@pytest.fixture
+def raw_config() -> dict:
+    """A copy of the core config the tests run with, to be modified."""
+    return copy.deepcopy(CONFIG)
+
+
+@pytest.fixture
+def db():
+    with GetDB() as db:
+        yield db
+
+
+@pytest.fixture
+def create_user(db):
+    """Creates users with unique usernames, their proxies on every inbound of the test config by default."""
+    def create_user(proxies: dict = None, **fields):
+        proxies = proxies or {"vless": {}, "vmess": {}}
+        fields.setdefault("username", f"user{next(_usernames)}")
+        # as the API always sends them
+        fields.setdefault("inbounds", {
+            proxy_type: [inbound["tag"] for inbound in xray.config.inbounds_by_protocol.get(proxy_type, [])]
+            for proxy_type in proxies
+        })
+        user = UserCreate(proxies=proxies, **fields)
+        return crud.create_user(db, user)
+
+    return create_user
@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import grpc
+import pytest
+
+from app import xray
+from app.utils.concurrency import run_coroutine
+from app.xray import node, queues, reconcile
+from xray_api import XRay as XRayAPI
+from xray_api.aio import fan_out, get_async_api
+
+
+class FakeAsyncAPI:
+    """Stands in for the async client of a core, failing the calls for the emails it's told to."""
+
+    def __init__(self, failures=()):
+        self.failures = dict(failures)
+        self.added = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def add_inbound_user(self, tag, user, timeout=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.001)
+            if user.email in self.failures:
+                raise self.failures[user.email]
+            self.added.append((tag, user.email))
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.fixture
+def node_queues():
+    node_ids = (901, 902)
+    for node_id in node_ids:
+        queues.reset_ledger(node_id, {})
+    yield node_ids
+    for node_id in node_ids:
+        queues.remove_queue(node_id)
+
+
+def test_async_clients_are_cached_until_released():
+    api = XRayAPI("127.0.0.1", 1)
+
+    async def get():
+        return get_async_api(api)
+
+    client = run_coroutine(get())
+    assert run_coroutine(get()) is client
+
+    node.close_async_api(api)
+
+    assert client._channel.get_state() == grpc.ChannelConnectivity.SHUTDOWN
+    assert run_coroutine(get()) is not client
+    node.close_async_api(api)
+
+
+def test_fan_out_keeps_the_results_of_every_client():
+    async def call(client):
+        if client == "down":
+            raise ConnectionError(client)
+        await asyncio.sleep(0.01)
+        return client
+
+    results = run_coroutine(fan_out({1: "up", 2: "down", 3: "up"}, call, limit=2))
+
+    assert results[1] == results[3] == "up"
+    assert isinstance(results[2], ConnectionError)
+
+
+def test_failed_reconcile_calls_dont_stop_the_others(monkeypatch, node_queues):
+    monkeypatch.setattr(reconcile, "get_async_api", lambda api: api)
+    monkeypatch.setattr(reconcile, "XRAY_RECONCILE_BATCH_SIZE", 10)
+    user_operations = [("add", "VLESS WS", SimpleNamespace(email=f"{i}.user")) for i in range(25)]
+    failing = {"3.user": xray.exc.TimeoutError("deadline exceeded"), "17.user": RuntimeError("broken")}
+    apis = {901: FakeAsyncAPI(failing), 902: FakeAsyncAPI()}
+
+    run_coroutine(reconcile._fan_out_operations(apis, user_operations))
+
+    assert len(apis[901].added) == 23
+    assert len(apis[902].added) == 25
+    assert apis[902].max_in_flight <= 10
+    ledger = queues.get_queue(901).snapshot()[0]["VLESS WS"]
+    assert len(ledger) == 23 and not ledger & set(failing)
+    assert len(queues.get_queue(902).snapshot()[0]["VLESS WS"]) == 25
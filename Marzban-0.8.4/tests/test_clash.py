@@ -0,0 +1,109 @@
+import random
+
+import jinja2
+import pytest
+
+from app.models.user import UserResponse
+from app.subscription import clash, share
+
+PROXIES = {
+    "all": {"vless": {"flow": "xtls-rprx-vision"}, "vmess": {}, "trojan": {}, "shadowsocks": {}},
+    "vmess": {"vmess": {}},
+    "none": {},
+}
+
+
+@pytest.fixture(autouse=True)
+def skeletons(monkeypatch):
+    monkeypatch.setattr(clash, "_skeletons", {})
+    return clash._skeletons
+
+
+@pytest.fixture
+def render(create_user, monkeypatch):
+    """Renders a clash subscription of a user with `proxies`, with jinja or directly."""
+    users = {}
+
+    def render(proxies: str, config_format: str, reverse: bool, direct: bool) -> str:
+        if proxies not in users:
+            users[proxies] = UserResponse.model_validate(create_user(proxies=PROXIES[proxies] or None))
+        user = users[proxies]
+        if proxies == "none":
+            user = user.model_copy(update={"proxies": {}, "inbounds": {}})
+
+        monkeypatch.setattr(clash, "CLASH_DIRECT_RENDER", direct)
+        # hosts with several addresses or SNIs pick one at random
+        random.seed(1)
+        return share.generate_subscription(user=user, config_format=config_format, as_base64=False, reverse=reverse)
+
+    return render
+
+
+@pytest.mark.parametrize("config_format", ["clash", "clash-meta"])
+@pytest.mark.parametrize("proxies", list(PROXIES))
+@pytest.mark.parametrize("reverse", [False, True])
+def test_direct_render_is_identical_to_jinja(render, skeletons, config_format, proxies, reverse):
+    expected = render(proxies, config_format, reverse, direct=False)
+
+    # the first render checks the skeleton against jinja, the next ones only use it
+    assert render(proxies, config_format, reverse, direct=True) == expected
+    assert render(proxies, config_format, reverse, direct=True) == expected
+
+    [skeleton] = skeletons.values()
+    assert skeleton.verified and skeleton.document is not None
+
+
+def test_flag_emojis_are_not_escaped(render):
+    render("vmess", "clash-meta", False, direct=True)
+    text = render("vmess", "clash-meta", False, direct=True)
+
+    # the default hosts' remarks start with one
+    assert "🚀" in text
+    assert "\\U" not in text
+
+
+def test_templates_using_the_lists_keep_being_rendered_by_jinja(render, skeletons, monkeypatch):
+    template = jinja2.Environment().from_string(
+        "proxies:\n"
+        "{% for proxy in conf['proxies'] %}"
+        "- name: {{ proxy['name'] | tojson }}\n"
+        "  server: {{ proxy['server'] }}\n"
+        "{% endfor %}"
+    )
+    monkeypatch.setattr(clash, "get_template", lambda name: template)
+    expected = render("all", "clash", False, direct=False)
+
+    assert render("all", "clash", False, direct=True) == expected
+    assert render("all", "clash", False, direct=True) == expected
+
+    [skeleton] = skeletons.values()
+    assert skeleton.document is None
+
+
+@pytest.fixture
+def dumps(monkeypatch):
+    """The dumpers of every yaml.dump of the direct render."""
+    dumps = []
+    dump = clash.yaml.dump
+
+    def counting_dump(*args, **kwargs):
+        dumps.append(kwargs.get("Dumper"))
+        return dump(*args, **kwargs)
+
+    monkeypatch.setattr(clash.yaml, "dump", counting_dump)
+    return dumps
+
+
+def test_configurations_are_dumped_once(render, skeletons, dumps):
+    render("all", "clash-meta", False, direct=True)
+    dumps.clear()
+
+    # the default hosts' remarks have emojis, which libyaml would escape
+    render("all", "clash-meta", False, direct=True)
+    assert dumps == [clash.yaml.SafeDumper]
+
+    [skeleton] = skeletons.values()
+    dumps.clear()
+    skeleton.render({"proxies": [{"name": "plain", "type": "vmess"}], "proxy-groups": [],
+                     "rules": [], "proxy_remarks": ["plain"]})
+    assert dumps == [clash.CSafeDumper]
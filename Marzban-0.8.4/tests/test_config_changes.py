@@ -0,0 +1,152 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app import xray
+from app.xray import operations, queues
+from app.xray.config import ConfigDiff, XRayConfig
+from app.xray.handlers import HandlerChanges, build_inbound, build_outbound
+from xray_api.proto.proxy.blackhole import config_pb2 as blackhole_pb2
+from xray_api.proto.proxy.vless.inbound import config_pb2 as vless_pb2
+from xray_api.proto.proxy.vmess.inbound import config_pb2 as vmess_pb2
+
+
+def inbound(config: dict, tag: str) -> dict:
+    return next(inbound for inbound in config["inbounds"] if inbound["tag"] == tag)
+
+
+class FakeAPI:
+    """Records the HandlerService calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(handler, timeout=None):
+            self.calls.append((name, getattr(handler, "tag", handler)))
+        return call
+
+
+@pytest.fixture
+def running(monkeypatch, raw_config):
+    """The test config running on a fake main core, returns the API calls and the restarts."""
+    api = FakeAPI()
+    restarts = []
+    config = XRayConfig(raw_config, api_port=62789)
+    monkeypatch.setattr(xray, "config", config)
+    monkeypatch.setattr(xray, "api", api)
+    monkeypatch.setattr(xray, "core", SimpleNamespace(started=True, restart=lambda config: restarts.append(config),
+                                                      get_x25519=xray.core.get_x25519))
+    monkeypatch.setattr(xray.reconcile, "restart_all", lambda force=False: restarts.append(None))
+    queues.reset_ledger(None, config.include_db_users())
+    return api, restarts
+
+
+def test_unchanged_config_has_no_diff(raw_config):
+    diff = ConfigDiff(XRayConfig(raw_config), XRayConfig(raw_config))
+
+    assert not diff
+    assert diff.restart_reasons == []
+
+
+def test_modified_handlers_are_removed_and_added_again(raw_config):
+    old = XRayConfig(raw_config)
+    inbound(raw_config, "VMess WS")["streamSettings"]["wsSettings"]["path"] = "/vmess2"
+    raw_config["inbounds"] = [i for i in raw_config["inbounds"] if i["tag"] != "Shadowsocks TCP"]
+    raw_config["inbounds"].append({"tag": "VLESS HU", "protocol": "vless", "port": 2096,
+                                   "settings": {"clients": [], "decryption": "none"},
+                                   "streamSettings": {"network": "httpupgrade"}})
+    raw_config["outbounds"][1]["settings"] = {"response": {"type": "http"}}
+
+    diff = ConfigDiff(old, XRayConfig(raw_config))
+
+    assert diff.restart_reasons == []
+    assert diff.removed_inbounds == ["VMess WS", "Shadowsocks TCP"]
+    assert [i["tag"] for i in diff.added_inbounds] == ["VMess WS", "VLESS HU"]
+    assert diff.removed_outbounds == ["BLOCK"]
+    assert [o["tag"] for o in diff.added_outbounds] == ["BLOCK"]
+
+
+@pytest.mark.parametrize("change, reason", [
+    (lambda config: config["log"].update(loglevel="debug"), "log"),
+    (lambda config: config.update(dns={"servers": ["1.1.1.1"]}), "dns"),
+    (lambda config: config["outbounds"].insert(0, {"tag": "WARP", "protocol": "wireguard"}), "default outbound"),
+    (lambda config: config["outbounds"].append({"tag": "DIRECT", "protocol": "blackhole"}), "outbounds"),
+])
+def test_changes_needing_a_restart(raw_config, change, reason):
+    old = XRayConfig(raw_config)
+    change(raw_config)
+
+    assert reason in ConfigDiff(old, XRayConfig(raw_config)).restart_reasons
+
+
+def test_handler_changes_carry_the_users(raw_config, create_user):
+    user = create_user(proxies={"vless": {}, "vmess": {}})
+    email = f"{user.id}.{user.username}"
+    old = XRayConfig(raw_config)
+    inbound(raw_config, "VLESS WS")["streamSettings"]["wsSettings"]["path"] = "/vless2"
+    new = XRayConfig(raw_config)
+
+    changes = HandlerChanges(ConfigDiff(old, new), new.users_clients.get())
+
+    assert changes.removed_inbounds == ["VLESS WS"]
+    assert {"static", email} <= changes.ledger["VLESS WS"]
+    [message] = changes.inbounds
+    settings = vless_pb2.Config.FromString(message.proxy_settings.value)
+    assert email in [client.email for client in settings.clients]
+    assert len(settings.clients) == len(changes.ledger["VLESS WS"])
+
+
+def test_handlers_are_built(raw_config):
+    for config_inbound in raw_config["inbounds"]:
+        message = build_inbound(config_inbound, [])
+        assert message.tag == config_inbound["tag"]
+
+    message = build_inbound(inbound(raw_config, "VMess WS"), [{"email": "1.a", "id": "0b7e2c6e-2dd6-4f17-b4a4-d66e3a9f1c3b"}])
+    assert message.proxy_settings.type == "xray.proxy.vmess.inbound.Config"
+    assert [user.email for user in vmess_pb2.Config.FromString(message.proxy_settings.value).user] == ["1.a"]
+
+    message = build_outbound({"tag": "BLOCK", "protocol": "blackhole", "settings": {"response": {"type": "http"}}})
+    response = blackhole_pb2.Config.FromString(message.proxy_settings.value).response
+    assert response.type == "xray.proxy.blackhole.HTTPResponse"
+
+
+@pytest.mark.parametrize("change", [
+    lambda config: inbound(config, "VMess WS")["streamSettings"]["wsSettings"].update(path="/vmess?ed=2048"),
+    lambda config: inbound(config, "VLESS WS")["streamSettings"].update(network="kcp"),
+    lambda config: inbound(config, "VLESS WS").update(allocate={"strategy": "always"}),
+    lambda config: config["outbounds"].append({"tag": "WARP", "protocol": "wireguard"}),
+])
+def test_unsupported_changes_raise(raw_config, change):
+    old = XRayConfig(raw_config)
+    change(raw_config)
+
+    with pytest.raises(ValueError):
+        HandlerChanges(ConfigDiff(old, XRayConfig(raw_config)), {})
+
+
+def test_apply_config_swaps_the_handlers(running, raw_config):
+    api, restarts = running
+    inbound(raw_config, "VMess WS")["streamSettings"]["wsSettings"]["path"] = "/vmess2"
+    raw_config["inbounds"] = [i for i in raw_config["inbounds"] if i["tag"] != "Shadowsocks TCP"]
+
+    operations.apply_config(XRayConfig(raw_config, api_port=62789))
+
+    assert api.calls == [("remove_inbound", "VMess WS"), ("remove_inbound", "Shadowsocks TCP"),
+                         ("add_inbound", "VMess WS")]
+    assert restarts == []
+    assert "Shadowsocks TCP" not in queues.get_queue(None).snapshot()[0]
+
+
+@pytest.mark.parametrize("change", [
+    lambda config: config["log"].update(loglevel="debug"),
+    lambda config: inbound(config, "VMess WS")["streamSettings"]["wsSettings"].update(path="/vmess?ed=2048"),
+])
+def test_apply_config_restarts_the_cores_otherwise(running, raw_config, change):
+    api, restarts = running
+    change(raw_config)
+
+    operations.apply_config(XRayConfig(raw_config, api_port=62789))
+
+    assert api.calls == []
+    assert restarts == [None]
@@ -0,0 +1,66 @@
+import uuid
+
+import pytest
+
+from app.db import crud
+from app.db.counters import UsersCounters, users_counters
+from app.models.admin import AdminCreate
+from app.models.user import UserStatus
+
+
+@pytest.fixture
+def counters(db):
+    """The live counters, loaded before the test so it only sees the changes applied to them."""
+    users_counters.refresh(db)
+    yield users_counters
+    users_counters.invalidate()
+
+
+def assert_counts(db, counters):
+    expected = UsersCounters()
+    expected.refresh(db)
+    assert not counters.stale
+    assert {key: count for key, count in counters.counts.items() if count} == dict(expected.counts)
+
+
+def test_user_changes_are_applied_incrementally(db, create_user, counters):
+    admin = crud.create_admin(db, AdminCreate(username=f"admin_{uuid.uuid4().hex[:8]}", password="x",
+                                              is_sudo=False))
+    users_counters.refresh(db)  # knows the new admin
+    total = counters.count(db)
+
+    user = create_user()
+    other = create_user()
+    assert counters.count(db) == total + 2
+    assert_counts(db, counters)
+
+    crud.update_user_status(db, user, UserStatus.disabled)
+    crud.set_owner(db, other, admin)
+    assert counters.count(db, UserStatus.active, admin.username) == 1
+    assert_counts(db, counters)
+
+    crud.remove_user(db, user)
+    assert counters.count(db) == total + 1
+    assert_counts(db, counters)
+
+
+def test_rolled_back_changes_are_discarded(db, create_user, counters):
+    user = create_user()
+    counts = dict(counters.counts)
+
+    user.status = UserStatus.disabled
+    db.flush()
+    db.rollback()
+
+    assert dict(counters.counts) == counts
+    assert_counts(db, counters)
+
+
+def test_users_of_unknown_admins_reload_them(db, create_user, counters):
+    admin = crud.create_admin(db, AdminCreate(username=f"admin_{uuid.uuid4().hex[:8]}", password="x",
+                                              is_sudo=False))
+    crud.set_owner(db, create_user(), admin)
+
+    assert counters.stale
+    assert counters.count(db, admin=admin.username) == 1
+    assert_counts(db, counters)
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app import xray
+from app.xray import queues, reconcile
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """The queue of the fake main core, recording the repairs put."""
+    monkeypatch.setattr(xray, "core", SimpleNamespace(started=True))
+    monkeypatch.setattr(xray, "nodes", {})
+    queue = queues.get_queue(None)
+    monkeypatch.setattr(queue, "repairs", [], raising=False)
+    monkeypatch.setattr(queue, "put", lambda action, tag, email, account=None: queue.repairs.append(
+        (action, tag, email, getattr(account, "email", None))))
+    return queue
+
+
+def start(queue):
+    """(Re)starts the fake main core with the users' current clients."""
+    queue.reset_ledger(xray.config.include_db_users(rebuild=True))
+
+
+def test_no_drift(queue, create_user):
+    create_user()
+    start(queue)
+
+    assert reconcile.check_drift() == {None: (0, 0)}
+    assert queue.repairs == []
+    assert (queue.stats()["missing"], queue.stats()["extra"]) == (0, 0)
+
+
+def test_drift_is_repaired(queue, create_user):
+    user = create_user(proxies={"vless": {}})
+    email = f"{user.id}.{user.username}"
+    start(queue)
+    queue.ledger["VLESS WS"].discard(email)
+    queue.ledger["VLESS WS"].add("999999.ghost")
+    repaired = queue.stats()["repaired"]
+
+    assert reconcile.check_drift(repair=False) == {None: (1, 1)}
+    assert queue.repairs == []
+    assert (queue.stats()["missing"], queue.stats()["extra"]) == (1, 1)
+
+    assert reconcile.check_drift() == {None: (1, 1)}
+    assert sorted(queue.repairs) == [("add", "VLESS WS", email, email), ("remove", "VLESS WS", "999999.ghost", None)]
+    assert queue.stats()["repaired"] == repaired + 2
+
+    queue.acknowledge(repair[:3] for repair in queue.repairs)
+    assert reconcile.check_drift() == {None: (0, 0)}
+
+
+def test_static_and_busy_clients_are_left_out(queue, create_user):
+    user = create_user(proxies={"vless": {}})
+    email = f"{user.id}.{user.username}"
+    start(queue)
+    queue.ledger["VLESS WS"].discard(email)
+    # an operation for the user is pending
+    queue._pending[("VLESS WS", email)] = ("add", None, 0)
+    try:
+        assert "static" in queue.ledger["VLESS WS"]
+        assert reconcile.check_drift() == {None: (0, 0)}
+    finally:
+        queue._pending.clear()
+
+
+def test_cores_without_a_ledger_are_skipped(queue):
+    start(queue)
+    queue.ledger = None
+
+    assert reconcile.check_drift() == {}
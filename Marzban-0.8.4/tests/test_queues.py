@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from app import xray
+from app.xray import queues
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class FakeCore:
+    """Stands in for the Xray API of a core, failing the calls it's told to."""
+
+    def __init__(self):
+        self.calls = []
+        self.failures = {}
+        self.release = threading.Event()
+        self.release.set()
+
+    async def apply_batch(self, api, batch):
+        self.release.wait()
+        results = []
+        for (inbound_tag, email), (action, account, tries) in batch:
+            self.calls.append((action, inbound_tag, email))
+            failures = self.failures.get(email)
+            results.append(failures.pop(0) if failures else None)
+        return results
+
+
+@pytest.fixture
+def core(monkeypatch):
+    core = FakeCore()
+    monkeypatch.setattr(queues, "_apply_batch", core.apply_batch)
+    monkeypatch.setattr(queues, "get_async_api", lambda api: api)
+    monkeypatch.setattr(queues, "JOB_CORE_HEALTH_CHECK_INTERVAL", 0.05)
+    return core
+
+
+@pytest.fixture
+def queue():
+    queue = queues.OperationQueue(None)
+    queue._api = lambda: object()
+    queue.reset_ledger({"inbounds": [{"tag": "VLESS WS", "settings": {"clients": [{"email": "1.a"}]}}]})
+    yield queue
+    queue.close()
+
+
+def test_operations_of_a_user_are_coalesced(core, queue):
+    core.release.clear()
+    queue.put("add", "VLESS WS", "0.blocker")
+    wait_for(lambda: core.calls == [] and len(queue) == 0)
+
+    queue.put("add", "VLESS WS", "2.b")
+    queue.put("alter", "VLESS WS", "2.b")
+    queue.put("remove", "VLESS WS", "1.a")
+    queue.put("add", "VLESS WS", "1.a")
+    core.release.set()
+    wait_for(lambda: queue.stats()["processed"] == 3)
+
+    # the add following a pending remove may find the user still there
+    assert core.calls[1:] == [("alter", "VLESS WS", "2.b"), ("alter", "VLESS WS", "1.a")]
+    assert queue.stats()["coalesced"] == 2
+    assert queue.snapshot() == ({"VLESS WS": {"0.blocker", "1.a", "2.b"}}, set())
+
+
+def test_failed_connections_are_retried(core, queue):
+    core.failures["2.b"] = [xray.exc.ConnectionError("down"), xray.exc.TimeoutError("slow")]
+    core.failures["3.c"] = [xray.exc.ConnectionError("down")] * (queues.XRAY_OPERATIONS_RETRIES + 1)
+    core.failures["4.d"] = [xray.exc.TagNotFoundError("no inbound", "VLESS WS")]
+
+    for email in ("2.b", "3.c", "4.d"):
+        queue.put("add", "VLESS WS", email)
+    wait_for(lambda: len(queue) == 0 and not queue._draining)
+
+    stats = queue.stats()
+    assert core.calls.count(("add", "VLESS WS", "2.b")) == 3
+    assert core.calls.count(("add", "VLESS WS", "3.c")) == queues.XRAY_OPERATIONS_RETRIES + 1
+    assert (stats["processed"], stats["failed"], stats["dropped"]) == (1, 1, 1)
+    assert stats["retried"] == 2 + queues.XRAY_OPERATIONS_RETRIES
+    assert queue.snapshot()[0]["VLESS WS"] == {"1.a", "2.b"}
+
+
+def test_operations_of_a_core_that_is_down_are_dropped(core, queue):
+    queue._api = lambda: None
+
+    queue.put("remove", "VLESS WS", "1.a")
+    wait_for(lambda: queue.stats()["dropped"] == 1)
+
+    assert core.calls == []
+    assert queue.snapshot()[0]["VLESS WS"] == {"1.a"}
+
+
+def test_queue_recovers_from_a_failed_drain(core, queue):
+    def broken_api():
+        queue._api = lambda: object()
+        raise RuntimeError("api broke")
+
+    queue._api = broken_api
+    queue.put("add", "VLESS WS", "2.b")
+    wait_for(lambda: queue.stats()["dropped"] == 1 and not queue._draining)
+
+    queue.put("add", "VLESS WS", "3.c")
+    wait_for(lambda: queue.stats()["processed"] == 1)
+    assert core.calls == [("add", "VLESS WS", "3.c")]
+    assert queue.snapshot()[1] == set()
+
+
+def test_put_gives_up_on_a_full_queue(core, queue, monkeypatch):
+    monkeypatch.setattr(queues, "XRAY_OPERATIONS_QUEUE_SIZE", 2)
+    monkeypatch.setattr(queues, "XRAY_OPERATIONS_PUT_TIMEOUT", 0.2)
+    # nothing drains it
+    queue._schedule = lambda delay=0: None
+
+    queue.put("add", "VLESS WS", "2.b")
+    queue.put("add", "VLESS WS", "3.c")
+    started = time.monotonic()
+    queue.put("add", "VLESS WS", "4.d")
+
+    assert time.monotonic() - started >= 0.2
+    # an operation replacing a pending one always fits
+    queue.put("remove", "VLESS WS", "3.c")
+    assert len(queue) == 2
+    assert queue.stats()["dropped"] == 1
+
+
+def test_put_waits_for_room_in_the_queue(core, queue, monkeypatch):
+    monkeypatch.setattr(queues, "XRAY_OPERATIONS_QUEUE_SIZE", 1)
+    monkeypatch.setattr(queues, "XRAY_OPERATIONS_BATCH_SIZE", 1)
+    core.release.clear()
+
+    queue.put("add", "VLESS WS", "2.b")
+    queue.put("add", "VLESS WS", "3.c")
+    threading.Timer(0.1, core.release.set).start()
+    queue.put("add", "VLESS WS", "4.d")
+    wait_for(lambda: queue.stats()["processed"] == 3)
+
+    assert queue.stats()["dropped"] == 0
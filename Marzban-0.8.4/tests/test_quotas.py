@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+
+from app import xray
+from app.db import crud
+from app.db.quotas import user_quotas
+from app.jobs import record_usages, review_users
+from app.models.user import UserModify, UserStatus
+from app.utils.spool import Spool
+
+
+@pytest.fixture
+def quotas(db):
+    user_quotas.refresh(db)
+    user_quotas.take_exceeded()
+    yield user_quotas
+    user_quotas.invalidate()
+
+
+@pytest.fixture
+def removed(tmp_path, monkeypatch):
+    """Users removed from the cores, the usages go through a spool of the test."""
+    monkeypatch.setattr(record_usages, "usage_spool", Spool(str(tmp_path / "usages.spool")))
+    removed = []
+    monkeypatch.setattr(xray.operations, "remove_user", lambda dbuser: removed.append(dbuser.id))
+    return removed
+
+
+def collect(user, value: int):
+    nodes = [{"node_id": None, "coefficient": 1, "params": [{"uid": str(user.id), "value": value}]}]
+    record_usages.usage_spool.append({"created_at": datetime.utcnow().isoformat(), "nodes": nodes})
+    record_usages.enforce_data_limits(nodes)
+
+
+def test_quotas_follow_the_users(db, create_user, quotas):
+    user = create_user(data_limit=1000)
+    unlimited = create_user()
+    assert quotas.remaining[user.id] == 1000
+    assert unlimited.id not in quotas.remaining
+
+    user = crud.update_user(db, user, UserModify(data_limit=3000))
+    assert quotas.remaining[user.id] == 3000 - user.used_traffic
+
+    crud.update_user_status(db, user, UserStatus.disabled)
+    assert user.id not in quotas.remaining
+
+    crud.update_user_status(db, user, UserStatus.active)
+    assert quotas.remaining[user.id] == 3000
+    crud.remove_user(db, user)
+    assert user.id not in quotas.remaining
+
+
+def test_users_running_out_are_limited_right_away(db, create_user, quotas, removed):
+    user = create_user(data_limit=1000)
+    other = create_user(data_limit=1000)
+
+    collect(user, 600)
+    collect(other, 600)
+    assert quotas.take_exceeded() == []
+    assert quotas.remaining[user.id] == 400
+
+    collect(user, 500)
+    # flushed so the review sees the usage
+    db.refresh(user)
+    assert user.used_traffic == 1100
+
+    review_users.review_exceeded_users()
+    db.refresh(user)
+    assert user.status == UserStatus.limited
+    assert removed == [user.id]
+    assert user.id not in quotas.remaining
+    assert quotas.take_exceeded() == []
+
+
+def test_out_of_date_quotas_are_reset_by_the_review(db, create_user, quotas, removed):
+    user = create_user(data_limit=1000)
+    quotas.set(user.id, 100)
+
+    collect(user, 200)
+    review_users.review_exceeded_users()
+
+    db.refresh(user)
+    assert user.status == UserStatus.active
+    assert removed == []
+    assert quotas.remaining[user.id] == 800
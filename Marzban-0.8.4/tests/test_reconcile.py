@@ -0,0 +1,72 @@
+import pytest
+
+from app import xray
+from app.db import crud
+from app.models.user import UserModify, UserStatus
+from app.xray import operations, queues, reconcile
+from xray_api.types.account import XTLSFlows
+
+VISION = "xtls-rprx-vision"
+
+
+@pytest.fixture
+def put(monkeypatch):
+    """The operations queued for the cores, as (action, inbound tag, email[, account])."""
+    calls = []
+    monkeypatch.setattr(queues, "put", lambda *args: calls.append(args))
+    return calls
+
+
+def test_operations_of_active_and_disabled_users(db, create_user):
+    active = create_user(proxies={"vless": {}})
+    disabled = crud.update_user_status(db, create_user(proxies={"vmess": {}}), UserStatus.disabled)
+
+    count, user_operations = reconcile.get_user_operations([active.id, disabled.id, active.id])
+
+    assert count == 2
+    added = {(action, tag, account.email) for action, tag, account in user_operations if action == "add"}
+    removed = {(action, tag, email) for action, tag, email in user_operations if action == "remove"}
+    active_email, disabled_email = f"{active.id}.{active.username}", f"{disabled.id}.{disabled.username}"
+    assert added == {("add", "VLESS TCP REALITY", active_email), ("add", "VLESS WS", active_email)}
+    assert removed == {("remove", tag, disabled_email) for tag in xray.config.inbounds_by_tag}
+
+
+def test_flow_is_only_kept_on_xtls_inbounds(db, create_user, put):
+    user = create_user(proxies={"vless": {"flow": VISION}})
+
+    _, user_operations = reconcile.get_user_operations([user.id])
+    operations.add_user(user)
+
+    expected = {"VLESS TCP REALITY": XTLSFlows.VISION, "VLESS WS": XTLSFlows.NONE}
+    assert {tag: account.flow for _, tag, account in user_operations} == expected
+    assert {tag: account.flow for _, tag, _, account in put} == expected
+    clients = xray.config.users_clients.query()
+    assert clients["VLESS TCP REALITY"][user.id]["flow"] == VISION
+    assert "flow" not in clients["VLESS WS"][user.id]
+
+
+def test_update_user_removes_the_excluded_inbounds(db, create_user, put):
+    user = create_user(proxies={"vless": {}})
+    user = crud.update_user(db, user, UserModify(proxies={"vless": {}}, inbounds={"vless": ["VLESS WS"]}))
+
+    operations.update_user(user)
+
+    actions = {call[:2] for call in put}
+    assert ("alter", "VLESS WS") in actions
+    assert ("remove", "VLESS TCP REALITY") in actions
+    assert ("alter", "VLESS TCP REALITY") not in actions
+
+
+def test_big_changes_restart_the_cores(db, create_user, monkeypatch):
+    users = [create_user(), create_user()]
+    calls = []
+    monkeypatch.setattr(reconcile, "restart_all", lambda force=False: calls.append("restart"))
+    monkeypatch.setattr(reconcile, "apply_operations", lambda user_operations: calls.append(len(user_operations)))
+
+    monkeypatch.setattr(reconcile, "XRAY_RECONCILE_RESTART_THRESHOLD", 1)
+    reconcile.reconcile_users([user.id for user in users])
+    monkeypatch.setattr(reconcile, "XRAY_RECONCILE_RESTART_THRESHOLD", 2)
+    reconcile.reconcile_users([user.id for user in users])
+
+    # 3 inbounds for each user
+    assert calls == ["restart", 6]
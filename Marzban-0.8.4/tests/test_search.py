@@ -0,0 +1,82 @@
+import uuid
+
+import pytest
+
+from app.db import crud
+from app.db.models import UserSearchGram
+from app.db.search import user_search_grams
+from app.models.user import UserModify
+
+
+@pytest.fixture
+def prefix() -> str:
+    """Unique to the test, so other tests' users don't match."""
+    return f"s{uuid.uuid4().hex[:8]}"
+
+
+def search(db, term: str) -> list:
+    return [user.username for user in crud.get_users(db, search=term)]
+
+
+def test_substrings_of_usernames_and_notes_match(db, create_user, prefix):
+    create_user(username=f"{prefix}_alice", note="Office laptop")
+    create_user(username=f"{prefix}_bob", note="100% paid_up")
+
+    assert search(db, f"{prefix}_ali") == [f"{prefix}_alice"]
+    assert search(db, f"{prefix.upper()}_B") == [f"{prefix}_bob"]
+    assert sorted(search(db, prefix)) == [f"{prefix}_alice", f"{prefix}_bob"]
+    assert f"{prefix}_alice" in search(db, "ice laptop")
+    # LIKE wildcards are matched literally
+    assert f"{prefix}_bob" in search(db, "0% paid_")
+    assert search(db, f"{prefix}%bob") == []
+    assert search(db, f"{prefix}_carol") == []
+
+
+def test_short_terms_match_anywhere(db, create_user, prefix):
+    user = create_user(username=f"q{prefix}", note="zq")
+
+    assert user.username in search(db, prefix[:2].upper())
+    assert user.username in search(db, "q")
+    assert user.username in search(db, "zq")
+    assert user.username not in search(db, "qz")
+
+
+def test_results_are_ranked(db, create_user, prefix):
+    note_only = create_user(username=f"n{prefix[::-1]}", note=f"see {prefix}").username
+    contains = create_user(username=f"x_{prefix}").username
+    starts = create_user(username=f"{prefix}_2").username
+    exact = create_user(username=prefix.upper()).username
+
+    assert search(db, prefix) == [exact, starts, contains, note_only]
+
+
+def test_cursor_pages_follow_the_ranking(db, create_user, prefix):
+    for username in (f"x_{prefix}", f"{prefix}_a", f"y_{prefix}", prefix, f"{prefix}_b"):
+        create_user(username=username)
+    expected = search(db, prefix)
+
+    pages, cursor = [], None
+    while True:
+        users = crud.get_users(db, search=prefix, limit=2, cursor=cursor)
+        if not users:
+            break
+        pages.append([user.username for user in users])
+        cursor = crud.encode_users_cursor(users[-1], search=prefix)
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert sum(pages, []) == expected
+
+
+def test_index_follows_the_users(db, create_user, prefix):
+    user = create_user(username=f"{prefix}_before", note="first note")
+    grams = lambda: {gram for gram, in db.query(UserSearchGram.gram).filter(UserSearchGram.user_id == user.id)}
+    assert grams() == user_search_grams(user.username, user.note)
+
+    user = crud.update_user(db, user, UserModify(note="second note"))
+    assert grams() == user_search_grams(user.username, "second note")
+    assert user.username not in search(db, "first note")
+    assert user.username in search(db, "second note")
+
+    crud.remove_user(db, user)
+    assert grams() == set()
+    assert search(db, prefix) == []
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+
+from app.db.models import NodeUserUsage
+from app.jobs import record_usages
+from app.utils.spool import Spool
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path / "usages.spool"))
+    monkeypatch.setattr(record_usages, "usage_spool", spool)
+    return spool
+
+
+def usage(user, value: int) -> dict:
+    return {"created_at": datetime.utcnow().isoformat(),
+            "nodes": [{"node_id": None, "coefficient": 1, "params": [{"uid": str(user.id), "value": value}]}]}
+
+
+def test_pending_batches_are_taken_again_until_committed(spool):
+    assert spool.take() is None
+    spool.append({"n": 1})
+    spool.append({"n": 2})
+
+    batch = spool.take()
+    assert batch.records == [{"n": 1}, {"n": 2}]
+    # records appended meanwhile wait for the next batch
+    spool.append({"n": 3})
+    assert spool.take() == batch
+
+    spool.commit()
+    next_batch = spool.take()
+    assert next_batch.records == [{"n": 3}]
+    assert next_batch.id != batch.id
+
+
+def test_the_directory_is_created_on_the_first_append(tmp_path):
+    spool = Spool(str(tmp_path / "missing" / "usages.spool"))
+    assert not (tmp_path / "missing").exists()
+    assert spool.take() is None
+
+    spool.append({"n": 1})
+    assert spool.take().records == [{"n": 1}]
+
+
+def test_torn_records_are_skipped(spool):
+    spool.append({"n": 1})
+    with open(spool.path, "a") as f:
+        f.write('{"n": 2, "tor')
+
+    spool = Spool(spool.path)
+    spool.append({"n": 3})
+    assert spool.take().records == [{"n": 1}, {"n": 3}]
+
+
+def test_flush_writes_the_usages(spool, db, create_user):
+    user = create_user()
+    spool.append(usage(user, 100))
+    spool.append(usage(user, 50))
+
+    record_usages.flush_user_usages()
+
+    db.refresh(user)
+    assert user.used_traffic == 150
+    assert db.query(NodeUserUsage.used_traffic).filter(NodeUserUsage.user_id == user.id).scalar() == 150
+    assert spool.take() is None
+
+
+def test_replayed_batches_are_not_counted_twice(spool, db, create_user):
+    user = create_user()
+    spool.append(usage(user, 100))
+
+    # the process stops after the usages are committed, before the spool is cleared
+    batch = spool.take()
+    record_usages.safe_transaction(lambda db: record_usages.write_user_usages_batch(db, batch))
+
+    spool.append(usage(user, 10))
+    record_usages.flush_user_usages()
+
+    db.refresh(user)
+    assert user.used_traffic == 110
+    assert spool.take() is None
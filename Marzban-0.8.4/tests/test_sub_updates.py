@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+from app import scheduler
+from app.db import crud
+from app.db import sub_updates as sub_updates_module
+from app.db.sub_updates import SubUpdatesBuffer
+from app.jobs import flush_sub_updates
+
+NOW = datetime(2024, 1, 2, 3, 4, 5)
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    buffer = SubUpdatesBuffer(3)
+    requests = []
+    buffer.on_full = lambda: requests.append(len(buffer))
+    buffer.requests = requests
+    monkeypatch.setattr(sub_updates_module, "sub_updates", buffer)
+    monkeypatch.setattr(crud, "sub_updates", buffer)
+    monkeypatch.setattr(flush_sub_updates, "sub_updates", buffer)
+    return buffer
+
+
+def test_a_full_buffer_requests_a_flush_once(buffer):
+    for user_id in range(1, 6):
+        buffer.add(user_id, NOW, "agent")
+
+    assert buffer.requests == [3]
+    buffer.take()
+    for user_id in range(1, 4):
+        buffer.add(user_id, NOW, "agent")
+    assert buffer.requests == [3, 3]
+
+
+def test_the_oldest_fetches_are_dropped_past_twice_the_size(buffer):
+    for user_id in range(1, 7):
+        buffer.add(user_id, NOW, f"agent {user_id}")
+    # fetching again makes the user's the latest
+    buffer.add(1, NOW, "agent 1 again")
+    buffer.add(7, NOW, "agent 7")
+
+    assert buffer.dropped == 1
+    assert list(buffer.take()) == [3, 4, 5, 6, 1, 7]
+
+
+def test_restored_fetches_are_older_than_the_new_ones(buffer):
+    for user_id in range(1, 5):
+        buffer.add(user_id, NOW, "old")
+    pending = buffer.take()
+    for user_id in (4, 5, 6):
+        buffer.add(user_id, NOW, "new")
+
+    buffer.restore(pending)
+
+    assert buffer.dropped == 0
+    assert buffer.take() == {1: (NOW, "old"), 2: (NOW, "old"), 3: (NOW, "old"),
+                             4: (NOW, "new"), 5: (NOW, "new"), 6: (NOW, "new")}
+
+
+def test_failed_flushes_dont_reach_the_subscriptions(db, create_user, buffer, monkeypatch):
+    users = [create_user() for _ in range(4)]
+    write = sub_updates_module._write_sub_updates
+
+    def fail(pending):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(sub_updates_module, "_write_sub_updates", fail)
+    for user in users:
+        crud.update_user_sub(db, user, "v2rayNG/1.8")
+    flush_sub_updates.flush_sub_updates_job()
+    assert len(buffer) == 4
+
+    monkeypatch.setattr(sub_updates_module, "_write_sub_updates", write)
+    flush_sub_updates.flush_sub_updates_job()
+    assert len(buffer) == 0
+    for user in users:
+        db.expire(user)
+        assert user.sub_last_user_agent == "v2rayNG/1.8"
+
+
+def test_a_flush_request_runs_the_job_now():
+    job = scheduler.get_job(flush_sub_updates.JOB_ID)
+    job.modify(next_run_time=datetime(2100, 1, 1).astimezone())
+
+    flush_sub_updates.request_flush()
+
+    assert scheduler.get_job(flush_sub_updates.JOB_ID).next_run_time.year < 2100
@@ -0,0 +1,51 @@
+import pytest
+
+from app import xray
+from app.subscription.cache import get_subscription, is_randomized, subscription_cache
+
+
+@pytest.fixture
+def hosts():
+    """The hosts of every inbound, to be modified by the test."""
+    xray.hosts.update()
+    yield xray.hosts
+    xray.hosts.update()
+
+
+def fetch(dbuser):
+    return get_subscription(dbuser, "v2ray", as_base64=False, reverse=False)
+
+
+def test_subscriptions_are_cached(create_user, hosts):
+    user = create_user(proxies={"vmess": {}})
+
+    assert not is_randomized(user)
+    assert fetch(user) is fetch(user)
+
+
+@pytest.mark.parametrize("field, values", [
+    ("address", ["a.example.com", "b.example.com"]),
+    ("address", ["*.example.com"]),
+    ("sni", ["a.example.com", "b.example.com"]),
+    ("host", ["*.example.com"]),
+])
+def test_random_picks_are_not_cached(create_user, hosts, field, values):
+    user = create_user(proxies={"vmess": {}})
+    fetch(user)
+    hosts["VMess WS"][0][field] = values
+    subscription_cache.bump()
+    entries = len(subscription_cache)
+
+    assert is_randomized(user)
+    assert fetch(user) is not fetch(user)
+    assert len(subscription_cache) == entries
+
+
+def test_only_the_users_inbounds_matter(create_user, hosts):
+    # the reality inbound picks one of its short ids at random
+    user = create_user(proxies={"vless": {}})
+    excluded = create_user(proxies={"vless": {}}, inbounds={"vless": ["VLESS WS"]})
+
+    assert is_randomized(user)
+    assert not is_randomized(excluded)
+    assert fetch(excluded) is fetch(excluded)
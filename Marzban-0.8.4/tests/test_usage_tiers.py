@@ -0,0 +1,157 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.db import crud
+from app.db.models import Node, NodeUserUsage, NodeUserUsageDaily, NodeUserUsageMonthly
+from app.models.admin import AdminCreate
+from app.models.user import UsageGranularity
+
+NOW = datetime.utcnow()
+
+
+@pytest.fixture(autouse=True)
+def clear_usages(db):
+    # the tiers are rolled up for every user at once
+    for model in (NodeUserUsage, NodeUserUsageDaily, NodeUserUsageMonthly):
+        db.query(model).delete()
+    db.commit()
+
+
+@pytest.fixture
+def node(db):
+    node = db.query(Node).filter(Node.name == "usage tiers").first()
+    if node is None:
+        node = Node(name="usage tiers", address="127.0.0.1", port=62050, api_port=62051)
+        db.add(node)
+        db.commit()
+    return node
+
+
+def add_hourly_usages(db, user_ids, node_ids, days: int = 100, seed: int = 1) -> list:
+    """Random hourly usages of the users over the last `days` days, returned as (hour, user id, node id, traffic)."""
+    rnd = random.Random(seed)
+    rows = []
+    hour = (NOW - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+    while hour <= NOW:
+        for user_id in user_ids:
+            for node_id in node_ids:
+                if rnd.random() < 0.3:
+                    rows.append((hour, user_id, node_id, rnd.randint(1, 1000)))
+        hour += timedelta(hours=1)
+
+    db.add_all(NodeUserUsage(created_at=hour, user_id=user_id, node_id=node_id, used_traffic=traffic)
+               for hour, user_id, node_id, traffic in rows)
+    db.commit()
+    return rows
+
+
+def expected_usages(rows, user_id, start, end) -> dict:
+    usages = {}
+    for hour, row_user_id, node_id, traffic in rows:
+        if row_user_id == user_id and start <= hour <= end:
+            usages[node_id] = usages.get(node_id, 0) + traffic
+    return usages
+
+
+def node_usages(db, user_id, start, end, granularity=None) -> dict:
+    usages = crud._get_node_user_usages(db, start, end, user_id=user_id, granularity=granularity)
+    if granularity:
+        return usages
+    return {node_id: buckets[None] for node_id, buckets in usages.items() if buckets[None]}
+
+
+def random_ranges(count: int, seed: int = 2) -> list:
+    rnd = random.Random(seed)
+    ranges = []
+    for _ in range(count):
+        start = NOW - timedelta(days=rnd.uniform(0, 110))
+        ranges.append((start, start + timedelta(days=rnd.uniform(0, 110))))
+    return ranges
+
+
+def test_rolled_up_usages_match_the_hourly_ones(db, create_user, node):
+    user = create_user()
+    rows = add_hourly_usages(db, [user.id], [None, node.id])
+    ranges = random_ranges(100)
+
+    crud.rollup_node_user_usages(db)
+    # recomputing the last days is idempotent
+    crud.rollup_node_user_usages(db)
+
+    assert db.query(NodeUserUsageDaily).count()
+    assert db.query(NodeUserUsageMonthly).count()
+    for start, end in ranges:
+        assert node_usages(db, user.id, start, end) == expected_usages(rows, user.id, start, end)
+
+
+def test_pruned_days_are_read_from_the_daily_tier(db, create_user, node):
+    user = create_user()
+    rows = add_hourly_usages(db, [user.id], [None, node.id])
+    crud.rollup_node_user_usages(db)
+
+    before = crud._floor_day(NOW - timedelta(days=30))
+    assert crud.prune_node_user_usages(db, before)
+    assert db.query(NodeUserUsage).filter(NodeUserUsage.created_at < before).count() == 0
+
+    for start, end in random_ranges(100):
+        # pruned days can only be read whole, at either end of the range
+        expected_start, expected_end = start, end
+        if start < before:
+            expected_start = crud._floor_day(start)
+        if end < before:
+            expected_end = crud._floor_day(end) + timedelta(days=1, microseconds=-1)
+        assert node_usages(db, user.id, start, end) == expected_usages(rows, user.id, expected_start, expected_end)
+
+
+def test_daily_buckets_span_the_tiers(db, create_user, node):
+    user = create_user()
+    rows = add_hourly_usages(db, [user.id], [node.id], days=60)
+    crud.rollup_node_user_usages(db)
+
+    start, end = NOW - timedelta(days=70), NOW
+    expected = {}
+    for hour, _, _, traffic in rows:
+        day = crud._floor_day(hour)
+        expected[day] = expected.get(day, 0) + traffic
+
+    assert node_usages(db, user.id, start, end, UsageGranularity.day) == {node.id: expected}
+
+
+def test_reset_user_data_usage_clears_the_tiers(db, create_user, node):
+    user, other = create_user(), create_user()
+    rows = add_hourly_usages(db, [user.id, other.id], [None, node.id], days=70)
+    crud.rollup_node_user_usages(db)
+    start = NOW - timedelta(days=80)
+
+    crud.reset_user_data_usage(db, user)
+
+    assert node_usages(db, user.id, start, NOW) == {}
+    for tier in (NodeUserUsageDaily, NodeUserUsageMonthly):
+        assert db.query(tier).filter(tier.user_id == user.id).count() == 0
+    assert node_usages(db, other.id, start, NOW) == expected_usages(rows, other.id, start, NOW)
+
+    # nor are they brought back by the next rollup
+    crud.rollup_node_user_usages(db)
+    assert node_usages(db, user.id, start, NOW) == {}
+
+
+def test_reset_all_users_data_usage_clears_the_tiers_of_the_admin(db, create_user, node):
+    admin = crud.create_admin(db, AdminCreate(username=f"tiers{random.randrange(10 ** 6)}", password="x",
+                                              is_sudo=False))
+    user, other = create_user(), create_user()
+    crud.set_owner(db, user, admin)
+    rows = add_hourly_usages(db, [user.id, other.id], [None, node.id], days=70)
+    crud.rollup_node_user_usages(db)
+    start = NOW - timedelta(days=80)
+
+    crud.reset_all_users_data_usage(db, admin)
+
+    assert node_usages(db, user.id, start, NOW) == {}
+    assert node_usages(db, other.id, start, NOW) == expected_usages(rows, other.id, start, NOW)
+
+    crud.reset_all_users_data_usage(db)
+
+    assert node_usages(db, other.id, start, NOW) == {}
+    assert db.query(NodeUserUsageDaily).count() == db.query(NodeUserUsageMonthly).count() == 0
@@ -0,0 +1,48 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from app.db.models import Node, NodeUserUsage
+from app.jobs import record_usages
+
+HOUR = datetime(2001, 2, 3, 4)
+
+
+@pytest.fixture
+def node(db):
+    node = Node(name=f"node_{uuid.uuid4().hex[:8]}", address="127.0.0.1", port=62050, api_port=62051)
+    db.add(node)
+    db.commit()
+    return node
+
+
+def usages(db, node_id, users) -> dict:
+    return dict(
+        db.query(NodeUserUsage.user_id, NodeUserUsage.used_traffic)
+        .filter(NodeUserUsage.created_at == HOUR,
+                NodeUserUsage.node_id == node_id if node_id else NodeUserUsage.node_id.is_(None),
+                NodeUserUsage.user_id.in_([user.id for user in users]))
+    )
+
+
+def record(params, node_id, consumption_factor=1):
+    record_usages.safe_transaction(
+        lambda db: record_usages.record_user_stats(db, params, node_id, HOUR, consumption_factor)
+    )
+
+
+@pytest.mark.parametrize("main_core", [False, True])
+def test_usages_are_added_to_the_hourly_rows(db, create_user, node, monkeypatch, main_core):
+    monkeypatch.setattr(record_usages, "RECORD_USER_USAGES_CHUNK_SIZE", 2)
+    node_id = None if main_core else node.id
+    users = [create_user() for _ in range(5)]
+
+    record([{"uid": str(user.id), "value": 10} for user in users[:3]], node_id)
+    record([{"uid": str(user.id), "value": 5} for user in users[1:]], node_id, consumption_factor=2)
+
+    assert usages(db, node_id, users) == {
+        users[0].id: 10, users[1].id: 20, users[2].id: 20, users[3].id: 10, users[4].id: 10
+    }
+    assert db.query(NodeUserUsage).filter(NodeUserUsage.created_at == HOUR,
+                                          NodeUserUsage.user_id.in_([user.id for user in users])).count() == 5
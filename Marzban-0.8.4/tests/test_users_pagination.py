@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from app.db import crud
+from app.db.crud import UsersSortingOptions
+
+SORTS = [
+    None,
+    ["username"],
+    ["-data_limit"],
+    ["expire", "-username"],
+    ["data_limit", "-created_at"],
+    ["-expire", "used_traffic"],
+]
+
+
+@pytest.fixture
+def usernames(create_user):
+    now = int(time.time())
+    fields = [
+        (None, None), (1000, now + 3600), (1000, None), (None, now + 3600),
+        (5000, now + 60), (2000, now + 7200), (1000, now + 60),
+    ]
+    return [create_user(data_limit=data_limit, expire=expire).username for data_limit, expire in fields]
+
+
+def pages(db, usernames, sort, limit):
+    pages, cursor = [], None
+    while True:
+        users = crud.get_users(db, usernames=usernames, sort=sort, limit=limit, cursor=cursor)
+        if not users:
+            return pages
+        pages.append([user.username for user in users])
+        cursor = crud.encode_users_cursor(users[-1], sort)
+
+
+@pytest.mark.parametrize("names", SORTS)
+@pytest.mark.parametrize("limit", [1, 2, 3])
+def test_cursor_pages_match_the_offset_pages(db, usernames, names, limit):
+    sort = [UsersSortingOptions[name] for name in names] if names else None
+    # without sorting options nor a limit, users aren't ordered at all
+    expected = [user.username for user in crud.get_users(db, usernames=usernames, sort=sort, limit=100)]
+
+    result = pages(db, usernames, sort, limit)
+
+    assert sum(result, []) == expected
+    assert all(len(page) == limit for page in result[:-1])
+    assert result == [
+        [user.username for user in crud.get_users(db, usernames=usernames, sort=sort, offset=i, limit=limit)]
+        for i in range(0, len(expected), limit)
+    ]
+
+
+def test_users_with_nulls_are_grouped(db, usernames):
+    sort = [UsersSortingOptions["data_limit"]]
+    users = crud.get_users(db, usernames=usernames, sort=sort)
+
+    assert [user.data_limit for user in users] == [1000, 1000, 1000, 2000, 5000, None, None]
+
+
+def test_cursors_of_other_sorts_are_rejected(db, usernames):
+    [user] = crud.get_users(db, usernames=usernames, limit=1)
+    cursor = crud.encode_users_cursor(user, [UsersSortingOptions["username"]])
+
+    with pytest.raises(ValueError):
+        crud.get_users(db, usernames=usernames, sort=[UsersSortingOptions["-username"]], cursor=cursor)
+    with pytest.raises(ValueError):
+        crud.get_users(db, cursor="not a cursor")
+
+
+def test_counts_are_cached_until_users_change(db, create_user, monkeypatch):
+    monkeypatch.setattr(crud, "USERS_COUNT_CACHE_TTL", 60)
+    crud.clear_users_count_cache()
+    _, total = crud.get_users(db, limit=1, return_with_count=True)
+
+    user = create_user()
+    assert crud.get_users(db, limit=1, return_with_count=True)[1] == total + 1
+
+    # users changed without crud aren't seen until the count expires
+    db.delete(user)
+    db.commit()
+    assert crud.get_users(db, limit=1, return_with_count=True)[1] == total + 1
+    crud.clear_users_count_cache()
+    assert crud.get_users(db, limit=1, return_with_count=True)[1] == total
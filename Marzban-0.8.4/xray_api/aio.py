@@ -0,0 +1,197 @@
+import asyncio
+import typing
+from weakref import WeakKeyDictionary
+
+import grpc
+import grpc.aio
+
+from .base import XRayBase
+from .exceptions import RelatedError
+from .proto.app.proxyman.command import command_pb2 as proxyman_command_pb2
+from .proto.app.proxyman.command import command_pb2_grpc as proxyman_command_pb2_grpc
+from .proto.app.stats.command import command_pb2 as stats_command_pb2
+from .proto.app.stats.command import command_pb2_grpc as stats_command_pb2_grpc
+from .proto.common.protocol import user_pb2
+from .stats import StatResponse, SysStatsResponse
+from .types.account import Account
+from .types.message import Message, TypedMessage
+
+K = typing.TypeVar("K")
+T = typing.TypeVar("T")
+
+
+class AsyncXRay:
+    """
+    grpc.aio counterpart of XRay.
+
+    The stubs are built once per channel and every call gets a deadline, `timeout`
+    when given or the client's default otherwise. A client is bound to the event loop
+    it's created in.
+    """
+
+    def __init__(self, address: str, port: int, ssl_cert: bytes = None, ssl_target_name: str = None,
+                 timeout: float = None):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+
+        if ssl_cert is None:
+            self._channel = grpc.aio.insecure_channel(f"{address}:{port}")
+        else:
+            creds = grpc.ssl_channel_credentials(root_certificates=ssl_cert)
+            opts = None
+            if ssl_target_name is not None:
+                opts = (('grpc.ssl_target_name_override', ssl_target_name,),)
+            self._channel = grpc.aio.secure_channel(f"{address}:{port}",
+                                                    credentials=creds,
+                                                    options=opts)
+
+        self._stats_stub = stats_command_pb2_grpc.StatsServiceStub(self._channel)
+        self._handler_stub = proxyman_command_pb2_grpc.HandlerServiceStub(self._channel)
+
+    @classmethod
+    def from_api(cls, api: XRayBase, timeout: float = None) -> "AsyncXRay":
+        return cls(api.address, api.port, api.ssl_cert, api.ssl_target_name, timeout=timeout)
+
+    async def close(self):
+        await self._channel.close()
+
+    def _timeout(self, timeout: typing.Optional[float]) -> typing.Optional[float]:
+        return self.timeout if timeout is None else timeout
+
+    async def get_sys_stats(self, timeout: float = None) -> SysStatsResponse:
+        try:
+            r = await self._stats_stub.GetSysStats(stats_command_pb2.SysStatsRequest(),
+                                                   timeout=self._timeout(timeout))
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        return SysStatsResponse(
+            num_goroutine=r.NumGoroutine,
+            num_gc=r.NumGC,
+            alloc=r.Alloc,
+            total_alloc=r.TotalAlloc,
+            sys=r.Sys,
+            mallocs=r.Mallocs,
+            frees=r.Frees,
+            live_objects=r.LiveObjects,
+            pause_total_ns=r.PauseTotalNs,
+            uptime=r.Uptime
+        )
+
+    async def query_stats(self, pattern: str, reset: bool = False, timeout: float = None) -> typing.List[StatResponse]:
+        try:
+            r = await self._stats_stub.QueryStats(
+                stats_command_pb2.QueryStatsRequest(pattern=pattern, reset=reset),
+                timeout=self._timeout(timeout)
+            )
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+        stats = []
+        for stat in r.stat:
+            type, name, _, link = stat.name.split('>>>')
+            stats.append(StatResponse(name, type, link, stat.value))
+        return stats
+
+    async def get_users_stats(self, reset: bool = False, timeout: float = None) -> typing.List[StatResponse]:
+        return await self.query_stats("user>>>", reset=reset, timeout=timeout)
+
+    async def get_inbounds_stats(self, reset: bool = False, timeout: float = None) -> typing.List[StatResponse]:
+        return await self.query_stats("inbound>>>", reset=reset, timeout=timeout)
+
+    async def get_outbounds_stats(self, reset: bool = False, timeout: float = None) -> typing.List[StatResponse]:
+        return await self.query_stats("outbound>>>", reset=reset, timeout=timeout)
+
+    async def alter_inbound(self, tag: str, operation: TypedMessage, timeout: float = None) -> bool:
+        try:
+            await self._handler_stub.AlterInbound(
+                proxyman_command_pb2.AlterInboundRequest(tag=tag, operation=operation),
+                timeout=self._timeout(timeout)
+            )
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+    async def add_inbound_user(self, tag: str, user: Account, timeout: float = None) -> bool:
+        return await self.alter_inbound(
+            tag=tag,
+            operation=Message(
+                proxyman_command_pb2.AddUserOperation(
+                    user=user_pb2.User(
+                        level=user.level,
+                        email=user.email,
+                        account=user.message
+                    )
+                )
+            ), timeout=timeout)
+
+    async def remove_inbound_user(self, tag: str, email: str, timeout: float = None) -> bool:
+        return await self.alter_inbound(
+            tag=tag,
+            operation=Message(
+                proxyman_command_pb2.RemoveUserOperation(
+                    email=email
+                )
+            ), timeout=timeout)
+
+
+_clients: "WeakKeyDictionary[XRayBase, AsyncXRay]" = WeakKeyDictionary()
+
+
+def get_async_api(api: XRayBase) -> AsyncXRay:
+    """
+    Returns the cached async client talking to the same core as the sync `api`.
+
+    Must be called from the event loop the clients are used in, a new sync client
+    (e.g. after a node restart) gets a new async one.
+    """
+    try:
+        return _clients[api]
+    except KeyError:
+        client = _clients[api] = AsyncXRay.from_api(api)
+        return client
+
+
+def release_async_api(api: XRayBase) -> typing.Optional[AsyncXRay]:
+    """
+    Forgets the async client of a sync `api` that's replaced or dropped, and returns it.
+
+    The caller closes it, on the event loop it's used in.
+    """
+    return _clients.pop(api, None)
+
+
+async def fan_out(clients: typing.Dict[K, AsyncXRay],
+                  call: typing.Callable[[AsyncXRay], typing.Awaitable[T]],
+                  limit: int = None) -> typing.Dict[K, typing.Union[T, Exception]]:
+    """
+    Runs `call` against every client concurrently.
+
+    Args:
+        clients: clients keyed by anything, e.g. node ids.
+        call: coroutine function receiving a client.
+        limit: max calls in flight, unlimited if None.
+
+    Returns:
+        Dict[K, Union[T, Exception]]: result of every client, or the exception it raised.
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run(client: AsyncXRay):
+        if semaphore is None:
+            return await call(client)
+        async with semaphore:
+            return await call(client)
+
+    results = await asyncio.gather(*(run(client) for client in clients.values()), return_exceptions=True)
+    return dict(zip(clients.keys(), results))
+
+
+__all__ = [
+    "AsyncXRay",
+    "get_async_api",
+    "release_async_api",
+    "fan_out",
+]
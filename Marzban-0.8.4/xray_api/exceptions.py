@@ -34,6 +34,14 @@ class TagNotFoundError(XrayError):
         super().__init__(details)
 
 
+class TagExistsError(XrayError):
+    REGEXP = re.compile(r"existing tag found: (.*)")
+
+    def __init__(self, details, tag):
+        self.tag = tag
+        super().__init__(details)
+
+
 class ConnectionError(XrayError):
     REGEXP = re.compile(r"Failed to connect to remote host|Socket closed|Broken pipe")
 
@@ -57,7 +65,8 @@ class RelatedError(XrayError):
     def __new__(cls, error: grpc.RpcError):
         details = error.details()
 
-        for e in (EmailExistsError, EmailNotFoundError, TagNotFoundError, ConnectionError, TimeoutError):
+        for e in (EmailExistsError, EmailNotFoundError, TagNotFoundError, TagExistsError,
+                  ConnectionError, TimeoutError):
             m = e.REGEXP.search(details)
             if not m:
                 continue
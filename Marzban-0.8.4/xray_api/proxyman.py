@@ -26,7 +26,7 @@ class Proxyman(XRayBase):
     def alter_outbound(self, tag: str, operation: TypedMessage, timeout: int = None) -> bool:
         stub = command_pb2_grpc.HandlerServiceStub(self._channel)
         try:
-            stub.AlterInbound(command_pb2.AlterOutboundRequest(tag=tag, operation=operation), timeout=timeout)
+            stub.AlterOutbound(command_pb2.AlterOutboundRequest(tag=tag, operation=operation), timeout=timeout)
             return True
 
         except grpc.RpcError as e:
@@ -76,14 +76,38 @@ class Proxyman(XRayBase):
                 )
             ), timeout=timeout)
 
-    def add_inbound(self):
-        raise NotImplementedError
+    def add_inbound(self, inbound: core_config_pb2.InboundHandlerConfig, timeout: int = None) -> bool:
+        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        try:
+            stub.AddInbound(command_pb2.AddInboundRequest(inbound=inbound), timeout=timeout)
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+    def remove_inbound(self, tag: str, timeout: int = None) -> bool:
+        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        try:
+            stub.RemoveInbound(command_pb2.RemoveInboundRequest(tag=tag), timeout=timeout)
+            return True
+
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+
+    def add_outbound(self, outbound: core_config_pb2.OutboundHandlerConfig, timeout: int = None) -> bool:
+        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        try:
+            stub.AddOutbound(command_pb2.AddOutboundRequest(outbound=outbound), timeout=timeout)
+            return True
 
-    def remove_inbound(self):
-        raise NotImplementedError
+        except grpc.RpcError as e:
+            raise RelatedError(e)
 
-    def add_outbound(self):
-        raise NotImplementedError
+    def remove_outbound(self, tag: str, timeout: int = None) -> bool:
+        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        try:
+            stub.RemoveOutbound(command_pb2.RemoveOutboundRequest(tag=tag), timeout=timeout)
+            return True
 
-    def remove_outbound(self):
-        raise NotImplementedError
+        except grpc.RpcError as e:
+            raise RelatedError(e)